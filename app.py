@@ -1,3 +1,8 @@
+import multiprocessing
+
 from nuc_data_tool.__main__ import main
 
-main()
+if __name__ == '__main__':
+    # pyinstaller 打包后，compare/extract/detect 的 --jobs 子进程需要由此进入 worker 而不是重新运行命令行
+    multiprocessing.freeze_support()
+    main()
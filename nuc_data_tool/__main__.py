@@ -1,20 +1,20 @@
+import multiprocessing
+import sys
 from pathlib import Path
 
 import click
 
 from nuc_data_tool import __version__
-from nuc_data_tool.anomaly_detection.train_and_detection import save_prediction_to_exel
-from nuc_data_tool.db.db_utils import init_db
+from nuc_data_tool.db.db_utils import init_db, create_missing_tables
 from nuc_data_tool.db.fetch_data import (fetch_extracted_data_id,
                                          fetch_physical_quantities_by_name,
                                          fetch_files_by_name)
 from nuc_data_tool.utils.configlib import config
-from nuc_data_tool.utils.data_extraction import save_extracted_data_to_exel
-from nuc_data_tool.utils.fill_db import populate_database
 from nuc_data_tool.utils.formatter import (all_physical_quantity_list,
                                            physical_quantity_list_generator)
-from nuc_data_tool.utils.input_xml_file import InputXmlFileReader
-from nuc_data_tool.utils.relative_error_calculation import save_comparison_result_to_excel
+from nuc_data_tool.utils.workbook import output_formats
+
+# 各子命令的实现模块在命令中导入，nuctool --help 和 fetch 等命令不需要加载 pycaret 等较慢的依赖
 
 
 class PythonLiteralOption(click.Option):
@@ -79,15 +79,26 @@ def main_cli():
               is_flag=True,
               default=False,
               help='初始化数据库')
+@click.option('--reingest', '-re',
+              'reingest',
+              is_flag=True,
+              default=False,
+              help='重新导入数据库中已存在的文件')
 def pop(path,
         physical_quantities,
-        initiation):
+        initiation,
+        reingest):
     """
     将输出文件(*.xml.out) 的内容填充进数据库
     """
+    from nuc_data_tool.utils.fill_db import populate_database, sync_nuclide_sets
+    from nuc_data_tool.utils.input_xml_file import InputXmlFileReader
 
     if initiation is True:
         init_db()
+    else:
+        # 旧版本数据库的 file 表中没有 generation 列
+        create_missing_tables()
 
     physical_quantities = physical_quantity_list_generator(physical_quantities)
 
@@ -98,7 +109,9 @@ def pop(path,
             print(f'found:     {xml_file.fetched_physical_quantity}')
             print(f'not found: {xml_file.unfetched_physical_quantity}')
             print()
-            populate_database(xml_file)
+            populate_database(xml_file, reingest)
+
+    sync_nuclide_sets()
 
 
 @main_cli.command()
@@ -133,12 +146,30 @@ def pop(path,
               is_flag=True,
               default=False,
               help='将结果合并输出至一个文件')
+@click.option('--chunk_size', '-cs',
+              'chunk_size',
+              type=click.INT,
+              default=config.get_data_extraction_conf('chunk_size') or 10000,
+              help='数据库分块读取时每块的行数，默认读取配置文件中的值')
+@click.option('--format', '-fmt',
+              'output_format',
+              default='xlsx',
+              type=click.Choice(output_formats, case_sensitive=False),
+              help='输出格式，默认为xlsx，csv/parquet/feather 每个物理量输出为目录中的一个文件，hdf5 每个物理量为一个group')
+@click.option('--jobs', '-j',
+              'jobs',
+              type=click.IntRange(min=1),
+              default=1,
+              help='并行的进程数，默认为1，只用于没有 --merge 时每个文件单独输出')
 def extract(filenames,
             result_path,
             physical_quantities,
             nuclide_list,
             is_all_step,
-            merge):
+            merge,
+            chunk_size,
+            output_format,
+            jobs):
     """
     从数据库导出选中的文件的数据到工作簿(xlsx文件)
 
@@ -151,6 +182,10 @@ def extract(filenames,
     文件名(没有后缀) 例如：001.xml.out -> 001
     文件名列表 例如： 001 002 003
     """
+    from nuc_data_tool.utils.data_extraction import save_extracted_data_to_exel
+
+    # 旧版本数据库的 file 表中没有 generation 列
+    create_missing_tables()
 
     if filenames:
         filenames = fetch_files_by_name(filenames)
@@ -163,14 +198,17 @@ def extract(filenames,
     physical_quantities = fetch_physical_quantities_by_name(physical_quantities)
     nuc_data_id = fetch_extracted_data_id(filenames,
                                           physical_quantities,
-                                          config.get_nuclide_list(nuclide_list))
+                                          nuclide_list)
 
     save_extracted_data_to_exel(nuc_data_id=nuc_data_id,
                                 filenames=filenames,
                                 physical_quantities=physical_quantities,
                                 is_all_step=is_all_step,
                                 result_path=result_path,
-                                merge=merge)
+                                merge=merge,
+                                chunk_size=chunk_size,
+                                output_format=output_format,
+                                jobs=jobs)
 
 
 @main_cli.command()
@@ -213,6 +251,58 @@ def extract(filenames,
               is_flag=True,
               default=False,
               help='提取中间步骤')
+@click.option('--chunk_size', '-cs',
+              'chunk_size',
+              type=click.INT,
+              default=config.get_data_extraction_conf('chunk_size') or 10000,
+              help='数据库分块读取时每块的行数，默认读取配置文件中的值')
+@click.option('--high_precision', '-hp',
+              'is_high_precision',
+              is_flag=True,
+              default=False,
+              help='使用Decimal计算偏差，较慢，默认使用float64')
+@click.option('--jobs', '-j',
+              'jobs',
+              type=click.IntRange(min=1),
+              default=1,
+              help='并行的进程数，默认为1')
+@click.option('--all_pairs', '-ap',
+              'is_all_pairs',
+              is_flag=True,
+              default=False,
+              help='计算全部文件两两之间偏差的最大值，平均值和均方根矩阵，只输出 --pair 指定文件对的详细结果')
+@click.option('--pair', '-pr',
+              'pairs',
+              multiple=True,
+              help='与 --all_pairs 一同使用，输出详细结果的文件对，格式为 reference:comparison')
+@click.option('--recompute', '-rc',
+              'is_recompute',
+              is_flag=True,
+              default=False,
+              help='忽略数据库中保存的对比结果，重新计算')
+@click.option('--summary', '-s',
+              'summary',
+              default=None,
+              type=click.Choice(['json', 'csv'], case_sensitive=False),
+              help='只输出每个文件对每个物理量的摘要(超过阈值的核素数，最大偏差及其核素和步骤)至标准输出，不输出工作簿，'
+                   '有超过阈值的核素时返回值为1')
+@click.option('--statistics', '-st',
+              'is_statistics',
+              is_flag=True,
+              default=False,
+              help='同时输出聚合统计：每一步的最大、均方根偏差及最大偏差所在核素({物理量}_step_stat)，'
+                   '每个核素的最大、均方根偏差及最大偏差所在步骤({物理量}_nuc_stat)')
+@click.option('--alignment', '-al',
+              'alignment',
+              default='step',
+              type=click.Choice(['step', 'time'], case_sensitive=False),
+              help='对齐方式，step: 依照步骤的位置对比(默认)，'
+                   'time: 依照文件的时间间隔和步数，将对比文件的数据线性插值至基准文件各步骤的时间点后对比')
+@click.option('--format', '-fmt',
+              'output_format',
+              default='xlsx',
+              type=click.Choice(output_formats, case_sensitive=False),
+              help='输出格式，默认为xlsx，csv/parquet/feather 每个物理量输出为目录中的一个文件，hdf5 每个物理量为一个group')
 def compare(reference_file,
             comparison_files,
             result_path,
@@ -220,7 +310,17 @@ def compare(reference_file,
             nuclide_list,
             deviation_mode,
             threshold,
-            is_all_step):
+            is_all_step,
+            chunk_size,
+            is_high_precision,
+            jobs,
+            is_all_pairs,
+            pairs,
+            is_recompute,
+            summary,
+            is_statistics,
+            alignment,
+            output_format):
     """
     \b
     对文件列表进行两两组合，进行对比，计算并输出对比结果至工作簿(xlsx文件)
@@ -228,10 +328,74 @@ def compare(reference_file,
     \b
     nuc_data_tool compare 'homo-case001-006' 'homo-case007-012' 'homo-case013-018'
     nuc_data_tool compare 'homo-case001-006'
+    nuc_data_tool compare all --all_pairs --pair 'homo-case001-006:homo-case007-012'
     \b
     文件名(没有后缀) 例如：001.xml.out -> 001
     文件名列表 例如： 001 002 003
     """
+    from nuc_data_tool.utils.relative_error_calculation import (save_comparison_result_to_excel,
+                                                                save_deviation_statistics_to_excel,
+                                                                calculate_comparison_summary)
+
+    if nuclide_list == 'None':
+        nuclide_list = None
+
+    if pairs and not is_all_pairs:
+        raise click.UsageError('--pair can only be used with --all_pairs')
+
+    if is_all_pairs and summary is not None:
+        raise click.UsageError('--summary can not be used with --all_pairs')
+
+    if is_all_pairs and alignment == 'time':
+        raise click.UsageError('--alignment time can not be used with --all_pairs')
+
+    # 对比结果保存在 comparison_result 表中，旧数据库中没有则创建，同时为 file 表添加 generation 列
+    create_missing_tables()
+
+    if is_all_pairs:
+        # 全部文件两两对比，第一个参数也作为文件列表的一部分
+        filenames = fetch_files_by_name([reference_file, *comparison_files])
+        file_dict = {filename.name: filename for filename in filenames}
+
+        pair_dict = {}
+        for pair in pairs:
+            reference_name, _, comparison_name = pair.partition(':')
+            if reference_name not in file_dict or comparison_name not in file_dict:
+                raise click.BadParameter(f'{pair} is not a pair of the selected files', param_hint='--pair')
+            pair_dict.setdefault(reference_name, []).append(file_dict[comparison_name])
+
+        physical_quantities = fetch_physical_quantities_by_name(physical_quantities)
+        nuc_data_id = fetch_extracted_data_id(filenames,
+                                              physical_quantities,
+                                              nuclide_list)
+
+        save_deviation_statistics_to_excel(nuc_data_id=nuc_data_id,
+                                           filenames=filenames,
+                                           result_path=result_path,
+                                           physical_quantities=physical_quantities,
+                                           deviation_mode=deviation_mode,
+                                           is_all_step=is_all_step,
+                                           chunk_size=chunk_size,
+                                           output_format=output_format)
+
+        for reference_name, pair_comparison_files in pair_dict.items():
+            save_comparison_result_to_excel(nuc_data_id=nuc_data_id,
+                                            reference_file=file_dict[reference_name],
+                                            comparison_files=pair_comparison_files,
+                                            result_path=result_path,
+                                            physical_quantities=physical_quantities,
+                                            deviation_mode=deviation_mode,
+                                            threshold=threshold,
+                                            is_all_step=is_all_step,
+                                            chunk_size=chunk_size,
+                                            is_high_precision=is_high_precision,
+                                            jobs=jobs,
+                                            nuclide_list=nuclide_list,
+                                            is_persisted=True,
+                                            is_recompute=is_recompute,
+                                            is_statistics=is_statistics,
+                                            output_format=output_format)
+        return
 
     reference_file = fetch_files_by_name(reference_file).pop()
 
@@ -240,16 +404,33 @@ def compare(reference_file,
     else:
         comparison_files = fetch_files_by_name('all')
 
-    if nuclide_list == 'None':
-        nuclide_list = None
-
     comparison_files = [comparison_file for comparison_file in comparison_files
                         if comparison_file.id != reference_file.id]
 
     physical_quantities = fetch_physical_quantities_by_name(physical_quantities)
     nuc_data_id = fetch_extracted_data_id([reference_file, *comparison_files],
                                           physical_quantities,
-                                          config.get_nuclide_list(nuclide_list))
+                                          nuclide_list)
+
+    if summary is not None:
+        # 只输出摘要，不输出工作簿，有超过阈值的核素时返回非零值
+        df_summary = calculate_comparison_summary(nuc_data_id=nuc_data_id,
+                                                  reference_file=reference_file,
+                                                  comparison_files=comparison_files,
+                                                  physical_quantities=physical_quantities,
+                                                  deviation_mode=deviation_mode,
+                                                  threshold=threshold,
+                                                  is_all_step=is_all_step,
+                                                  chunk_size=chunk_size,
+                                                  alignment=alignment)
+        if summary == 'json':
+            click.echo(df_summary.to_json(orient='records', indent=2))
+        else:
+            click.echo(df_summary.to_csv(index=False), nl=False)
+
+        if (df_summary['count'] > 0).any():
+            sys.exit(1)
+        return
 
     save_comparison_result_to_excel(nuc_data_id=nuc_data_id,
                                     reference_file=reference_file,
@@ -258,7 +439,16 @@ def compare(reference_file,
                                     physical_quantities=physical_quantities,
                                     deviation_mode=deviation_mode,
                                     threshold=threshold,
-                                    is_all_step=is_all_step)
+                                    is_all_step=is_all_step,
+                                    chunk_size=chunk_size,
+                                    is_high_precision=is_high_precision,
+                                    jobs=jobs,
+                                    nuclide_list=nuclide_list,
+                                    is_persisted=True,
+                                    is_recompute=is_recompute,
+                                    is_statistics=is_statistics,
+                                    alignment=alignment,
+                                    output_format=output_format)
 
 
 @main_cli.command()
@@ -271,23 +461,31 @@ def compare(reference_file,
               help='输出文件路径，默认读取配置文件中的路径')
 @click.option('--model_type', '-mt',
               'model_type',
-              default='iforest',
+              default=['iforest'],
+              multiple=True,
               type=click.Choice(['abod', 'iforest', 'cluster',
                                  'cof', 'histogram', 'knn',
-                                 'lof', 'svm', 'pca', 'mcd', 'sos'],
+                                 'lof', 'svm', 'pca', 'mcd', 'sos',
+                                 'zscore'],
                                 case_sensitive=True),
               help="""
 \b
 'abod'      Angle-base Outlier Detection
-'iforest'   Isolation Forest
+'iforest'   Isolation Forest *
 'cluster'   Clustering-Based Local Outlier
 'cof'       Connectivity-Based Outlier Factor
-'histogram' Histogram-based Outlier Detection
-'knn'       k-Nearest Neighbors Detector
-'lof'       Local Outlier Factor
+'histogram' Histogram-based Outlier Detection *
+'knn'       k-Nearest Neighbors Detector *
+'lof'       Local Outlier Factor *
 'svm'       One-class SVM detector
-'pca'       Principal Component Analysis
-'mcd'       Minimum Covariance Determinant
+'pca'       Principal Component Analysis *
+'mcd'       Minimum Covariance Determinant *
+'zscore'    Robust z-score *
+\b
+* 不经过 pycaret setup，直接在特征矩阵上训练和检测
+\b
+可以多次输入，例如 -mt iforest -mt knn，只能组合带 * 的模型，
+输出各模型的异常分数和组合的异常分数(Anomaly_Score)
 """)
 @click.option('--fraction',
               '-fra',
@@ -317,6 +515,26 @@ def compare(reference_file,
               is_flag=True,
               default=False,
               help='将结果合并输出至一个文件')
+@click.option('--format', '-fmt',
+              'output_format',
+              default='xlsx',
+              type=click.Choice(output_formats, case_sensitive=False),
+              help='输出格式，默认为xlsx，csv/parquet/feather 每个物理量输出为目录中的一个文件，hdf5 每个物理量为一个group')
+@click.option('--retrain', '-rt',
+              'is_retrained',
+              is_flag=True,
+              default=False,
+              help='忽略模型注册表中训练数据相同的模型，重新训练')
+@click.option('--jobs', '-j',
+              'jobs',
+              default=1,
+              type=click.IntRange(min=1),
+              help='组合多个模型时并行训练的进程数，默认为1')
+@click.option('--seed', '-sd',
+              'seed',
+              default=0,
+              type=click.INT,
+              help='iforest, pca, mcd 等模型的随机种子(pycaret 的 session_id)，默认为0')
 def detect(filenames,
            result_path,
            model_type,
@@ -324,7 +542,11 @@ def detect(filenames,
            fraction,
            physical_quantities,
            is_all_step,
-           merge):
+           merge,
+           output_format,
+           is_retrained,
+           jobs,
+           seed):
     """
     对数据进行异常检测，并导出异常的数据至工作簿(xlsx文件)
     如果未输入model_type，model_path已输入，
@@ -332,6 +554,10 @@ def detect(filenames,
 
     参数为文件列表(默认为所有文件)
     """
+    from nuc_data_tool.anomaly_detection.train_and_detection import save_prediction_to_exel
+
+    # 旧版本数据库的 file 表中没有 generation 列
+    create_missing_tables()
 
     if filenames:
         filenames = fetch_files_by_name(filenames)
@@ -343,12 +569,16 @@ def detect(filenames,
 
     save_prediction_to_exel(filenames=filenames,
                             result_path=result_path,
-                            model_type=model_type,
+                            model_type=list(model_type),
                             fraction=fraction,
                             model_name=model_name,
                             physical_quantities=physical_quantities,
                             is_all_step=is_all_step,
-                            merge=merge)
+                            merge=merge,
+                            output_format=output_format,
+                            is_retrained=is_retrained,
+                            jobs=jobs,
+                            seed=seed)
 
 
 @main_cli.command()
@@ -399,4 +629,6 @@ def main():
     main_cli(prog_name='nuctool')
 
 
-main()
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
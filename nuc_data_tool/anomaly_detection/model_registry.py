@@ -0,0 +1,156 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from nuc_data_tool.db.cache import digest
+from nuc_data_tool.utils.configlib import config
+
+
+def fingerprint(nuc_data):
+    """
+    训练数据的指纹，columns 和全部数值相同时相同
+
+    Parameters
+    ----------
+    nuc_data : pd.DataFrame
+
+    Returns
+    -------
+    str
+    """
+    hasher = hashlib.sha1(','.join(map(str, nuc_data.columns.tolist())).encode())
+    hasher.update(pd.util.hash_pandas_object(nuc_data, index=False).to_numpy().tobytes())
+    return hasher.hexdigest()
+
+
+def make_model_key(physical_quantity, is_all_step, model_type, fraction, nuc_data, seed=None):
+    """
+    生成模型的key
+
+    Parameters
+    ----------
+    physical_quantity : PhysicalQuantity or str
+    is_all_step : bool
+    model_type : str
+    fraction : float or None
+    nuc_data : pd.DataFrame
+        训练数据
+    seed : int or None, default = None
+        随机种子
+
+    Returns
+    -------
+    tuple
+    """
+    physical_quantity = getattr(physical_quantity, 'name', physical_quantity)
+    return physical_quantity, bool(is_all_step), model_type, fraction, seed, fingerprint(nuc_data)
+
+
+class ModelRegistry:
+    """
+    已训练模型的注册表，训练数据相同时复用模型
+
+    key 为 (physical quantity, is_all_step, model_type, fraction, seed, 训练数据的指纹)，参见 make_model_key，
+    每个模型与其元数据保存为 {path}/{key 的摘要}.pkl，
+    超过 max_entries 个时剔除最久未使用的模型
+
+    Attributes
+    ----------
+    enabled : bool
+    path : Path
+    max_entries : int
+    """
+
+    def __init__(self, path='./model/registry', max_entries=20, enabled=True):
+        self.enabled = enabled
+        self.path = Path(path)
+        self.max_entries = int(max_entries)
+
+    def _model_path(self, key):
+        return self.path.joinpath(f'{digest(key)}.pkl')
+
+    def get(self, key):
+        """
+        获取模型，不存在则返回None
+
+        Parameters
+        ----------
+        key : tuple
+
+        Returns
+        -------
+        Any
+        """
+        if not self.enabled:
+            return None
+
+        model_path = self._model_path(key)
+        if not model_path.is_file():
+            return None
+
+        with model_path.open('rb') as f:
+            entry = pickle.load(f)
+
+        if entry['metadata']['key'] != key:
+            return None
+
+        # 以修改时间记录最近使用的时间
+        model_path.touch()
+        return entry['model']
+
+    def put(self, key, model, **metadata):
+        """
+        保存模型
+
+        Parameters
+        ----------
+        key : tuple
+        model : Any
+        metadata : Any
+            其他元数据，例如训练用的文件名
+
+        Returns
+        -------
+
+        """
+        if not self.enabled:
+            return
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        entry = {'metadata': {'key': key, 'created': datetime.now(), **metadata},
+                 'model': model}
+
+        # 先写入临时文件再替换，多个进程同时保存时不会读到不完整的文件
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, self._model_path(key))
+
+        self._evict()
+
+    def _evict(self):
+        model_paths = sorted(self.path.glob('*.pkl'), key=lambda p: p.stat().st_mtime)
+        for model_path in model_paths[:max(len(model_paths) - self.max_entries, 0)]:
+            model_path.unlink(missing_ok=True)
+
+    def clear(self):
+        """
+        删除全部模型
+
+        Returns
+        -------
+
+        """
+        if self.path.is_dir():
+            for model_path in self.path.glob('*.pkl'):
+                model_path.unlink(missing_ok=True)
+
+
+model_registry = ModelRegistry(path=config.get_anomaly_detection_config('registry_path') or './model/registry',
+                               max_entries=config.get_anomaly_detection_config('registry_max_entries') or 20,
+                               enabled=config.get_anomaly_detection_config('registry_enabled') is not False)
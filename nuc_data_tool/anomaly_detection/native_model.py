@@ -0,0 +1,316 @@
+import importlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# 可以不经过 pycaret setup 直接训练的模型，参数与 pycaret.anomaly.create_model 相同
+_pyod_models = {'iforest': ('pyod.models.iforest', 'IForest', {'behaviour': 'new', 'n_jobs': -1}),
+                'knn': ('pyod.models.knn', 'KNN', {'n_jobs': -1}),
+                'lof': ('pyod.models.lof', 'LOF', {'n_jobs': -1}),
+                'pca': ('pyod.models.pca', 'PCA', {}),
+                'mcd': ('pyod.models.mcd', 'MCD', {}),
+                'histogram': ('pyod.models.hbos', 'HBOS', {})}
+
+# 使用 random_state 的模型
+_seeded_models = ('iforest', 'pca', 'mcd')
+
+native_model_types = [*_pyod_models, 'zscore']
+
+
+class RobustZScore:
+    """
+    稳健 z-score 检测器，异常分数为各列 |x - median| / (1.4826 * MAD) 的最大值，
+    接口与 pyod 的检测器相同(fit, decision_function, predict, threshold_)
+
+    Parameters
+    ----------
+    contamination : float, default = 0.05
+        异常占数据集的比例，用于确定 threshold_
+    """
+
+    def __init__(self, contamination=0.05):
+        self.contamination = contamination
+
+    def fit(self, X):
+        self.median_ = np.median(X, axis=0)
+        mad = np.median(np.abs(X - self.median_), axis=0) * 1.4826
+        self.mad_ = np.where(mad > 0, mad, 1.0)
+
+        self.decision_scores_ = self.decision_function(X)
+        self.threshold_ = np.percentile(self.decision_scores_, 100 * (1 - self.contamination))
+        self.labels_ = (self.decision_scores_ > self.threshold_).astype(int)
+
+        return self
+
+    def decision_function(self, X):
+        if X.shape[1] == 0:
+            return np.zeros(len(X))
+        return np.max(np.abs(X - self.median_) / self.mad_, axis=1)
+
+    def predict(self, X):
+        return (self.decision_function(X) > self.threshold_).astype(int)
+
+
+class NativeModel:
+    """
+    不经过 pycaret setup 的异常检测模型，直接在float64特征矩阵上训练和检测
+
+    预处理与 pycaret.anomaly.setup(normalize=True, normalize_method='robust') 相同:
+    缺失值以训练数据各列的平均值填充，再以中位数和四分位距(IQR)缩放
+
+    Parameters
+    ----------
+    model_type : str
+        参见 native_model_types
+    fraction : float or None, default = None
+        异常占数据集的比例，None 时与 pycaret 相同，为0.05
+    random_state : int or None, default = None
+
+    Attributes
+    ----------
+    columns : list[str]
+        训练时的特征列名，检测时依照该顺序排列
+    """
+
+    def __init__(self, model_type, fraction=None, random_state=None):
+        if model_type not in native_model_types:
+            raise Exception(f"can't support {model_type} model natively")
+
+        self.model_type = model_type
+        self.fraction = 0.05 if fraction is None else fraction
+        self.random_state = random_state
+        self.columns = None
+        self.estimator = None
+
+    def __repr__(self):
+        return f'NativeModel(model_type={self.model_type!r}, fraction={self.fraction!r})'
+
+    def _create_estimator(self, n_jobs=None):
+        if self.model_type == 'zscore':
+            return RobustZScore(contamination=self.fraction)
+
+        module_name, class_name, kwargs = _pyod_models[self.model_type]
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            raise Exception('pyod is required to train the native models, please install it with pip install pyod')
+
+        kwargs = {**kwargs, 'contamination': self.fraction}
+        if n_jobs is not None and 'n_jobs' in kwargs:
+            kwargs['n_jobs'] = n_jobs
+        if self.model_type in _seeded_models:
+            kwargs['random_state'] = self.random_state
+
+        return getattr(module, class_name)(**kwargs)
+
+    def _transform(self, nuc_data):
+        """
+        依照训练时的特征列生成缩放后的float64矩阵
+
+        Parameters
+        ----------
+        nuc_data : pd.DataFrame
+
+        Returns
+        -------
+        np.ndarray
+        """
+        matrix = nuc_data.reindex(columns=self.columns).to_numpy(dtype=np.float64)
+        matrix = np.where(np.isnan(matrix), self.means_, matrix)
+
+        return (matrix - self.center_) / self.scale_
+
+    def _fit_preprocessing(self, nuc_data):
+        """
+        确定特征列、填充值和缩放参数，返回缩放后的训练矩阵
+
+        Parameters
+        ----------
+        nuc_data : pd.DataFrame
+
+        Returns
+        -------
+        np.ndarray
+        """
+        features = nuc_data.drop(columns=['nuc_ix', 'name'])
+        # 全部为空的列没有任何信息，与 pycaret 的缺失值填充相同，不作为特征
+        features = features.loc[:, features.notna().any(axis=0)]
+        self.columns = features.columns.tolist()
+
+        matrix = features.to_numpy(dtype=np.float64)
+        self.means_ = np.nanmean(matrix, axis=0) if len(matrix) else np.zeros(len(self.columns))
+        matrix = np.where(np.isnan(matrix), self.means_, matrix)
+
+        q1, self.center_, q3 = np.percentile(matrix, [25, 50, 75], axis=0)
+        scale = q3 - q1
+        self.scale_ = np.where(scale > 0, scale, 1.0)
+
+        return (matrix - self.center_) / self.scale_
+
+    def _copy_preprocessing(self, other):
+        self.columns = other.columns
+        self.means_ = other.means_
+        self.center_ = other.center_
+        self.scale_ = other.scale_
+
+    def _fit_estimator(self, matrix, n_jobs=None):
+        self.estimator = self._create_estimator(n_jobs)
+        self.estimator.fit(matrix)
+
+        return self
+
+    def fit(self, nuc_data):
+        """
+        训练模型，nuc_ix 和 name 以外的列均为特征
+
+        Parameters
+        ----------
+        nuc_data : pd.DataFrame
+
+        Returns
+        -------
+        NativeModel
+        """
+        return self._fit_estimator(self._fit_preprocessing(nuc_data))
+
+    def predict(self, nuc_data, batch_size=100000):
+        """
+        分批检测，返回带有 Anomaly 和 Anomaly_Score 列的结果，与 pycaret.anomaly.predict_model 相同
+
+        Parameters
+        ----------
+        nuc_data : pd.DataFrame
+        batch_size : int, default = 100000
+            每批的行数
+
+        Returns
+        -------
+        pd.DataFrame
+        """
+        scores = np.empty(len(nuc_data))
+        for start in range(0, len(nuc_data), batch_size):
+            matrix = self._transform(nuc_data.iloc[start:start + batch_size])
+            scores[start:start + batch_size] = self.estimator.decision_function(matrix)
+
+        result = nuc_data.copy()
+        result['Anomaly'] = (scores > self.estimator.threshold_).astype(int)
+        result['Anomaly_Score'] = scores
+
+        return result
+
+
+class NativeEnsemble:
+    """
+    多个 NativeModel 的组合，各模型的预处理相同，检测时只缩放一次
+
+    各模型的异常分数以其训练数据分数的平均值和标准差标准化后取平均，作为组合的异常分数，
+    组合的阈值为训练数据组合分数的 (1 - fraction) 分位数
+
+    Parameters
+    ----------
+    models : list[NativeModel]
+        以相同数据训练的模型，参见 fit_native_models
+    fraction : float or None, default = None
+        异常占数据集的比例，None 时为0.05
+    """
+
+    def __init__(self, models, fraction=None):
+        self.models = models
+        self.fraction = 0.05 if fraction is None else fraction
+
+        train_scores = np.array([model.estimator.decision_scores_ for model in models])
+        self.score_means_ = train_scores.mean(axis=1)
+        stds = train_scores.std(axis=1)
+        self.score_stds_ = np.where(stds > 0, stds, 1.0)
+
+        ensemble_scores = self._combine(train_scores)
+        self.threshold_ = np.percentile(ensemble_scores, 100 * (1 - self.fraction)) if ensemble_scores.size else 0.0
+
+    def __repr__(self):
+        return f'NativeEnsemble(models={self.models!r}, fraction={self.fraction!r})'
+
+    def _combine(self, scores):
+        return ((scores - self.score_means_[:, np.newaxis]) / self.score_stds_[:, np.newaxis]).mean(axis=0)
+
+    def predict(self, nuc_data, batch_size=100000):
+        """
+        分批检测，返回带有各模型的 {model_type}_Anomaly_Score 列，
+        以及组合的 Anomaly 和 Anomaly_Score 列的结果
+
+        Parameters
+        ----------
+        nuc_data : pd.DataFrame
+        batch_size : int, default = 100000
+            每批的行数
+
+        Returns
+        -------
+        pd.DataFrame
+        """
+        scores = np.empty((len(self.models), len(nuc_data)))
+        for start in range(0, len(nuc_data), batch_size):
+            matrix = self.models[0]._transform(nuc_data.iloc[start:start + batch_size])
+            for i, model in enumerate(self.models):
+                scores[i, start:start + batch_size] = model.estimator.decision_function(matrix)
+
+        ensemble_scores = self._combine(scores)
+
+        result = nuc_data.copy()
+        for model, model_scores in zip(self.models, scores):
+            result[f'{model.model_type}_Anomaly_Score'] = model_scores
+        result['Anomaly'] = (ensemble_scores > self.threshold_).astype(int)
+        result['Anomaly_Score'] = ensemble_scores
+
+        return result
+
+
+_worker_matrix = None
+_worker_n_jobs = None
+
+
+def _init_worker(matrix, n_jobs):
+    global _worker_matrix, _worker_n_jobs
+    _worker_matrix = matrix
+    _worker_n_jobs = n_jobs
+
+
+def _fit_estimator_in_worker(model):
+    return model._fit_estimator(_worker_matrix, _worker_n_jobs)
+
+
+def fit_native_models(nuc_data, model_types, fraction=None, jobs=1, random_state=None):
+    """
+    只预处理一次，以同一个缩放后的矩阵训练多个 NativeModel
+
+    Parameters
+    ----------
+    nuc_data : pd.DataFrame
+    model_types : list[str]
+        参见 native_model_types
+    fraction : float or None, default = None
+    jobs : int, default = 1
+        并行训练的进程数，每个进程只接收一次矩阵，
+        jobs > 1 时每个模型(iforest, knn, lof)只使用 cpu 数 // jobs 个线程，避免超额占用
+    random_state : int or None, default = None
+
+    Returns
+    -------
+    list[NativeModel]
+        与 model_types 的顺序相同
+    """
+    models = [NativeModel(model_type, fraction, random_state) for model_type in model_types]
+    matrix = models[0]._fit_preprocessing(nuc_data)
+    for model in models[1:]:
+        model._copy_preprocessing(models[0])
+
+    jobs = min(jobs, len(models))
+    if jobs <= 1:
+        return [model._fit_estimator(matrix) for model in models]
+
+    n_jobs = max((os.cpu_count() or 1) // jobs, 1)
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_init_worker,
+                             initargs=(matrix, n_jobs)) as executor:
+        return list(executor.map(_fit_estimator_in_worker, models))
@@ -1,14 +1,18 @@
+import re
 from pathlib import Path
 
 import pandas as pd
-from pycaret.anomaly import setup, create_model, predict_model, load_model
 
+from nuc_data_tool.anomaly_detection.model_registry import model_registry, make_model_key
+from nuc_data_tool.anomaly_detection.native_model import (NativeModel, NativeEnsemble,
+                                                          native_model_types, fit_native_models)
+from nuc_data_tool.db.cache import feature_cache, make_feature_key
 from nuc_data_tool.db.db_model import File, PhysicalQuantity
 from nuc_data_tool.db.fetch_data import (fetch_files_by_name,
                                          fetch_physical_quantities_by_name,
                                          fetch_data_by_filename_and_physical_quantity)
 from nuc_data_tool.utils.formatter import type_checker
-from nuc_data_tool.utils.workbook import save_to_excel
+from nuc_data_tool.utils.workbook import save_to_excel, open_writer, remove_output
 
 
 def _complement_columns(nuc_data,
@@ -40,18 +44,27 @@ def _complement_columns(nuc_data,
 
 def train_model(nuc_data,
                 model_type,
-                fraction):
+                fraction,
+                seed=0):
     """
+    native_model_types 中的模型直接在特征矩阵上训练(NativeModel)，其他模型使用 pycaret 训练
 
     Parameters
     ----------
     nuc_data : pd.DataFrame
     model_type : str
     fraction : float
+    seed : int, default = 0
+        iforest, pca, mcd 等模型的随机种子，pycaret 的 session_id
     Returns
     -------
-
+    NativeModel or pycaret model
     """
+    if model_type in native_model_types:
+        return NativeModel(model_type, fraction, random_state=seed).fit(nuc_data)
+
+    from pycaret.anomaly import setup, create_model
+
     unnecessary_columns = ['nuc_ix', 'name']
     numeric_columns = [col for col in nuc_data.columns.tolist()
                        if col not in unnecessary_columns]
@@ -61,6 +74,7 @@ def train_model(nuc_data,
                     normalize_method='robust',
                     ignore_features=unnecessary_columns,
                     numeric_features=numeric_columns,
+                    session_id=seed,
                     silent=True)
 
     kargs = {}
@@ -72,12 +86,174 @@ def train_model(nuc_data,
     return model
 
 
+def _get_or_train_model(nuc_data,
+                        physical_quantity,
+                        is_all_step,
+                        model_type,
+                        fraction,
+                        is_retrained=False,
+                        seed=0):
+    """
+    从 model_registry 获取训练数据相同的模型，没有则训练并保存
+    pycaret 的模型依赖 setup 中的预处理，不保存，每次重新训练
+
+    Parameters
+    ----------
+    nuc_data : pd.DataFrame
+    physical_quantity : PhysicalQuantity
+    is_all_step : bool
+    model_type : str
+    fraction : float
+    is_retrained : bool, default = False
+        是否忽略已保存的模型，重新训练
+    seed : int, default = 0
+        随机种子
+
+    Returns
+    -------
+    NativeModel or pycaret model
+    """
+    if model_type not in native_model_types:
+        return train_model(nuc_data=nuc_data, model_type=model_type, fraction=fraction, seed=seed)
+
+    key = make_model_key(physical_quantity, is_all_step, model_type, fraction, nuc_data, seed)
+    model = None if is_retrained else model_registry.get(key)
+    if model is None:
+        model = train_model(nuc_data=nuc_data, model_type=model_type, fraction=fraction, seed=seed)
+        model_registry.put(key, model, num_of_rows=len(nuc_data))
+
+    return model
+
+
+def _get_or_train_ensemble(nuc_data,
+                           physical_quantity,
+                           is_all_step,
+                           model_types,
+                           fraction,
+                           is_retrained=False,
+                           jobs=1,
+                           seed=0):
+    """
+    组合多个 native 模型，model_registry 中没有的模型以同一个预处理后的矩阵并行训练并保存
+
+    Parameters
+    ----------
+    nuc_data : pd.DataFrame
+    physical_quantity : PhysicalQuantity
+    is_all_step : bool
+    model_types : list[str]
+    fraction : float
+    is_retrained : bool, default = False
+        是否忽略已保存的模型，重新训练
+    jobs : int, default = 1
+        并行训练的进程数
+    seed : int, default = 0
+        随机种子
+
+    Returns
+    -------
+    NativeEnsemble
+    """
+    unsupported_model_types = [model_type for model_type in model_types if model_type not in native_model_types]
+    if unsupported_model_types:
+        raise Exception(f"can't combine {unsupported_model_types}, only {native_model_types} can be combined")
+
+    keys = {model_type: make_model_key(physical_quantity, is_all_step, model_type, fraction, nuc_data, seed)
+            for model_type in model_types}
+
+    models = {}
+    if not is_retrained:
+        for model_type, key in keys.items():
+            model = model_registry.get(key)
+            if model is not None:
+                models[model_type] = model
+
+    missing_model_types = [model_type for model_type in model_types if model_type not in models]
+    if missing_model_types:
+        for model in fit_native_models(nuc_data, missing_model_types, fraction, jobs, seed):
+            models[model.model_type] = model
+            model_registry.put(keys[model.model_type], model, num_of_rows=len(nuc_data))
+
+    return NativeEnsemble([models[model_type] for model_type in model_types], fraction)
+
+
+def _predict(model, nuc_data):
+    """
+    检测，结果带有 Anomaly 和 Anomaly_Score 列
+
+    Parameters
+    ----------
+    model : NativeModel or NativeEnsemble or pycaret model
+    nuc_data : pd.DataFrame
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    if isinstance(model, (NativeModel, NativeEnsemble)):
+        return model.predict(nuc_data)
+
+    from pycaret.anomaly import predict_model
+
+    return predict_model(model, data=nuc_data)
+
+
+def _fetch_features(filenames,
+                    physical_quantity,
+                    is_all_step=False):
+    """
+    读取各文件同一物理量的数据，依照nuc_ix和name合并为float64的特征矩阵，
+    列名以文件名为前缀，例如 {文件名}_last_step
+    合并后的矩阵保存在 feature_cache 中，文件重新导入后失效
+
+    Parameters
+    ----------
+    filenames : list[File]
+    physical_quantity : PhysicalQuantity
+    is_all_step : bool, default = False
+        是否读取全部中间结果数据列，默认只读取最终结果列
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    cache_key = make_feature_key(filenames, physical_quantity, is_all_step)
+    nuc_data = feature_cache.get(cache_key)
+    if nuc_data is not None:
+        return nuc_data
+
+    file_features = []
+    for filename in filenames:
+        nuc_data_right = fetch_data_by_filename_and_physical_quantity(filename, physical_quantity, is_all_step)
+
+        if nuc_data_right.empty:
+            continue
+
+        nuc_data_right = nuc_data_right.set_index(['nuc_ix', 'name'])
+        nuc_data_right.columns = [f'{filename.name}_{col}' for col in nuc_data_right.columns.tolist()]
+        file_features.append(nuc_data_right.astype('float64', copy=False))
+
+    if file_features:
+        # 依照(nuc_ix, name)一次性对齐全部文件，与逐个 outer merge 的结果相同
+        nuc_data = pd.concat(file_features, axis=1, join='outer', copy=False).sort_index().reset_index()
+        nuc_data['nuc_ix'] = nuc_data['nuc_ix'].astype('int64')
+    else:
+        nuc_data = pd.DataFrame(columns=['nuc_ix', 'name'])
+
+    feature_cache.put(cache_key, nuc_data)
+
+    return nuc_data
+
+
 def prediction(filenames,
                physical_quantity='isotope',
                is_all_step=False,
                model_type='iforest',
                model=None,
-               fraction=0.01):
+               fraction=0.01,
+               is_retrained=False,
+               jobs=1,
+               seed=0):
     """
 
     Parameters
@@ -88,9 +264,16 @@ def prediction(filenames,
         默认为核素密度
     is_all_step : bool, default = False
         是否读取全部中间结果数据列，默认只读取最终结果列
-    model_type : str
+    model_type : str or list[str]
+        多个模型时组合各模型的异常分数，参见 NativeEnsemble
     model
     fraction : float
+    is_retrained : bool, default = False
+        是否忽略 model_registry 中训练数据相同的模型，重新训练
+    jobs : int, default = 1
+        多个模型时并行训练的进程数
+    seed : int, default = 0
+        随机种子，与 model_registry 中模型的 key 相关
 
     Returns
     -------
@@ -103,34 +286,64 @@ def prediction(filenames,
     if type_checker(physical_quantity, PhysicalQuantity) == 'str':
         physical_quantity = fetch_physical_quantities_by_name(physical_quantity).pop()
 
-    nuc_data_left = pd.DataFrame(columns=['nuc_ix', 'name'])
+    nuc_data_left = _fetch_features(filenames, physical_quantity, is_all_step)
+
+    if isinstance(model_type, (list, tuple)) and len(model_type) == 1:
+        model_type = model_type[0]
+
+    if isinstance(model_type, (list, tuple)):
+        model = _get_or_train_ensemble(nuc_data_left,
+                                       physical_quantity,
+                                       is_all_step,
+                                       model_type,
+                                       fraction,
+                                       is_retrained,
+                                       jobs,
+                                       seed)
+    elif model_type is not None:
+        model = _get_or_train_model(nuc_data_left,
+                                    physical_quantity,
+                                    is_all_step,
+                                    model_type,
+                                    fraction,
+                                    is_retrained,
+                                    seed)
+
+    result_prediction = _predict(model, nuc_data_left)
 
-    for filename in filenames:
-        nuc_data_right = fetch_data_by_filename_and_physical_quantity(filename, physical_quantity, is_all_step)
+    return result_prediction[result_prediction['Anomaly'] == 1].drop(columns='Anomaly')
 
-        if nuc_data_right.empty:
-            continue
 
-        nuc_data_right.rename(columns={'first_step': f'{filename.name}_first_step',
-                                       'last_step': f'{filename.name}_last_step'},
-                              inplace=True)
-        columns = {col: f'{filename.name}_{col}'
-                   for col in nuc_data_right.columns.tolist()
-                   if 'middle_step' in col}
-        nuc_data_right.rename(columns=columns, inplace=True)
+def _split_prediction_by_file(df_result, filename):
+    """
+    从全部文件的检测结果中选出某一文件的列，以及该文件有数据的异常行
 
-        numeric_columns = [col for col in nuc_data_right.columns.tolist()
-                           if col not in ['nuc_ix', 'name']]
-        nuc_data_right[numeric_columns] = nuc_data_right[numeric_columns].astype('float64', copy=False)
+    Parameters
+    ----------
+    df_result : pd.DataFrame
+        prediction 的结果
+    filename : File
 
-        nuc_data_left = pd.merge(nuc_data_left, nuc_data_right, how='outer', on=['nuc_ix', 'name'])
+    Returns
+    -------
+    pd.DataFrame
+        列为 nuc_ix, name, 该文件的数据列和 {文件名}_Anomaly_Score，
+        组合多个模型时还有各模型的 {文件名}_{模型}_Anomaly_Score
+    """
+    pattern = re.compile(rf'{re.escape(filename.name)}_(first_step|last_step|middle_step_\d+)')
+    data_columns = [column for column in df_result.columns.tolist()
+                    if pattern.fullmatch(column)]
+    score_columns = [column for column in df_result.columns.tolist()
+                     if column.endswith('Anomaly_Score') and column not in data_columns]
 
-    if model_type is not None:
-        model = train_model(nuc_data=nuc_data_left, model_type=model_type, fraction=fraction)
+    df_file = df_result.loc[:, ['nuc_ix', 'name', *data_columns, *score_columns]]
+    df_file = df_file.dropna(subset=data_columns, how='all')
+    df_file = df_file.rename(columns={column: f'{filename.name}_{column}' for column in score_columns})
 
-    result_prediction = predict_model(model, data=nuc_data_left)
+    if df_file.empty:
+        return df_file.loc[:, ['nuc_ix', 'name']]
 
-    return result_prediction[result_prediction['Anomaly'] == 1].drop(columns='Anomaly')
+    return df_file.dropna(axis=1, how='all')
 
 
 def save_prediction_to_exel(filenames,
@@ -140,7 +353,11 @@ def save_prediction_to_exel(filenames,
                             merge=True,
                             model_type=None,
                             model_name=None,
-                            fraction=0.001):
+                            fraction=0.001,
+                            output_format='xlsx',
+                            is_retrained=False,
+                            jobs=1,
+                            seed=0):
     """
 
     Parameters
@@ -154,9 +371,18 @@ def save_prediction_to_exel(filenames,
     result_path : Path or str
     merge : bool, default = True
         是否将结果合并输出至一个文件，否则单独输出至每个文件
-    model_type : str
+    model_type : str or list[str]
+        多个模型时输出各模型的异常分数和组合的异常分数，参见 NativeEnsemble
     model_name : str
     fraction
+    output_format : str, default = 'xlsx'
+        输出格式，xlsx，csv，parquet，feather 或 hdf5，参见 open_writer
+    is_retrained : bool, default = False
+        是否忽略已保存的模型，重新训练
+    jobs : int, default = 1
+        组合多个模型时并行训练的进程数
+    seed : int, default = 0
+        iforest, pca, mcd 等模型的随机种子，相同的种子和训练数据得到相同的结果
     Returns
     -------
 
@@ -169,13 +395,20 @@ def save_prediction_to_exel(filenames,
         physical_quantities = fetch_physical_quantities_by_name(physical_quantities)
 
     if model_type is None:
+        from pycaret.anomaly import load_model
+
         model = load_model(model_name)
     else:
         model = None
 
     result_path = Path(result_path).joinpath('anomaly_detection_result')
 
-    prefix = model_type
+    if isinstance(model_type, (list, tuple)):
+        # 重复的模型只训练一次
+        model_type = list(dict.fromkeys(model_type))
+        prefix = '_'.join(model_type)
+    else:
+        prefix = model_type
 
     file_name = 'final.xlsx'
 
@@ -185,56 +418,50 @@ def save_prediction_to_exel(filenames,
     file_name = f'{prefix}_{file_name}'
 
     if merge:
-        Path(result_path).joinpath(file_name).unlink(missing_ok=True)
-    else:
-        for filename in filenames:
-            if is_all_step:
-                Path(result_path).joinpath(f'{prefix}_all_steps_{filename.name}.xlsx').unlink(missing_ok=True)
-            else:
-                Path(result_path).joinpath(f'{prefix}_{filename.name}.xlsx').unlink(missing_ok=True)
-        del filename
-
+        remove_output(Path(result_path).joinpath(file_name), output_format)
+        # 全部物理量写入同一个工作簿，只打开和保存一次
+        with open_writer(Path(result_path).joinpath(file_name), output_format) as writer:
+            for physical_quantity in physical_quantities:
+                df_result = prediction(filenames=filenames,
+                                       physical_quantity=physical_quantity,
+                                       is_all_step=is_all_step,
+                                       model_type=model_type,
+                                       model=model,
+                                       fraction=fraction,
+                                       is_retrained=is_retrained,
+                                       jobs=jobs,
+                                       seed=seed)
+
+                df_result.dropna(axis=1, how='all', inplace=True)
+                writer.write(physical_quantity.name, df_result)
+        return
+
+    # 每个物理量只读取和检测一次，再将结果依照文件拆分至各自的工作簿
+    dict_df_files = {filename.name: {} for filename in filenames}
     for physical_quantity in physical_quantities:
+        df_result = prediction(filenames=filenames,
+                               physical_quantity=physical_quantity,
+                               is_all_step=is_all_step,
+                               model_type=model_type,
+                               model=model,
+                               fraction=fraction,
+                               is_retrained=is_retrained,
+                               jobs=jobs,
+                               seed=seed)
 
-        if merge:
-            df_result = prediction(filenames=filenames,
-                                   physical_quantity=physical_quantity,
-                                   is_all_step=is_all_step,
-                                   model_type=model_type,
-                                   model=model,
-                                   fraction=fraction)
-
-            df_result.dropna(axis=1, how='all', inplace=True)
-            save_to_excel({physical_quantity.name: df_result},
-                          file_name,
-                          result_path)
-        else:
-            df_left = pd.DataFrame(data=None, columns=['nuc_ix', 'name'])
-
-            for filename in filenames:
-
-                files_name = f'{prefix}_{filename.name}.xlsx'
-                if is_all_step:
-                    files_name = f'{prefix}_all_steps_{filename.name}.xlsx'
-
-                df_right = prediction(filenames=filenames,
-                                      physical_quantity=physical_quantity,
-                                      is_all_step=is_all_step,
-                                      model_type=model_type,
-                                      model=model,
-                                      fraction=fraction)
-
-                if not df_right.empty:
-                    df_right.rename(columns={'Anomaly_Score': f'{filename.name}_Anomaly_Score'},
-                                    inplace=True)
-
-                    df_right.dropna(axis=1, how='all', inplace=True)
-                    df_left = pd.merge(df_left, df_right, how='outer', on=['nuc_ix', 'name'])
-
-                save_to_excel({physical_quantity.name: df_left},
-                              files_name,
-                              result_path)
-                df_left = pd.DataFrame(data=None, columns=['nuc_ix', 'name'])
+        for filename in filenames:
+            dict_df_files[filename.name][physical_quantity.name] = _split_prediction_by_file(df_result, filename)
+
+    for filename in filenames:
+        files_name = f'{prefix}_{filename.name}.xlsx'
+        if is_all_step:
+            files_name = f'{prefix}_all_steps_{filename.name}.xlsx'
+
+        remove_output(Path(result_path).joinpath(files_name), output_format)
+        save_to_excel(dict_df_files[filename.name],
+                      files_name,
+                      result_path,
+                      output_format)
 
 
 # def main():
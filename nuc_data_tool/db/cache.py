@@ -0,0 +1,365 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from nuc_data_tool.db.base import engine
+from nuc_data_tool.utils.configlib import config
+
+
+def database_identity():
+    """
+    当前数据库(engine url)的摘要，用于区分不同数据库中 id 和 generation 相同的文件
+
+    Returns
+    -------
+    str
+    """
+    return hashlib.sha1(str(engine.url).encode()).hexdigest()
+
+
+def make_key(kind, file, physical_quantity, nuclide_key=None, is_all_step=False):
+    """
+    生成缓存的key
+    key 中包含文件的数据版本号(generation)，文件重新导入后旧的缓存自然失效，
+    以及数据库的标识，切换 chosen_db 后持久化的缓存不会混用
+
+    Parameters
+    ----------
+    kind : str
+        查询种类，一般为 fetch function 名
+    file : File
+        File object
+    physical_quantity : PhysicalQuantity
+        PhysicalQuantity object
+    nuclide_key : tuple or str or None
+        核素列表或者 nuc_data_id 的摘要
+    is_all_step : bool, default = False
+
+    Returns
+    -------
+    tuple
+    """
+    return (kind, file.id, file.generation, physical_quantity.id, nuclide_key, bool(is_all_step),
+            database_identity())
+
+
+def make_feature_key(filenames, physical_quantity, is_all_step=False):
+    """
+    生成特征矩阵缓存的key，包含数据库的标识和各文件的数据版本号(generation)
+    切换 chosen_db 后，不同数据库中 id 和 generation 相同的文件不会共用缓存
+
+    Parameters
+    ----------
+    filenames : list[File]
+    physical_quantity : PhysicalQuantity
+    is_all_step : bool, default = False
+
+    Returns
+    -------
+    tuple
+    """
+    return (database_identity(),
+            tuple((filename.id, filename.generation) for filename in filenames),
+            physical_quantity.id,
+            bool(is_all_step))
+
+
+def digest(values):
+    """
+    生成 list 的摘要，用于将较长的 nuc_data_id 压缩为 key 的一部分
+
+    Parameters
+    ----------
+    values : list or None
+
+    Returns
+    -------
+    str or None
+    """
+    if values is None:
+        return None
+    return hashlib.sha1(','.join(map(str, values)).encode()).hexdigest()
+
+
+class QueryCache:
+    """
+    查询结果(DataFrame)的LRU缓存，可选持久化至磁盘
+
+    key 为 (kind, file id, generation, physical quantity id, nuclide key, is_all_step, 数据库的标识)，
+    参见 make_key
+
+    Attributes
+    ----------
+    enabled : bool
+    max_size : int
+        内存中缓存总大小的上限，单位为 byte，超过则依照LRU剔除
+    persist : bool
+        是否持久化至磁盘
+    path : Path
+        持久化路径
+    """
+
+    def __init__(self, max_size_mb=512, persist=False, path='./cache', enabled=True):
+        self.enabled = enabled
+        self.max_size = int(max_size_mb * 1024 ** 2)
+        self.persist = persist
+        self.path = Path(path)
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _disk_path(self, key):
+        # 以 file id 为前缀，便于依照文件删除
+        return self.path.joinpath(f'{key[1]}_{digest(key)}.pkl')
+
+    def get(self, key):
+        """
+        获取缓存，不存在则返回None
+        返回的是副本，调用方可以随意修改
+
+        Parameters
+        ----------
+        key : tuple
+
+        Returns
+        -------
+        pd.DataFrame or None
+        """
+        if not self.enabled:
+            return None
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key][0].copy()
+
+        if self.persist:
+            disk_path = self._disk_path(key)
+            if disk_path.is_file():
+                df = pd.read_pickle(disk_path)
+                # 以修改时间记录最近使用的时间，磁盘上的缓存依照LRU剔除
+                disk_path.touch()
+                self._store(key, df)
+                return df.copy()
+
+        return None
+
+    def put(self, key, df):
+        """
+        存入缓存
+
+        Parameters
+        ----------
+        key : tuple
+        df : pd.DataFrame
+
+        Returns
+        -------
+
+        """
+        if not self.enabled:
+            return
+
+        df = df.copy()
+        self._store(key, df)
+
+        if self.persist:
+            self.path.mkdir(parents=True, exist_ok=True)
+            df.to_pickle(self._disk_path(key))
+            self._evict_disk()
+
+    def _store(self, key, df):
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        if size > self.max_size:
+            # 单个结果大于上限则不缓存
+            return
+
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[1]
+
+        self._entries[key] = (df, size)
+        self._size += size
+
+        while self._size > self.max_size:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._size -= evicted_size
+
+    def _evict_disk(self):
+        # 磁盘上的缓存同样依照大小上限剔除，最久未使用(修改时间)的优先
+        disk_files = sorted(self.path.glob('*.pkl'), key=lambda p: p.stat().st_mtime)
+        total_size = sum(p.stat().st_size for p in disk_files)
+        while disk_files and total_size > self.max_size:
+            oldest = disk_files.pop(0)
+            total_size -= oldest.stat().st_size
+            oldest.unlink(missing_ok=True)
+
+    def invalidate_file(self, file_id):
+        """
+        删除某文件的全部缓存
+
+        Parameters
+        ----------
+        file_id : int
+
+        Returns
+        -------
+
+        """
+        for key in [key for key in self._entries if key[1] == file_id]:
+            self._size -= self._entries.pop(key)[1]
+
+        if self.persist and self.path.is_dir():
+            for disk_path in self.path.glob(f'{file_id}_*.pkl'):
+                disk_path.unlink(missing_ok=True)
+
+    def clear(self):
+        """
+        清空缓存，包括磁盘上的缓存
+
+        Returns
+        -------
+
+        """
+        self._entries.clear()
+        self._size = 0
+
+        if self.persist and self.path.is_dir():
+            for disk_path in self.path.glob('*.pkl'):
+                disk_path.unlink(missing_ok=True)
+
+
+class FeatureCache:
+    """
+    异常检测特征矩阵的磁盘缓存，参见 make_feature_key
+
+    每个矩阵保存为 {path}/{key 的摘要}.npz，包含 nuc_ix, names, columns 和float64的 data，
+    以及所用文件的 file_ids，文件重新导入时由 invalidate_file 删除，
+    超过 max_entries 个时剔除最久未使用的
+
+    Attributes
+    ----------
+    enabled : bool
+    path : Path
+    max_entries : int
+    """
+
+    def __init__(self, path='./cache/features', max_entries=64, enabled=True):
+        self.enabled = enabled
+        self.path = Path(path)
+        self.max_entries = int(max_entries)
+
+    def _disk_path(self, key):
+        return self.path.joinpath(f'{digest(key)}.npz')
+
+    def get(self, key):
+        """
+        获取特征矩阵，不存在则返回None
+
+        Parameters
+        ----------
+        key : tuple
+
+        Returns
+        -------
+        pd.DataFrame or None
+            columns 为 nuc_ix, name 和各文件的数据列
+        """
+        if not self.enabled:
+            return None
+
+        disk_path = self._disk_path(key)
+        if not disk_path.is_file():
+            return None
+
+        with np.load(disk_path) as npz_file:
+            df = pd.DataFrame(npz_file['data'], columns=npz_file['columns'].tolist())
+            df.insert(0, 'name', npz_file['names'].astype(object))
+            df.insert(0, 'nuc_ix', npz_file['nuc_ix'])
+
+        # 以修改时间记录最近使用的时间
+        disk_path.touch()
+        return df
+
+    def put(self, key, df):
+        """
+        存入缓存
+
+        Parameters
+        ----------
+        key : tuple
+        df : pd.DataFrame
+            columns 为 nuc_ix, name 和float64的数据列
+
+        Returns
+        -------
+
+        """
+        if not self.enabled:
+            return
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        data_columns = [column for column in df.columns.tolist() if column not in ('nuc_ix', 'name')]
+
+        # 先写入临时文件再替换，多个进程同时写入时不会读到不完整的文件
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f,
+                                file_ids=np.array([file_id for file_id, _ in key[1]], dtype=np.int64),
+                                nuc_ix=df['nuc_ix'].to_numpy(dtype=np.int64),
+                                names=df['name'].to_numpy(dtype=str),
+                                columns=np.array(data_columns, dtype=str),
+                                data=df[data_columns].to_numpy(dtype=np.float64))
+        os.replace(tmp_path, self._disk_path(key))
+
+        disk_paths = sorted(self.path.glob('*.npz'), key=lambda p: p.stat().st_mtime)
+        for disk_path in disk_paths[:max(len(disk_paths) - self.max_entries, 0)]:
+            disk_path.unlink(missing_ok=True)
+
+    def invalidate_file(self, file_id):
+        """
+        删除包含某文件的全部特征矩阵
+
+        Parameters
+        ----------
+        file_id : int
+
+        Returns
+        -------
+
+        """
+        if not self.path.is_dir():
+            return
+
+        for disk_path in self.path.glob('*.npz'):
+            with np.load(disk_path) as npz_file:
+                is_stale = file_id in npz_file['file_ids']
+            if is_stale:
+                disk_path.unlink(missing_ok=True)
+
+    def clear(self):
+        """
+        删除全部特征矩阵
+
+        Returns
+        -------
+
+        """
+        if self.path.is_dir():
+            for disk_path in self.path.glob('*.npz'):
+                disk_path.unlink(missing_ok=True)
+
+
+query_cache = QueryCache(max_size_mb=config.get_cache_config('max_size_mb', 512),
+                         persist=config.get_cache_config('persist', False),
+                         path=config.get_cache_config('path', './cache'),
+                         enabled=config.get_cache_config('enabled', True))
+
+feature_cache = FeatureCache(path=config.get_cache_config('features_path', './cache/features'),
+                             max_entries=config.get_cache_config('features_max_entries', 64),
+                             enabled=config.get_cache_config('features_enabled', True))
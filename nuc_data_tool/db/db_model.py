@@ -1,11 +1,11 @@
 """
 Database model
 
-       ┌───────┐
-       │       │
-       │  nuc  │
-       │       │
-       └───────┘
+       ┌───────┐many     many┌───────────────┐
+       │       │◄────────────┤               │
+       │  nuc  │             │  nuclide_set  │
+       │       │             │               │
+       └───────┘             └───────────────┘
            ▲ one
            │
            │
@@ -25,9 +25,12 @@ Database model
 │                     │  many
 └─────────────────────┘
 
+comparison_result 依据 file id 和 physical_quantity id 保存 compare 的结果
+
 """
 
-from sqlalchemy import Column, Integer, Numeric, String, LargeBinary, Interval, Boolean, ForeignKey, Table
+from sqlalchemy import (Column, Integer, Numeric, String, LargeBinary, Interval, Boolean, ForeignKey, Table,
+                        UniqueConstraint)
 from sqlalchemy.orm import relationship
 
 from nuc_data_tool.db.base import Base
@@ -38,14 +41,38 @@ file_physical_quantity_association = Table('file_physical_quantity_association',
                                                      ForeignKey('physical_quantity.id'), nullable=False)
                                               )
 
+nuclide_set_association = Table('nuclide_set_association', Base.metadata,
+                                Column('nuclide_set_id', Integer, ForeignKey('nuclide_set.id'),
+                                       nullable=False, index=True),
+                                Column('nuc_id', Integer, ForeignKey('nuc.id'), nullable=False)
+                                )
+
 
 class Nuc(Base):
     __tablename__ = 'nuc'
     id = Column(Integer, primary_key=True)
     nuc_ix = Column(Integer, unique=True, autoincrement=True, nullable=False)
-    name = Column(String(32), nullable=False)
+    name = Column(String(32), nullable=False, index=True)
 
     data = relationship('NucData', back_populates='nuc')
+    nuclide_sets = relationship('NuclideSet',
+                                secondary=nuclide_set_association,
+                                back_populates='nuclides')
+
+
+class NuclideSet(Base):
+    """
+    命名的核素列表，由配置文件 nuclide_list 项同步而来
+    digest 为同步时配置文件中核素列表的摘要，与当前配置文件不一致时该副本已过期
+    """
+    __tablename__ = 'nuclide_set'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(32), unique=True, nullable=False)
+    digest = Column(String(40))
+
+    nuclides = relationship('Nuc',
+                            secondary=nuclide_set_association,
+                            back_populates='nuclide_sets')
 
 
 class NucData(Base):
@@ -70,6 +97,8 @@ class File(Base):
     time_interval = Column(Interval)
     repeat_times = Column(Integer)
     is_all_step = Column(Boolean)
+    # 数据版本号，每次导入(populate_database)递增，用于缓存失效
+    generation = Column(Integer, nullable=False, default=0, server_default='0')
 
     data = relationship('NucData', back_populates='file')
     physical_quantities = relationship('PhysicalQuantity',
@@ -85,3 +114,28 @@ class PhysicalQuantity(Base):
     data = relationship('NucData', back_populates='physical_quantity')
     files = relationship('File', secondary=file_physical_quantity_association,
                          back_populates='physical_quantities')
+
+
+class ComparisonResult(Base):
+    """
+    compare 的计算结果，reference_generation 和 comparison_generation 与文件当前的数据版本号一致时可以复用
+    result 为 dict[工作表名, DataFrame] 以 result_format 格式序列化的结果(参见 db_utils.dump_frames)，
+    为空表示任意一方没有该物理量的数据，result_format 与当前格式不同的结果不会被读取
+    """
+    __tablename__ = 'comparison_result'
+    __table_args__ = (UniqueConstraint('reference_file_id', 'comparison_file_id', 'physical_quantity_id',
+                                       'deviation_mode', 'threshold', 'is_all_step', 'is_high_precision',
+                                       'nuclide_key'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    reference_file_id = Column(Integer, ForeignKey('file.id'), nullable=False)
+    comparison_file_id = Column(Integer, ForeignKey('file.id'), nullable=False)
+    physical_quantity_id = Column(Integer, ForeignKey('physical_quantity.id'), nullable=False)
+    deviation_mode = Column(String(16), nullable=False)
+    threshold = Column(String(32), nullable=False)
+    is_all_step = Column(Boolean, nullable=False)
+    is_high_precision = Column(Boolean, nullable=False)
+    nuclide_key = Column(String(128), nullable=False)
+    reference_generation = Column(Integer, nullable=False)
+    comparison_generation = Column(Integer, nullable=False)
+    result_format = Column(String(16))
+    result = Column(LargeBinary(2 ** 32 - 1))
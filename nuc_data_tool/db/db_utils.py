@@ -1,8 +1,16 @@
-from sqlalchemy import insert, delete
+import json
+import numbers
+import zlib
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import insert, delete, inspect, text
 from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.dialects.postgresql import insert as postgres_insert
 
 from nuc_data_tool.db.base import Session, Base
+from nuc_data_tool.db.cache import query_cache, feature_cache
 
 
 def init_db():
@@ -17,6 +25,147 @@ def init_db():
         Base.metadata.drop_all(session.bind)
         Base.metadata.create_all(session.bind)
 
+    # 数据库重建后 file id 和 generation 会重复，所以清空缓存
+    query_cache.clear()
+    feature_cache.clear()
+
+
+# 旧版本数据库的表中缺少的列及其添加语句，create_all 不会为已存在的表添加列
+_missing_column_migrations = {
+    ('file', 'generation'): 'ALTER TABLE file ADD COLUMN generation INTEGER NOT NULL DEFAULT 0',
+    ('nuclide_set', 'digest'): 'ALTER TABLE nuclide_set ADD COLUMN digest VARCHAR(40)',
+    ('comparison_result', 'result_format'): 'ALTER TABLE comparison_result ADD COLUMN result_format VARCHAR(16)',
+}
+
+# dump_frames 的格式，改变序列化方式时需要修改，旧格式的结果会被重新计算
+FRAMES_FORMAT = 'json-zlib-1'
+
+
+def create_missing_tables():
+    """
+    创建数据库中不存在的表，并为旧版本数据库中已存在的表添加缺少的列和索引(例如 nuc.name)，已存在的数据不受影响
+
+    Returns
+    -------
+
+    """
+    with Session() as session:
+        Base.metadata.create_all(session.bind)
+
+        inspector = inspect(session.connection())
+        for (table_name, column_name), statement in _missing_column_migrations.items():
+            column_names = [column['name'] for column in inspector.get_columns(table_name)]
+            if column_name not in column_names:
+                session.execute(text(statement))
+
+        # create_all 同样不会为已存在的表创建索引，相当于 CREATE INDEX IF NOT EXISTS
+        for table in Base.metadata.sorted_tables:
+            index_names = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in index_names:
+                    index.create(session.connection())
+
+        session.commit()
+
+
+def _encode_value(value):
+    """
+    object 列和索引中的值，Decimal 标注类型，以便原样还原
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, Decimal):
+        return {'decimal': str(value)}
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    raise Exception(f"can't serialize {type(value).__name__} value {value!r}")
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return Decimal(value['decimal'])
+    return value
+
+
+def _encode_frame(df):
+    if isinstance(df.index, pd.RangeIndex):
+        index = {'range': [df.index.start, df.index.stop, df.index.step]}
+    else:
+        index = {'values': [_encode_value(value) for value in df.index], 'dtype': str(df.index.dtype)}
+    index['name'] = df.index.name
+
+    data = []
+    for i, dtype in enumerate(df.dtypes):
+        column = df.iloc[:, i]
+        if dtype.kind in 'fiub':
+            data.append(column.tolist())
+        elif dtype.kind == 'O':
+            data.append([_encode_value(value) for value in column])
+        else:
+            raise Exception(f"can't serialize {dtype} column {df.columns[i]}")
+
+    return {'columns': [_encode_value(column) for column in df.columns],
+            'columns_dtype': str(df.columns.dtype),
+            'dtypes': [str(dtype) for dtype in df.dtypes],
+            'index': index,
+            'data': data}
+
+
+def _decode_frame(frame):
+    index = frame['index']
+    if 'range' in index:
+        index_values = pd.RangeIndex(*index['range'], name=index['name'])
+    else:
+        index_values = pd.Index([_decode_value(value) for value in index['values']],
+                                dtype=index['dtype'], name=index['name'])
+
+    columns = {i: pd.Series([_decode_value(value) for value in values] if dtype == 'object' else values,
+                            index=index_values,
+                            dtype=dtype)
+               for i, (dtype, values) in enumerate(zip(frame['dtypes'], frame['data']))}
+
+    df = pd.DataFrame(columns, index=index_values)
+    df.columns = pd.Index([_decode_value(column) for column in frame['columns']], dtype=frame['columns_dtype'])
+    return df
+
+
+def dump_frames(dict_df):
+    """
+    将 dict[str, pd.DataFrame] 序列化为 FRAMES_FORMAT 格式(zlib 压缩的json)，
+    不使用 pickle，读取时不会执行任何代码，也不依赖 pandas 的版本
+    支持数值，字符串和 Decimal(原样保存)
+
+    Parameters
+    ----------
+    dict_df : dict[str, pd.DataFrame]
+
+    Returns
+    -------
+    bytes
+    """
+    frames = {name: _encode_frame(df) for name, df in dict_df.items()}
+    return zlib.compress(json.dumps(frames).encode())
+
+
+def load_frames(data):
+    """
+    反序列化 dump_frames 的结果
+
+    Parameters
+    ----------
+    data : bytes
+
+    Returns
+    -------
+    dict[str, pd.DataFrame]
+    """
+    frames = json.loads(zlib.decompress(data).decode())
+    return {name: _decode_frame(frame) for name, frame in frames.items()}
+
 
 def delete_all_from_table(model):
     """
@@ -1,10 +1,17 @@
+from datetime import timedelta
+
+import numpy as np
 import pandas as pd
-from sqlalchemy import select, lambda_stmt, or_
+from sqlalchemy import select, lambda_stmt, or_, type_coerce, Float, func
 
 from nuc_data_tool.db.base import Session
-from nuc_data_tool.db.db_model import File, NucData, Nuc, PhysicalQuantity
+from nuc_data_tool.db.cache import query_cache, make_key, digest
+from nuc_data_tool.db.db_model import (File, NucData, Nuc, PhysicalQuantity, NuclideSet, ComparisonResult,
+                                       nuclide_set_association)
+from nuc_data_tool.db.db_utils import load_frames, FRAMES_FORMAT
+from nuc_data_tool.utils.configlib import config
 from nuc_data_tool.utils.formatter import physical_quantity_list_generator, type_checker
-from nuc_data_tool.utils.middle_steps import middle_steps_line_parsing
+from nuc_data_tool.utils.middle_steps import middle_steps_line_parsing, middle_steps_line_parsing_to_array
 
 
 def fetch_files_by_name(filenames='all'):
@@ -127,6 +134,11 @@ def fetch_data_by_filename_and_physical_quantity(filename, physical_quantity, is
     if type_checker(physical_quantity, PhysicalQuantity) == 'str':
         physical_quantity = fetch_physical_quantities_by_name(physical_quantity).pop()
 
+    cache_key = make_key('data', filename, physical_quantity, is_all_step=is_all_step)
+    df_cached = query_cache.get(cache_key)
+    if df_cached is not None:
+        return df_cached
+
     df_left = pd.DataFrame(data=None, columns=['nuc_ix', 'name'])
 
     file_id = filename.id
@@ -169,6 +181,8 @@ def fetch_data_by_filename_and_physical_quantity(filename, physical_quantity, is
 
     df_left.sort_values(by=['nuc_ix'], inplace=True)
 
+    query_cache.put(cache_key, df_left)
+
     return df_left
 
 
@@ -202,6 +216,14 @@ def fetch_data_by_filename_and_nuclide_list(filename, physical_quantities, nucli
     with Session() as session:
         physical_quantity: PhysicalQuantity
         for physical_quantity in physical_quantities:
+            cache_key = make_key('nuclide_list', filename, physical_quantity,
+                                 tuple(nuclide_list) if isinstance(nuclide_list, list) else nuclide_list,
+                                 is_all_step)
+            nuc_data = query_cache.get(cache_key)
+            if nuc_data is not None:
+                dict_df_data[physical_quantity.name] = nuc_data
+                continue
+
             file_id = filename.id
             physical_quantity_id = physical_quantity.id
 
@@ -244,14 +266,53 @@ def fetch_data_by_filename_and_nuclide_list(filename, physical_quantities, nucli
                                      axis=1, copy=False)
 
             nuc_data.sort_values(by=['nuc_ix'], inplace=True)
+            query_cache.put(cache_key, nuc_data)
             dict_df_data[physical_quantity.name] = nuc_data
 
     return dict_df_data
 
 
+def _nuclide_id_subquery(nuclide_list):
+    """
+    生成核素列表对应 nuc.id 的子查询
+    nuclide_list 为核素列表名时，优先使用数据库中同步的 nuclide_set，
+    不存在则读取配置文件中的核素列表
+
+    Parameters
+    ----------
+    nuclide_list : list[str] or str
+        核素列表或者核素列表名
+
+    Returns
+    -------
+    Select
+    """
+    if isinstance(nuclide_list, str):
+        nuclides = config.get_nuclide_list(nuclide_list)
+
+        nuclide_set_stmt = (select(NuclideSet.id, NuclideSet.digest).
+                            where(NuclideSet.name == nuclide_list))
+        with Session() as session:
+            nuclide_set = session.execute(nuclide_set_stmt).one_or_none()
+
+        # 修改配置文件后没有重新 pop 时，数据库中的副本已过期，直接依照配置文件中的核素名过滤
+        is_synced = nuclide_set is not None and (not isinstance(nuclides, list)
+                                                 or nuclide_set.digest == digest(sorted(nuclides)))
+        if is_synced:
+            return (select(nuclide_set_association.c.nuc_id).
+                    where(nuclide_set_association.c.nuclide_set_id == nuclide_set.id))
+
+        if not isinstance(nuclides, list):
+            raise Exception(f"{nuclide_list} isn't a nuclide list")
+        nuclide_list = nuclides
+
+    return select(Nuc.id).where(Nuc.name.in_(nuclide_list))
+
+
 def fetch_extracted_data_id(filenames=None, physical_quantities='all', nuclide_list=None):
     """
     获取extracted_data的id
+    全部文件共用一次查询，核素列表被解析为 nuc.id 后以整数过滤
 
     Parameters
     ----------
@@ -260,8 +321,9 @@ def fetch_extracted_data_id(filenames=None, physical_quantities='all', nuclide_l
     physical_quantities : list[str or PhysicalQuantity] or str or PhysicalQuantity
         物理量，可以是物理量名的list[str]或str，
         也可以是list[PhysicalQuantity]或PhysicalQuantity
-    nuclide_list : list[str]
-        核素list
+    nuclide_list : list[str] or str, optional
+        核素list，或者核素列表名(参见配置文件 nuclide_list 项)，
+        为None则过滤first_step和last_step皆为0的records，为'all'则不过滤
 
     Returns
     -------
@@ -277,49 +339,155 @@ def fetch_extracted_data_id(filenames=None, physical_quantities='all', nuclide_l
     if type_checker(physical_quantities, PhysicalQuantity) == 'str':
         physical_quantities = fetch_physical_quantities_by_name(physical_quantities)
 
-    nuc_data_id = []
+    files_id = [filename.id for filename in filenames]
+    physical_quantities_id = [physical_quantity.id
+                              for physical_quantity in physical_quantities]
 
-    with Session() as session:
-        for filename in filenames:
-            physical_quantities_id = [physical_quantity.id
-                                      for physical_quantity in physical_quantities]
-            file_id = filename.id
+    stmt = (select(NucData.id).
+            where(NucData.file_id.in_(files_id),
+                  NucData.physical_quantity_id.in_(physical_quantities_id)).
+            order_by(NucData.id)
+            )
 
-            if nuclide_list is None:
-                # 核素列表为空则过滤first_step和last_step皆为0的records
-                stmt = (select(NucData.id).
-                        where(NucData.file_id == file_id,
-                              NucData.physical_quantity_id.in_(physical_quantities_id)).
-                        where(or_(NucData.first_step != 0, NucData.last_step != 0))
-                        )
-            elif nuclide_list == 'all':
-                stmt = (select(NucData.id).
-                        where(NucData.file_id == file_id,
-                              NucData.physical_quantity_id.in_(physical_quantities_id)))
-            else:
-                # 核素不为gamma时，依照核素列表过滤records，否则反之
-                for physical_quantity in physical_quantities:
-                    if physical_quantity.name == 'gamma_spectra':
-                        gamma_physical_quantity_id = physical_quantity.id
-
-                        gamma_stmt = (select(NucData.id).
-                                      where(NucData.file_id == file_id,
-                                            NucData.physical_quantity_id == gamma_physical_quantity_id)
-                                      )
-                        nuc_data_id.extend(session.execute(gamma_stmt).scalars().all())
-
-                stmt = (select(NucData.id).
-                        join(Nuc, Nuc.id == NucData.nuc_id).
-                        where(NucData.file_id == file_id,
-                              NucData.physical_quantity_id.in_(physical_quantities_id)).
-                        where(Nuc.name.in_(nuclide_list))
-                        )
-
-            nuc_data_id.extend(session.execute(stmt).scalars().all())
+    if nuclide_list is None:
+        # 核素列表为空则过滤first_step和last_step皆为0的records
+        stmt = stmt.where(or_(NucData.first_step != 0, NucData.last_step != 0))
+    elif nuclide_list == 'all':
+        pass
+    else:
+        # 核素不为gamma时，依照核素列表过滤records，否则反之
+        gamma_physical_quantities_id = [physical_quantity.id
+                                        for physical_quantity in physical_quantities
+                                        if physical_quantity.name == 'gamma_spectra']
+        stmt = stmt.where(or_(NucData.physical_quantity_id.in_(gamma_physical_quantities_id),
+                              NucData.nuc_id.in_(_nuclide_id_subquery(nuclide_list))))
+
+    with Session() as session:
+        nuc_data_id = session.execute(stmt).scalars().all()
 
     return nuc_data_id
 
 
+def nuclide_list_key(nuclide_list):
+    """
+    生成核素列表的key，用于标识 fetch_extracted_data_id 的筛选条件
+    配置文件中的核素列表会包含其内容的摘要，修改列表后key随之改变
+
+    Parameters
+    ----------
+    nuclide_list : list[str] or str or None
+
+    Returns
+    -------
+    str
+    """
+    if nuclide_list is None:
+        return 'None'
+
+    if isinstance(nuclide_list, str):
+        nuclides = config.get_nuclide_list(nuclide_list)
+        if isinstance(nuclides, list):
+            return f'{nuclide_list}:{digest(sorted(nuclides))}'
+        return nuclide_list
+
+    return digest(sorted(nuclide_list))
+
+
+def fetch_comparison_results(reference_file,
+                             comparison_files,
+                             physical_quantity,
+                             deviation_mode,
+                             threshold,
+                             is_all_step,
+                             is_high_precision,
+                             nuclide_key):
+    """
+    获取已保存的对比结果，只返回与文件当前数据版本号(generation)一致的结果
+
+    Parameters
+    ----------
+    reference_file : File
+    comparison_files : list[File]
+    physical_quantity : PhysicalQuantity
+    deviation_mode : str
+    threshold : str
+        标准化的偏差阈值，参见 Decimal.normalize
+    is_all_step : bool
+    is_high_precision : bool
+    nuclide_key : str
+        参见 nuclide_list_key
+
+    Returns
+    -------
+    dict[int, dict[str, pd.DataFrame] or None]
+        key 为对比文件的 id，value 为该物理量的对比结果(工作表名: DataFrame)，None 表示任意一方没有该物理量的数据
+    """
+    comparison_generations = {comparison_file.id: comparison_file.generation
+                              for comparison_file in comparison_files}
+
+    stmt = (select(ComparisonResult.comparison_file_id,
+                   ComparisonResult.comparison_generation,
+                   ComparisonResult.result).
+            where(ComparisonResult.reference_file_id == reference_file.id,
+                  ComparisonResult.reference_generation == reference_file.generation,
+                  ComparisonResult.comparison_file_id.in_(list(comparison_generations)),
+                  ComparisonResult.physical_quantity_id == physical_quantity.id,
+                  ComparisonResult.deviation_mode == deviation_mode,
+                  ComparisonResult.threshold == threshold,
+                  ComparisonResult.is_all_step == bool(is_all_step),
+                  ComparisonResult.is_high_precision == bool(is_high_precision),
+                  ComparisonResult.nuclide_key == nuclide_key,
+                  ComparisonResult.result_format == FRAMES_FORMAT)
+            )
+
+    with Session() as session:
+        rows = session.execute(stmt).all()
+
+    comparison_results = {}
+    for comparison_file_id, comparison_generation, result in rows:
+        if comparison_generation != comparison_generations[comparison_file_id]:
+            continue
+
+        comparison_results[comparison_file_id] = None if result is None else load_frames(result)
+
+    return comparison_results
+
+
+def _extracted_rows_to_frame(rows, filename, is_all_step=False):
+    """
+    将 extracted_data 的查询结果转换为DataFrame，
+    middle_steps 会被反序列化为 {filename.name}_middle_step_* columns
+
+    Parameters
+    ----------
+    rows : list[Row]
+        (nuc_ix, name, last_step) 或者 (nuc_ix, name, last_step, middle_steps)
+    filename : File
+    is_all_step : bool, default = False
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    column_names = ['nuc_ix', 'name', f'{filename.name}_last_step']
+
+    if not is_all_step:
+        return pd.DataFrame(data=rows, columns=column_names)
+
+    df_rows = pd.DataFrame(data=rows, columns=[*column_names, 'middle_steps'])
+
+    # 没有中间结果的行填充为NaN，以保持行对齐
+    middle_steps = pd.DataFrame([middle_steps_line_parsing(middle_steps)
+                                 if middle_steps is not None
+                                 else {}
+                                 for middle_steps in df_rows['middle_steps']],
+                                index=df_rows.index)
+    middle_steps.columns = [f'{filename.name}_{name}'
+                            for name in middle_steps.columns.tolist()]
+
+    return pd.concat([df_rows.drop(columns='middle_steps'), middle_steps], axis=1, copy=False)
+
+
 def fetch_extracted_data_by_filename_and_physical_quantity(nuc_data_id,
                                                            filename,
                                                            physical_quantity,
@@ -346,6 +514,12 @@ def fetch_extracted_data_by_filename_and_physical_quantity(nuc_data_id,
     if type_checker(physical_quantity, PhysicalQuantity) == 'str':
         physical_quantity = fetch_physical_quantities_by_name(physical_quantity).pop()
 
+    cache_key = make_key('extracted_data', filename, physical_quantity,
+                         digest(nuc_data_id), is_all_step)
+    df_cached = query_cache.get(cache_key)
+    if df_cached is not None:
+        return df_cached
+
     df_left = pd.DataFrame(data=None, columns=['nuc_ix', 'name'])
 
     physical_quantity_id = physical_quantity.id
@@ -374,36 +548,231 @@ def fetch_extracted_data_by_filename_and_physical_quantity(nuc_data_id,
                               PhysicalQuantity.id == physical_quantity_id)
 
     with Session() as session:
-        if not is_all_step:
-            column_names = ['nuc_ix', 'name', f'{filename.name}_last_step']
-            df_right = pd.DataFrame(data=session.execute(stmt).all(),
-                                    columns=column_names)
-        else:
-            column_names = ['nuc_ix', 'name', f'{filename.name}_last_step', 'middle_steps']
-            df_right = pd.DataFrame(data=session.execute(stmt).all(),
-                                    columns=column_names)
-
-            exclude_middle_steps = df_right.drop(columns='middle_steps', axis=1)
-            del column_names[-1]
-            exclude_middle_steps.columns = column_names
-
-            middle_steps = pd.DataFrame([middle_steps_line_parsing(middle_steps)
-                                         for middle_steps in df_right['middle_steps']
-                                         if middle_steps is not None])
-            middle_step_column_names = [f'{filename.name}_{name}'
-                                        for name in middle_steps.columns.tolist()]
-            middle_steps.columns = middle_step_column_names
-
-            df_right = pd.concat([exclude_middle_steps, middle_steps], axis=1, copy=False)
+        df_right = _extracted_rows_to_frame(session.execute(stmt).all(),
+                                            filename,
+                                            is_all_step)
 
     if not df_right.empty:
         df_left = pd.merge(df_left, df_right, how='outer', on=['nuc_ix', 'name'])
 
     df_left.sort_values(by=['nuc_ix'], inplace=True)
 
+    query_cache.put(cache_key, df_left)
+
     return df_left
 
 
+def _iter_frame_chunks(df, chunk_size):
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size]
+
+
+def stream_extracted_data_by_filenames_and_physical_quantity(nuc_data_id,
+                                                             filenames,
+                                                             physical_quantity,
+                                                             is_all_step=False,
+                                                             chunk_size=10000):
+    """
+    分块获取多个文件的 extracted_data
+    所有文件共用一个 server-side cursor(stream_results)，依照nuc_ix排序读取，
+    每次只将约 chunk_size 行载入内存，并拆分为各个文件的DataFrame后yield，
+    同一个nuc_ix的行总是出现在同一次yield中
+    DataFrame 的 columns 与 fetch_extracted_data_by_filename_and_physical_quantity 相同
+    如果全部文件的数据都已缓存，则直接从缓存中分块返回，
+    否则在全部读取完毕后，将各文件的数据存入缓存(总大小不超过缓存上限时)
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+    filenames : list[File or str] or File or str
+    physical_quantity : str or PhysicalQuantity
+    is_all_step : bool, default = False
+        是否读取全部中间结果数据列，默认只读取最终结果列
+    chunk_size : int, default = 10000
+        每块的行数
+
+    Yields
+    ------
+    list[pd.DataFrame or None]
+        依次对应 filenames，该块中没有数据的文件为None
+    """
+
+    if type_checker(filenames, File) == 'str':
+        filenames = fetch_files_by_name(filenames)
+
+    if not isinstance(filenames, list):
+        filenames = [filenames]
+
+    if type_checker(physical_quantity, PhysicalQuantity) == 'str':
+        physical_quantity = fetch_physical_quantities_by_name(physical_quantity).pop()
+
+    nuc_data_id_digest = digest(nuc_data_id)
+    cache_keys = [make_key('extracted_data', filename, physical_quantity, nuc_data_id_digest, is_all_step)
+                  for filename in filenames]
+    df_cached = [query_cache.get(cache_key) for cache_key in cache_keys]
+    if all(df is not None for df in df_cached):
+        streams = [_iter_frame_chunks(df.reset_index(drop=True), chunk_size) for df in df_cached]
+        yield from iter_aligned_chunks(streams)
+        return
+
+    files = {filename.id: filename for filename in filenames}
+    file_positions = {filename.id: i for i, filename in enumerate(filenames)}
+
+    columns = [NucData.file_id, Nuc.nuc_ix, Nuc.name, NucData.last_step]
+    if is_all_step:
+        columns.append(NucData.middle_steps)
+
+    stmt = (select(*columns).
+            join(Nuc, Nuc.id == NucData.nuc_id).
+            where(NucData.id.in_(nuc_data_id),
+                  NucData.file_id.in_(list(files)),
+                  NucData.physical_quantity_id == physical_quantity.id).
+            order_by(Nuc.nuc_ix, NucData.file_id)
+            )
+
+    def split_by_file(rows):
+        rows_by_file = [[] for _ in filenames]
+        for row in rows:
+            rows_by_file[file_positions[row[0]]].append(row[1:])
+
+        return [_extracted_rows_to_frame(file_rows, filename, is_all_step)
+                if file_rows else None
+                for filename, file_rows in zip(filenames, rows_by_file)]
+
+    # 收集已yield的块，读取完毕后存入缓存，超过缓存上限或提前结束读取则不缓存
+    cached_chunks = [[] for _ in filenames] if query_cache.enabled else None
+    cached_size = 0
+
+    def collect(chunks):
+        nonlocal cached_chunks, cached_size
+        if cached_chunks is None:
+            return
+
+        cached_size += sum(int(df.memory_usage(index=True, deep=True).sum())
+                           for df in chunks if df is not None)
+        if cached_size > query_cache.max_size:
+            cached_chunks = None
+            return
+
+        for file_chunks, df in zip(cached_chunks, chunks):
+            if df is not None:
+                file_chunks.append(df)
+
+    with Session() as session:
+        result = session.execute(stmt, execution_options={'stream_results': True})
+
+        pending = []
+        for rows in result.partitions(chunk_size):
+            rows = pending + rows
+
+            # 最后一个nuc_ix的行可能还没有读完，留到下一块
+            cut = len(rows)
+            while cut > 0 and rows[cut - 1].nuc_ix == rows[-1].nuc_ix:
+                cut -= 1
+            pending = rows[cut:]
+
+            if cut:
+                chunks = split_by_file(rows[:cut])
+                collect(chunks)
+                yield chunks
+
+        if pending:
+            chunks = split_by_file(pending)
+            collect(chunks)
+            yield chunks
+
+    if cached_chunks is not None:
+        for cache_key, file_chunks in zip(cache_keys, cached_chunks):
+            df = (pd.concat(file_chunks, ignore_index=True, copy=False) if file_chunks
+                  else pd.DataFrame(data=None, columns=['nuc_ix', 'name']))
+            query_cache.put(cache_key, df)
+
+
+def fetch_num_of_middle_steps(nuc_data_id, filename, physical_quantity):
+    """
+    获取选中的数据中某文件某物理量 middle_step 的个数，
+    只读取 middle_steps 最长的一行，用于在分块读取之前确定 columns
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+    filename : File
+    physical_quantity : PhysicalQuantity
+
+    Returns
+    -------
+    int
+    """
+    stmt = (select(NucData.middle_steps).
+            where(NucData.id.in_(nuc_data_id),
+                  NucData.file_id == filename.id,
+                  NucData.physical_quantity_id == physical_quantity.id,
+                  NucData.middle_steps.is_not(None)).
+            order_by(func.length(NucData.middle_steps).desc()).
+            limit(1)
+            )
+
+    with Session() as session:
+        middle_steps = session.execute(stmt).scalar()
+
+    return len(middle_steps_line_parsing_to_array(middle_steps))
+
+
+def iter_aligned_chunks(streams, key='nuc_ix'):
+    """
+    对齐多个依照 key 排序的分块流
+    每次yield一个list，依次为各个流中 key 不大于当前水位(各未结束流的已读最大key的最小值)的行，
+    所以同一个 key 的行总是出现在同一次yield中
+    从未返回任何数据的流，对应位置为None
+
+    Parameters
+    ----------
+    streams : list[Iterable[pd.DataFrame]]
+    key : str, default = 'nuc_ix'
+
+    Yields
+    ------
+    list[pd.DataFrame or None]
+    """
+    iterators = [iter(stream) for stream in streams]
+    buffers = [None] * len(iterators)
+    exhausted = [False] * len(iterators)
+
+    while True:
+        for i, iterator in enumerate(iterators):
+            # 补充已经取空的buffer，跳过空块
+            while not exhausted[i] and (buffers[i] is None or buffers[i].empty):
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    exhausted[i] = True
+                    break
+                buffers[i] = chunk if buffers[i] is None else pd.concat([buffers[i], chunk], ignore_index=True)
+
+        if all(exhausted) and all(buffer is None or buffer.empty for buffer in buffers):
+            return
+
+        watermarks = [buffers[i][key].iloc[-1]
+                      for i in range(len(iterators))
+                      if not exhausted[i]]
+        watermark = min(watermarks) if watermarks else None
+
+        aligned = []
+        for i, buffer in enumerate(buffers):
+            if buffer is None:
+                aligned.append(None)
+                continue
+
+            if watermark is None:
+                is_released = np.ones(len(buffer), dtype=bool)
+            else:
+                is_released = (buffer[key] <= watermark).to_numpy()
+            aligned.append(buffer.loc[is_released].reset_index(drop=True))
+            buffers[i] = buffer.loc[~is_released]
+
+        yield aligned
+
+
 def fetch_max_num_of_middle_steps(physical_quantity='isotope'):
     """
     获取选定物理量中所有文件 middle_step 的最大值
@@ -435,24 +804,36 @@ def fetch_max_num_of_middle_steps(physical_quantity='isotope'):
     return max_num - 4
 
 
-def fetch_transposed_data_by_filename_and_physical_quantity(filename,
-                                                            physical_quantity,
-                                                            is_all_step=False):
+def _step_labels(step_ids, last_step_id):
     """
-    根据输入的 File 和 physical quantity 从 Nuc， NucData，PhysicalQuantity table获取数据
+    依据步骤序号生成 first_step, middle_step_*, last_step 标签
 
     Parameters
     ----------
-    filename : File
-        File object
-    physical_quantity : str or PhysicalQuantity
-        物理量，可以是物理量的 str，PhysicalQuantity
-    is_all_step : bool, default false
-        是否读取全部中间结果数据列，默认只读取第一步和最后一步
+    step_ids : np.ndarray
+    last_step_id : int
 
     Returns
     -------
-    pd.DataFrame
+    list[str]
+    """
+    return ['first_step' if step_id == 0
+            else 'last_step' if step_id == last_step_id
+            else f'middle_step_{step_id}'
+            for step_id in step_ids.tolist()]
+
+
+def _fetch_time_series(filename,
+                       physical_quantity,
+                       nuclide_list=None,
+                       steps=None):
+    """
+    fetch_time_series 的实现，额外返回选择的步骤序号和 last_step 的序号
+
+    Returns
+    -------
+    tuple[pd.DataFrame, np.ndarray, int, np.ndarray, np.ndarray]
+        依次为核素(nuc_ix, name)，步骤序号(time,)，last_step 的序号，时间点(time,)，数据(time, nuclide)
     """
 
     if type_checker(filename, File) == 'str':
@@ -461,63 +842,138 @@ def fetch_transposed_data_by_filename_and_physical_quantity(filename,
     if type_checker(physical_quantity, PhysicalQuantity) == 'str':
         physical_quantity = fetch_physical_quantities_by_name(physical_quantity).pop()
 
-    df_left = pd.DataFrame(data=None, columns=['nuc_ix', 'name'])
+    if steps is None:
+        steps = slice(None)
 
-    file_id = filename.id
-    physical_quantity_id = physical_quantity.id
+    repeat_times = filename.repeat_times
+    if repeat_times is None:
+        # 无法预知步数，需要读取中间步骤后才能确定
+        is_middle_steps_needed = True
+    else:
+        step_ids = np.arange(int(repeat_times) + 1)[steps]
+        is_middle_steps_needed = bool(((step_ids > 0) & (step_ids < int(repeat_times))).any())
+
+    columns = [Nuc.nuc_ix, Nuc.name,
+               type_coerce(NucData.first_step, Float),
+               type_coerce(NucData.last_step, Float)]
+    if is_middle_steps_needed:
+        columns.append(NucData.middle_steps)
+
+    stmt = (select(*columns).
+            join(Nuc, Nuc.id == NucData.nuc_id).
+            where(NucData.file_id == filename.id,
+                  NucData.physical_quantity_id == physical_quantity.id).
+            order_by(Nuc.nuc_ix)
+            )
+    if nuclide_list is not None:
+        stmt = stmt.where(NucData.nuc_id.in_(_nuclide_id_subquery(nuclide_list)))
 
-    if not is_all_step:
-        # 不读取中间结果，所以不选择NucData.middle_steps，否则反之
-        stmt = lambda_stmt(lambda: select(Nuc.nuc_ix, Nuc.name,
-                                          NucData.first_step, NucData.last_step))
+    with Session() as session:
+        rows = session.execute(stmt).all()
+
+    nuclides = pd.DataFrame(data=[row[:2] for row in rows], columns=['nuc_ix', 'name'])
+    first_step = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+    last_step = np.fromiter((row[3] for row in rows), dtype=np.float64, count=len(rows))
+
+    middle_steps = None
+    if is_middle_steps_needed:
+        middle_steps = [middle_steps_line_parsing_to_array(row[4]) for row in rows]
+        num_of_middle_steps = max((len(middle_step) for middle_step in middle_steps), default=0)
+        if repeat_times is None:
+            repeat_times = num_of_middle_steps + 1
+            step_ids = np.arange(repeat_times + 1)[steps]
+        if num_of_middle_steps == 0:
+            # 没有中间步骤，只保留第一步和最后一步
+            step_ids = step_ids[(step_ids == 0) | (step_ids == repeat_times)]
+
+    repeat_times = int(repeat_times)
+    values = np.full((len(step_ids), len(rows)), np.nan)
+    for i, step_id in enumerate(step_ids.tolist()):
+        if step_id == 0:
+            values[i] = first_step
+        elif step_id == repeat_times:
+            values[i] = last_step
+
+    middle_positions = np.flatnonzero((step_ids > 0) & (step_ids < repeat_times))
+    if middle_steps is not None and middle_positions.size:
+        middle_indices = step_ids[middle_positions] - 1
+        for j, middle_step in enumerate(middle_steps):
+            is_available = middle_indices < len(middle_step)
+            values[middle_positions[is_available], j] = middle_step[middle_indices[is_available]]
+
+    if filename.time_interval is None:
+        times = np.full(len(step_ids), np.nan)
     else:
-        stmt = lambda_stmt(lambda: select(Nuc.nuc_ix, Nuc.name,
-                                          NucData.first_step, NucData.last_step,
-                                          NucData.middle_steps))
+        times = step_ids * (filename.time_interval / timedelta(days=1))
 
-    stmt += lambda s: s.join(Nuc,
-                             Nuc.id == NucData.nuc_id)
-    stmt += lambda s: s.join(PhysicalQuantity,
-                             PhysicalQuantity.id == NucData.physical_quantity_id)
-    stmt += lambda s: s.where(NucData.file_id == file_id,
-                              PhysicalQuantity.id == physical_quantity_id)
+    return nuclides, step_ids, repeat_times, times, values
 
-    with Session() as session:
-        column_names = [column.name for
-                        column in list(stmt.selected_columns)]
-        df_right = pd.DataFrame(data=session.execute(stmt).all(),
-                                columns=column_names)
 
-    if is_all_step:
-        exclude_middle_steps = df_right.drop(columns='middle_steps', axis=1)
-        del column_names[-1]
-        exclude_middle_steps.columns = column_names
+def fetch_time_series(filename,
+                      physical_quantity,
+                      nuclide_list=None,
+                      steps=None):
+    """
+    获取时间序列，直接返回float64数组(time x nuclide)，不经过Decimal和DataFrame转置
+    时间轴依据 File.time_interval 和 File.repeat_times 计算，单位为天
+    第0步为 first_step，第 repeat_times 步为 last_step，其余为 middle_step_*
+    只读取需要的核素，只有选择的步骤包括中间步骤时才读取 middle_steps
+
+    Parameters
+    ----------
+    filename : File or str
+        File object
+    physical_quantity : str or PhysicalQuantity
+        物理量，可以是物理量的 str，PhysicalQuantity
+    nuclide_list : list[str] or str, optional
+        核素list，或者核素列表名(参见配置文件 nuclide_list 项)，默认为全部核素
+    steps : slice or list[int], optional
+        选择的步骤，支持负数，默认为全部步骤
 
-        middle_steps = pd.DataFrame([middle_steps_line_parsing(middle_steps)
-                                     for middle_steps in df_right['middle_steps']
-                                     if middle_steps is not None])
+    Returns
+    -------
+    tuple[pd.DataFrame, np.ndarray, np.ndarray]
+        依次为核素(nuc_ix, name)，时间点(time,)，数据(time, nuclide)
+    """
+    nuclides, _, _, times, values = _fetch_time_series(filename,
+                                                       physical_quantity,
+                                                       nuclide_list,
+                                                       steps)
 
-        df_right = pd.concat([exclude_middle_steps, middle_steps], axis=1, copy=False)
+    return nuclides, times, values
 
-    if not df_right.empty:
-        df_left = pd.merge(df_left, df_right, how='outer', on=['nuc_ix', 'name'])
 
-    df_left.sort_values(by=['nuc_ix'], inplace=True)
+def fetch_transposed_data_by_filename_and_physical_quantity(filename,
+                                                            physical_quantity,
+                                                            is_all_step=False):
+    """
+    根据输入的 File 和 physical quantity 从 Nuc， NucData，PhysicalQuantity table获取数据
 
-    nuc_ix = df_left.loc[:, ['nuc_ix', 'name']]
+    Parameters
+    ----------
+    filename : File
+        File object
+    physical_quantity : str or PhysicalQuantity
+        物理量，可以是物理量的 str，PhysicalQuantity
+    is_all_step : bool, default false
+        是否读取全部中间结果数据列，默认只读取第一步和最后一步
 
-    df_left = df_left.T
-    df_left.columns = df_left.loc['name']
-    df_left.drop(['nuc_ix', 'name'], inplace=True)
-    df_left = df_left.astype('float64', copy=False)
-    reindex = df_left.index.tolist()
-    reindex.append(reindex.pop(1))
-    df_left = df_left.reindex(reindex, copy=False)
+    Returns
+    -------
+    pd.DataFrame
+    """
+
+    if type_checker(filename, File) == 'str':
+        filename = fetch_files_by_name(filename).pop()
 
-    time_interval = pd.Series((filename.time_interval * i for i in range(filename.repeat_times + 1)),
-                              name='time_interval', index=df_left.index)
-    time_interval = time_interval / pd.to_timedelta(1, unit='D')
+    nuclides, step_ids, last_step_id, times, values = \
+        _fetch_time_series(filename,
+                           physical_quantity,
+                           steps=None if is_all_step else [0, -1])
 
-    df_left = pd.concat([df_left, time_interval], axis=1)
+    df_left = pd.DataFrame(values,
+                           index=_step_labels(step_ids, last_step_id),
+                           columns=nuclides['name'].tolist())
+    df_left['time_interval'] = times
 
-    return nuc_ix, df_left
+    return nuclides, df_left
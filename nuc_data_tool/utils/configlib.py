@@ -72,6 +72,23 @@ class Config:
         else:
             return self.conf.get("anomaly_detection").get(properties)
 
+    def get_cache_config(self, properties, default=None):
+        """
+        获取cache下的配置，配置文件中不存在时返回default
+
+        Parameters
+        ----------
+        properties : str
+            字段
+        default : Any
+            默认值
+
+        Returns
+        -------
+        Any
+        """
+        return self.conf.get("cache", {}).get(properties, default)
+
     def get_database_config(self):
         """
         获取database下的配置
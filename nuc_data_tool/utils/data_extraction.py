@@ -1,13 +1,16 @@
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import pandas as pd
 
+from nuc_data_tool.db.base import engine
 from nuc_data_tool.db.db_model import File, PhysicalQuantity
 from nuc_data_tool.db.fetch_data import (fetch_data_by_filename_and_nuclide_list, fetch_files_by_name,
-                                         fetch_extracted_data_by_filename_and_physical_quantity,
-                                         fetch_physical_quantities_by_name)
+                                         stream_extracted_data_by_filenames_and_physical_quantity,
+                                         fetch_physical_quantities_by_name,
+                                         fetch_num_of_middle_steps)
 from nuc_data_tool.utils.formatter import type_checker
-from nuc_data_tool.utils.workbook import save_to_excel
+from nuc_data_tool.utils.workbook import open_writer, remove_output
 
 
 def filter_data(filename, physical_quantity_name, nuclide_list, is_all_step):
@@ -50,12 +53,175 @@ def filter_data(filename, physical_quantity_name, nuclide_list, is_all_step):
     return dict_df_data
 
 
+def _extracted_columns(nuc_data_id,
+                       filenames,
+                       physical_quantity,
+                       is_all_step=False):
+    """
+    在读取数据之前确定合并后的columns，依照 filenames 的顺序排列，
+    每个文件为 {文件名}_last_step 以及全部中间结果时的 {文件名}_middle_step_*
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+    filenames : list[File]
+    physical_quantity : PhysicalQuantity
+    is_all_step : bool, default = False
+
+    Returns
+    -------
+    list[str]
+    """
+    columns = ['nuc_ix', 'name']
+    for filename in filenames:
+        columns.append(f'{filename.name}_last_step')
+        if is_all_step:
+            num_of_middle_steps = fetch_num_of_middle_steps(nuc_data_id, filename, physical_quantity)
+            columns.extend(f'{filename.name}_middle_step_{i}' for i in range(1, num_of_middle_steps + 1))
+
+    return columns
+
+
+def _iter_merged_chunks(nuc_data_id,
+                        filenames,
+                        physical_quantity,
+                        is_all_step=False,
+                        chunk_size=10000):
+    """
+    分块读取多个文件同一物理量的数据，并依照nuc_ix和name合并每一块
+    每一块的 columns 相同(参见 _extracted_columns)，所以可以直接逐块写入，
+    没有数据时 yield 一个只有 columns 的空块
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+    filenames : list[File]
+    physical_quantity : PhysicalQuantity
+    is_all_step : bool, default = False
+        是否读取全部中间结果数据列，默认只读取最终结果列
+    chunk_size : int, default = 10000
+        每块的行数
+
+    Yields
+    ------
+    pd.DataFrame
+    """
+    columns = _extracted_columns(nuc_data_id, filenames, physical_quantity, is_all_step)
+
+    is_empty = True
+    for chunks in stream_extracted_data_by_filenames_and_physical_quantity(nuc_data_id,
+                                                                           filenames,
+                                                                           physical_quantity,
+                                                                           is_all_step,
+                                                                           chunk_size):
+        df_left = pd.DataFrame(data=None, columns=['nuc_ix', 'name'])
+
+        for df_right in chunks:
+            if df_right is not None:
+                df_left = pd.merge(df_left, df_right, how='outer', on=['nuc_ix', 'name'])
+
+        df_left.sort_values(by=['nuc_ix'], inplace=True)
+
+        unexpected_columns = set(df_left.columns) - set(columns)
+        if unexpected_columns:
+            raise Exception(f'unexpected columns {sorted(unexpected_columns)} in {physical_quantity.name}')
+
+        is_empty = False
+        yield df_left.reindex(columns=columns)
+
+    if is_empty:
+        yield pd.DataFrame(data=None, columns=columns)
+
+
+def _save_file_workbook(nuc_data_id,
+                        filename,
+                        physical_quantities,
+                        is_all_step=False,
+                        result_path=Path('.'),
+                        chunk_size=10000,
+                        output_format='xlsx'):
+    """
+    将单个文件的全部物理量写入该文件的工作簿，只打开和保存一次
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+    filename : File
+    physical_quantities : list[PhysicalQuantity]
+    is_all_step : bool, default = False
+        是否读取全部中间结果数据列，默认只读取最终结果列
+    result_path : Path or str
+    chunk_size : int, default = 10000
+        数据库读取时每块的行数
+    output_format : str, default = 'xlsx'
+        输出格式，参见 open_writer
+
+    Returns
+    -------
+
+    """
+    files_name = f'{filename.name}.xlsx'
+    if is_all_step:
+        files_name = f'all_steps_{filename.name}.xlsx'
+
+    file_path = Path(result_path).joinpath(files_name)
+    remove_output(file_path, output_format)
+
+    with open_writer(file_path, output_format) as writer:
+        for physical_quantity in physical_quantities:
+            writer.write_chunks(physical_quantity.name,
+                                _iter_merged_chunks(nuc_data_id,
+                                                    [filename],
+                                                    physical_quantity,
+                                                    is_all_step,
+                                                    chunk_size))
+
+
+# worker 进程共享的 nuc_data_id，由 _init_worker 设置，避免每个任务重复传输
+_worker_nuc_data_id = None
+
+
+def _init_worker(nuc_data_id):
+    """
+    初始化 worker 进程
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+
+    Returns
+    -------
+
+    """
+    global _worker_nuc_data_id
+    _worker_nuc_data_id = nuc_data_id
+    # fork 得到的连接池属于父进程，不能在子进程中使用
+    engine.dispose(close=False)
+
+
+def _save_file_workbook_in_worker(file_name, physical_quantity_names, **kwargs):
+    """
+    在 worker 进程中运行 _save_file_workbook，文件和物理量以名称传递
+
+    Returns
+    -------
+
+    """
+    _save_file_workbook(_worker_nuc_data_id,
+                        fetch_files_by_name(file_name).pop(),
+                        fetch_physical_quantities_by_name(physical_quantity_names),
+                        **kwargs)
+
+
 def save_extracted_data_to_exel(nuc_data_id,
                                 filenames=None,
                                 physical_quantities=None,
                                 is_all_step=False,
                                 result_path=Path('.'),
-                                merge=True):
+                                merge=True,
+                                chunk_size=10000,
+                                output_format='xlsx',
+                                jobs=1):
     """
     将数据存入到exel文件
     将传入的File list中包含的文件的数据存到exel文件
@@ -73,6 +239,12 @@ def save_extracted_data_to_exel(nuc_data_id,
     result_path : Path or str
     merge : bool, default = True
         是否将结果合并输出至一个文件，否则单独输出至每个文件
+    chunk_size : int, default = 10000
+        数据库读取时每块的行数
+    output_format : str, default = 'xlsx'
+        输出格式，xlsx，csv，parquet，feather 或 hdf5，参见 open_writer
+    jobs : int, default = 1
+        并行的进程数，merge 为 False 时每个文件的工作簿在一个 worker 进程中生成
 
     Returns
     -------
@@ -90,42 +262,50 @@ def save_extracted_data_to_exel(nuc_data_id,
     if is_all_step:
         file_name = f'all_steps_{file_name}'
 
+    physical_quantity: PhysicalQuantity
     if merge:
-        Path(result_path).joinpath(file_name).unlink(missing_ok=True)
-    else:
-        for filename in filenames:
-            if is_all_step:
-                Path(result_path).joinpath(f'all_steps_{filename.name}.xlsx').unlink(missing_ok=True)
-            else:
-                Path(result_path).joinpath(f'{filename.name}.xlsx').unlink(missing_ok=True)
-        del filename
+        remove_output(Path(result_path).joinpath(file_name), output_format)
+        # 全部物理量写入同一个工作簿，只打开和保存一次，每个物理量逐块写入
+        with open_writer(Path(result_path).joinpath(file_name), output_format) as writer:
+            for physical_quantity in physical_quantities:
+                writer.write_chunks(physical_quantity.name,
+                                    _iter_merged_chunks(nuc_data_id,
+                                                        filenames,
+                                                        physical_quantity,
+                                                        is_all_step,
+                                                        chunk_size))
+        return
 
-    physical_quantity: PhysicalQuantity
-    for physical_quantity in physical_quantities:
-        df_left = pd.DataFrame(data=None, columns=['nuc_ix', 'name'])
+    if not isinstance(filenames, list):
+        filenames = [filenames]
 
-        filename: File
-        for filename in filenames:
+    if not isinstance(physical_quantities, list):
+        physical_quantities = [physical_quantities]
 
-            files_name = f'{filename.name}.xlsx'
-            if is_all_step:
-                files_name = f'all_steps_{filename.name}.xlsx'
+    kwargs = {'is_all_step': is_all_step,
+              'result_path': result_path,
+              'chunk_size': chunk_size,
+              'output_format': output_format}
 
-            df_right = fetch_extracted_data_by_filename_and_physical_quantity(nuc_data_id,
-                                                                              filename,
-                                                                              physical_quantity,
-                                                                              is_all_step)
+    jobs = min(jobs, len(filenames))
+    if jobs <= 1:
+        filename: File
+        for filename in filenames:
+            _save_file_workbook(nuc_data_id, filename, physical_quantities, **kwargs)
+        return
 
-            if not df_right.empty:
-                df_left = pd.merge(df_left, df_right, how='outer', on=['nuc_ix', 'name'])
+    physical_quantity_names = [physical_quantity.name for physical_quantity in physical_quantities]
 
-            if not merge:
-                save_to_excel({physical_quantity.name: df_left},
-                              files_name,
-                              result_path)
-                df_left = pd.DataFrame(data=None, columns=['nuc_ix', 'name'])
+    # 每个文件的工作簿相互独立，作为一个任务提交给 worker 进程
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_init_worker,
+                             initargs=(nuc_data_id,)) as executor:
+        futures = [executor.submit(_save_file_workbook_in_worker,
+                                   filename.name,
+                                   physical_quantity_names,
+                                   **kwargs)
+                   for filename in filenames]
 
-        if merge:
-            save_to_excel({physical_quantity.name: df_left},
-                          file_name,
-                          result_path)
+        for future in futures:
+            # 抛出 worker 中的异常
+            future.result()
@@ -0,0 +1,271 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from nuc_data_tool.db.db_model import File, PhysicalQuantity
+from nuc_data_tool.db.fetch_data import (fetch_files_by_name,
+                                         fetch_physical_quantities_by_name,
+                                         fetch_time_series)
+from nuc_data_tool.utils.formatter import type_checker
+
+
+class NucDataset:
+    """
+    单一物理量、多个文件的三维数据集 (file x nuclide x step)
+    数值为float64，不存在的值为NaN
+    各文件的步数不同时，较短的文件在末尾补NaN，实际的时间点见 times
+
+    Attributes
+    ----------
+    physical_quantity : str
+        物理量名
+    files : np.ndarray
+        文件名，shape (file,)
+    nuc_ix : np.ndarray
+        核素序号，shape (nuclide,)
+    names : np.ndarray
+        核素名，shape (nuclide,)
+    times : np.ndarray
+        各文件各步的时间点，单位为天，shape (file, step)
+    data : np.ndarray
+        数据，shape (file, nuclide, step)
+    """
+
+    def __init__(self, physical_quantity, files, nuc_ix, names, times, data):
+        self.physical_quantity = str(physical_quantity)
+        self.files = np.asarray(files, dtype=str)
+        self.nuc_ix = np.asarray(nuc_ix, dtype=np.int64)
+        self.names = np.asarray(names, dtype=str)
+        self.times = np.asarray(times, dtype=np.float64)
+        self.data = np.asarray(data, dtype=np.float64)
+
+    def __repr__(self):
+        return (f'NucDataset(physical_quantity={self.physical_quantity!r}, '
+                f'files={len(self.files)}, nuclides={len(self.nuc_ix)}, steps={self.data.shape[2]})')
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @classmethod
+    def from_database(cls, filenames='all', physical_quantity='isotope', is_all_step=False):
+        """
+        从数据库读取选定文件的某一物理量，生成数据集
+
+        Parameters
+        ----------
+        filenames : list[File or str] or File or str, default = 'all'
+        physical_quantity : str or PhysicalQuantity, default = 'isotope'
+        is_all_step : bool, default = False
+            是否读取全部中间结果，默认只读取第一步和最后一步
+
+        Returns
+        -------
+        NucDataset
+        """
+        if type_checker(filenames, File) == 'str':
+            filenames = fetch_files_by_name(filenames)
+
+        if not isinstance(filenames, list):
+            filenames = [filenames]
+
+        if type_checker(physical_quantity, PhysicalQuantity) == 'str':
+            physical_quantity = fetch_physical_quantities_by_name(physical_quantity).pop()
+
+        # 直接读取每个文件的float64时间序列，再一次性填入三维数组
+        file_series = []
+        nuclides = {}
+        for filename in filenames:
+            file_nuclides, file_times, values = fetch_time_series(filename,
+                                                                  physical_quantity,
+                                                                  steps=None if is_all_step else [0, -1])
+            nuc_ix = file_nuclides['nuc_ix'].to_numpy(dtype=np.int64)
+            nuclides.update(zip(nuc_ix.tolist(), file_nuclides['name'].tolist()))
+
+            file_series.append((nuc_ix, file_times, values.T))
+
+        all_nuc_ix = np.array(sorted(nuclides), dtype=np.int64)
+        names = np.array([nuclides[ix] for ix in all_nuc_ix.tolist()], dtype=str)
+        num_of_steps = max((matrix.shape[1] for _, _, matrix in file_series), default=0)
+
+        data = np.full((len(filenames), len(all_nuc_ix), num_of_steps), np.nan)
+        times = np.full((len(filenames), num_of_steps), np.nan)
+
+        for i, (nuc_ix, file_times, matrix) in enumerate(file_series):
+            rows = np.searchsorted(all_nuc_ix, nuc_ix)
+            data[i, rows, :matrix.shape[1]] = matrix
+            times[i, :matrix.shape[1]] = file_times
+
+        return cls(physical_quantity.name,
+                   [filename.name for filename in filenames],
+                   all_nuc_ix,
+                   names,
+                   times,
+                   data)
+
+    def __getitem__(self, key):
+        """
+        依照位置切片，key 依次对应 (file, nuclide, step)，
+        int 会被视为长度为1的切片，所以结果总是三维的
+
+        Parameters
+        ----------
+        key : int or slice or array-like or tuple
+
+        Returns
+        -------
+        NucDataset
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if len(key) > 3:
+            raise Exception('too many indices for NucDataset')
+
+        key = tuple(slice(k, (k + 1) or None) if isinstance(k, (int, np.integer)) else k
+                    for k in key)
+        file_key, nuc_key, step_key = key + (slice(None),) * (3 - len(key))
+
+        return NucDataset(self.physical_quantity,
+                          self.files[file_key],
+                          self.nuc_ix[nuc_key],
+                          self.names[nuc_key],
+                          self.times[file_key][:, step_key],
+                          self.data[file_key][:, nuc_key][:, :, step_key])
+
+    def sel(self, files=None, nuclides=None, steps=None):
+        """
+        依照标签选择
+
+        Parameters
+        ----------
+        files : list[str] or str, optional
+            文件名
+        nuclides : list[str or int] or str or int, optional
+            核素名或者nuc_ix
+        steps : int or slice or array-like, optional
+            步骤的位置
+
+        Returns
+        -------
+        NucDataset
+        """
+        file_key = slice(None)
+        if files is not None:
+            if isinstance(files, str):
+                files = [files]
+            file_positions = {name: i for i, name in enumerate(self.files.tolist())}
+            file_key = [file_positions[name] for name in files]
+
+        nuc_key = slice(None)
+        if nuclides is not None:
+            if isinstance(nuclides, (str, int, np.integer)):
+                nuclides = [nuclides]
+            name_positions = {name: i for i, name in enumerate(self.names.tolist())}
+            nuc_ix_positions = {ix: i for i, ix in enumerate(self.nuc_ix.tolist())}
+            nuc_key = [name_positions[nuclide] if isinstance(nuclide, str) else nuc_ix_positions[int(nuclide)]
+                       for nuclide in nuclides]
+
+        return self[file_key, nuc_key, slice(None) if steps is None else steps]
+
+    def to_frame(self, file):
+        """
+        将某一文件的数据转换为与 fetch_data_by_filename_and_physical_quantity 相同布局的DataFrame
+
+        Parameters
+        ----------
+        file : str or int
+            文件名或者文件的位置
+
+        Returns
+        -------
+        pd.DataFrame
+        """
+        if isinstance(file, str):
+            file = self.files.tolist().index(file)
+
+        matrix = self.data[file]
+        num_of_steps = int((~np.isnan(self.times[file])).sum()) or matrix.shape[1]
+        columns = ['first_step',
+                   *(f'middle_step_{i}' for i in range(1, num_of_steps - 1)),
+                   'last_step'][:num_of_steps]
+
+        df = pd.DataFrame(matrix[:, :num_of_steps], columns=columns)
+        df.insert(0, 'name', self.names)
+        df.insert(0, 'nuc_ix', self.nuc_ix)
+
+        return df.dropna(subset=columns, how='all').reset_index(drop=True)
+
+    def save(self, path):
+        """
+        保存数据集，依据后缀选择格式
+        .npz 为 numpy 压缩格式，.h5/.hdf5 为 HDF5 格式(需要h5py)
+
+        Parameters
+        ----------
+        path : Path or str
+
+        Returns
+        -------
+
+        """
+        path = Path(path)
+        arrays = {'files': self.files,
+                  'nuc_ix': self.nuc_ix,
+                  'names': self.names,
+                  'times': self.times,
+                  'data': self.data}
+
+        if path.suffix in ('.h5', '.hdf5'):
+            h5py = _import_h5py()
+            with h5py.File(path, 'w') as h5_file:
+                h5_file.attrs['physical_quantity'] = self.physical_quantity
+                for key, value in arrays.items():
+                    if value.dtype.kind == 'U':
+                        value = np.char.encode(value, 'utf-8')
+                    h5_file.create_dataset(key, data=value, compression='gzip')
+        elif path.suffix == '.npz':
+            np.savez_compressed(path, physical_quantity=np.array(self.physical_quantity), **arrays)
+        else:
+            raise Exception(f"can't support {path.suffix} format")
+
+    @classmethod
+    def load(cls, path):
+        """
+        读取 save 保存的数据集
+
+        Parameters
+        ----------
+        path : Path or str
+
+        Returns
+        -------
+        NucDataset
+        """
+        path = Path(path)
+
+        if path.suffix in ('.h5', '.hdf5'):
+            h5py = _import_h5py()
+            with h5py.File(path, 'r') as h5_file:
+                arrays = {key: h5_file[key][()] for key in h5_file.keys()}
+                physical_quantity = h5_file.attrs['physical_quantity']
+            for key in ('files', 'names'):
+                arrays[key] = np.char.decode(arrays[key], 'utf-8')
+        elif path.suffix == '.npz':
+            with np.load(path) as npz_file:
+                arrays = {key: npz_file[key] for key in npz_file.files}
+            physical_quantity = arrays.pop('physical_quantity').item()
+        else:
+            raise Exception(f"can't support {path.suffix} format")
+
+        return cls(physical_quantity, **arrays)
+
+
+def _import_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise Exception('h5py is required to read or write HDF5 files, please install it with pip install h5py')
+
+    return h5py
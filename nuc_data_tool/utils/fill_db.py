@@ -1,19 +1,24 @@
 import pandas as pd
-from sqlalchemy import select
+from sqlalchemy import select, delete, or_
 
 from nuc_data_tool.db.base import Session
-from nuc_data_tool.db.db_model import Nuc, NucData, File, PhysicalQuantity
-from nuc_data_tool.db.db_utils import upsert
+from nuc_data_tool.db.cache import query_cache, feature_cache, digest
+from nuc_data_tool.db.db_model import Nuc, NucData, File, PhysicalQuantity, NuclideSet, ComparisonResult
+from nuc_data_tool.db.db_utils import upsert, dump_frames, FRAMES_FORMAT
+from nuc_data_tool.utils.configlib import config
 from nuc_data_tool.utils.middle_steps import middle_steps_line_serialization
 
 
-def populate_database(xml_file):
+def populate_database(xml_file, reingest=False):
     """
     将xml_file的数据填入数据库
+    每次导入都会递增文件的数据版本号(File.generation)，以使缓存失效
 
     Parameters
     ----------
     xml_file: InputXmlFileReader
+    reingest : bool, default = False
+        文件已存在时，是否删除原有数据并重新导入，否则跳过
 
     Returns
     -------
@@ -33,10 +38,25 @@ def populate_database(xml_file):
                         repeat_times=xml_file.repeat_times,
                         is_all_step=xml_file.is_all_step)
         session.add(file_tmp)
+    elif reingest:
+        # 重新导入，删除原有数据和关系，并更新文件信息
+        session.execute(delete(NucData).where(NucData.file_id == file_tmp.id))
+        # 旧的对比结果已经失效
+        session.execute(delete(ComparisonResult).
+                        where(or_(ComparisonResult.reference_file_id == file_tmp.id,
+                                  ComparisonResult.comparison_file_id == file_tmp.id)))
+        file_tmp.physical_quantities.clear()
+        file_tmp.time_interval = xml_file.time_interval
+        file_tmp.repeat_times = xml_file.repeat_times
+        file_tmp.is_all_step = xml_file.is_all_step
+        query_cache.invalidate_file(file_tmp.id)
+        feature_cache.invalidate_file(file_tmp.id)
     else:
         session.close()
         return
 
+    file_tmp.generation = (file_tmp.generation or 0) + 1
+
     for key in xml_file.table_of_physical_quantity:
 
         if not xml_file.table_of_physical_quantity[key]:
@@ -104,3 +124,65 @@ def populate_database(xml_file):
         session.commit()
 
     session.close()
+
+
+def sync_nuclide_sets():
+    """
+    将配置文件 nuclide_list 项下的核素列表同步至 nuclide_set table
+    核素名被解析为 nuc.id，数据库中不存在的核素被忽略，配置文件中已删除的核素列表也会被删除
+    'all'，'None' 之类的非列表项不会被同步
+
+    Returns
+    -------
+
+    """
+    nuclide_lists = {name: nuclide_list
+                     for name, nuclide_list in config.get_conf('nuclide_list').items()
+                     if isinstance(nuclide_list, list)}
+
+    with Session() as session:
+        for nuclide_set in session.execute(select(NuclideSet)).scalars().all():
+            if nuclide_set.name not in nuclide_lists:
+                session.delete(nuclide_set)
+
+        for name, nuclide_list in nuclide_lists.items():
+            nuclide_set = session.execute(select(NuclideSet).
+                                          where(NuclideSet.name == name)).scalar_one_or_none()
+            if nuclide_set is None:
+                nuclide_set = NuclideSet(name=name)
+                session.add(nuclide_set)
+
+            nuclide_set.nuclides = session.execute(select(Nuc).
+                                                   where(Nuc.name.in_(nuclide_list))).scalars().all()
+            nuclide_set.digest = digest(sorted(nuclide_list))
+
+        session.commit()
+
+
+def save_comparison_results(comparison_results):
+    """
+    保存对比结果，相同key(文件，物理量，偏差模式，阈值等)的旧结果会被替换
+
+    Parameters
+    ----------
+    comparison_results : list[dict]
+        ComparisonResult 的各字段，result 为 dict[str, pd.DataFrame] 或 None
+
+    Returns
+    -------
+
+    """
+    key_fields = ('reference_file_id', 'comparison_file_id', 'physical_quantity_id',
+                  'deviation_mode', 'threshold', 'is_all_step', 'is_high_precision', 'nuclide_key')
+
+    with Session() as session:
+        for comparison_result in comparison_results:
+            session.execute(delete(ComparisonResult).
+                            where(*(getattr(ComparisonResult, field) == comparison_result[field]
+                                    for field in key_fields)))
+
+            result = comparison_result['result']
+            session.add(ComparisonResult(**{**comparison_result,
+                                            'result_format': FRAMES_FORMAT,
+                                            'result': None if result is None else dump_frames(result)}))
+        session.commit()
@@ -1,5 +1,7 @@
 from decimal import Decimal
 
+import numpy as np
+
 from nuc_data_tool.utils.middle_steps_pb2 import MiddleStep, MiddleSteps
 
 
@@ -53,3 +55,25 @@ def middle_steps_line_parsing(data):
         return {'middle_steps': None}
     else:
         return {f'middle_step_{middle_step.id}': Decimal(middle_step.data) for middle_step in parsing(data)}
+
+
+def middle_steps_line_parsing_to_array(data):
+    """
+    将middle_steps_line反序列化为float64数组，依照序号排列
+
+    Parameters
+    ----------
+    data : bytes or None
+
+    Returns
+    -------
+    np.ndarray
+    """
+    if data is None:
+        return np.empty(0, dtype=np.float64)
+
+    middle_steps = MiddleSteps()
+    middle_steps.ParseFromString(data)
+    return np.fromiter((middle_step.data for middle_step in middle_steps.middle_steps),
+                       dtype=np.float64,
+                       count=len(middle_steps.middle_steps))
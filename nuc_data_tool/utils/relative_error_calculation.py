@@ -1,159 +1,724 @@
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
 from decimal import localcontext, Decimal, InvalidOperation
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
+from nuc_data_tool.db.base import engine
 from nuc_data_tool.db.db_model import PhysicalQuantity, File
-from nuc_data_tool.db.fetch_data import (fetch_extracted_data_by_filename_and_physical_quantity,
+from nuc_data_tool.db.fetch_data import (stream_extracted_data_by_filenames_and_physical_quantity,
                                          fetch_files_by_name,
-                                         fetch_physical_quantities_by_name)
+                                         fetch_physical_quantities_by_name,
+                                         fetch_comparison_results,
+                                         nuclide_list_key)
+from nuc_data_tool.utils.fill_db import save_comparison_results
 from nuc_data_tool.utils.formatter import type_checker
-from nuc_data_tool.utils.workbook import save_to_excel
+from nuc_data_tool.utils.workbook import save_to_excel, output_exists, remove_output
 
 
-def _complement_columns(df_reference,
-                        df_comparison,
-                        reference_complement_column_name,
-                        comparison_complement_column_name):
+def _deviation_matrix(reference, comparison, deviation_mode='relative'):
     """
-    对齐middle_step_* columns，数值填充为NaN
+    对对齐后的float64矩阵一次性计算全部步骤的偏差
+    relative deviation formula: abs(X - Y) / (1 + min(X, Y))
+    absolute deviation formula: abs(X - Y)
 
     Parameters
     ----------
-    df_reference : pd.DataFrame
-    df_comparison : pd.DataFrame
-    reference_complement_column_name : str
-    comparison_complement_column_name : str
+    reference : np.ndarray
+    comparison : np.ndarray
+    deviation_mode : str, default = 'relative'
 
     Returns
     -------
-    tuple[pd.DataFrame, pd.DataFrame]
-    """
-    reference_column_length = len(df_reference.columns)
-    comparison_column_length = len(df_comparison.columns)
-    column_length_difference = reference_column_length - comparison_column_length
-
-    column_start_num = min(reference_column_length, comparison_column_length) - 2
-
-    if reference_column_length == comparison_column_length:
-        # 当column length相同时，什么也不做
-        pass
-    elif reference_column_length < comparison_column_length:
-        complement_columns = [f'{reference_complement_column_name}_middle_step_{i}'
-                              for i in range(column_start_num,
-                                             column_start_num + abs(column_length_difference))]
-        complement_df = pd.DataFrame(data=None, columns=complement_columns)
-        df_reference = pd.concat([df_reference, complement_df], axis=1, copy=False)
-    else:
-        complement_columns = [f'{comparison_complement_column_name}_middle_step_{i}'
-                              for i in range(column_start_num,
-                                             column_start_num + abs(column_length_difference))]
-        complement_df = pd.DataFrame(data=None, columns=complement_columns)
-        df_comparison = pd.concat([df_comparison, complement_df], axis=1, copy=False)
-
-    return df_reference, df_comparison
+    np.ndarray
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if deviation_mode == 'relative':
+            return np.abs(reference - comparison) / (1 + np.minimum(reference, comparison))
+        elif deviation_mode == 'absolute':
+            return np.abs(reference - comparison)
+        else:
+            raise Exception("wrong deviation mode")
 
 
-def _calculate_deviation(df_reference,
-                         df_comparison,
-                         deviation_mode='relative',
-                         threshold=Decimal('1.0E-12')):
+def _deviation_matrix_decimal(reference, comparison, deviation_mode='relative', threshold=Decimal('1.0E-12')):
     """
-    计算误差
-    relative deviation formula: abs(X - Y) / 1 + min(abs(X), abs(Y))
-    absolute deviation formula: X - Y
+    _deviation_matrix 的高精度版本，使用Decimal逐元素计算，速度较慢
 
     Parameters
     ----------
-    df_reference : pd.DataFrame
-    df_comparison : pd.DataFrame
+    reference : np.ndarray
+        object 数组，元素为Decimal
+    comparison : np.ndarray
+        object 数组，元素为Decimal
     deviation_mode : str, default = 'relative'
-        绝对=absolute
-        相对=relative
-        偏差模式，分为绝对和相对，默认为相对
+    threshold : Decimal, default = Decimal('1.0E-12')
 
     Returns
     -------
-    tuple[pd.DataFrame, pd.Series]
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        偏差(object 数组)，是否为NaN，是否超过阈值
     """
+    # NaN is classified as unordered.
+    # By default InvalidOperation is trapped,
+    # so a Python exception is raised when using <= and >= against Decimal('NaN').
+    # You could disable trapping by using a Decimal.localcontext()
+    # https://stackoverflow.com/a/28371465/11071374
+    with localcontext() as ctx:
+        ctx.traps[InvalidOperation] = False
+        if deviation_mode == 'relative':
+            deviation = np.abs(reference - comparison) / (1 + np.minimum(reference, comparison))
+        elif deviation_mode == 'absolute':
+            deviation = np.abs(reference - comparison)
+        else:
+            raise Exception("wrong deviation mode")
 
-    i = 0
+        is_nan = np.frompyfunc(lambda value: value.is_nan(), 1, 1)(deviation).astype(bool)
+        # NaN 与阈值比较的结果为False
+        is_exceeded = (deviation > threshold).astype(bool)
 
-    df_deviation = pd.DataFrame()
-    for reference_column, \
-        comparison_column in zip(df_reference.columns.values.tolist()[2:],
-                                 df_comparison.columns.values.tolist()[2:]):
-        if deviation_mode == 'relative':
-            # abs(X - Y) / 1 + min(abs(X), abs(Y))
-            """NaN is classified as unordered.
-            By default InvalidOperation is trapped, 
-            so a Python exception is raised when using <= and >= against Decimal('NaN'). 
-            This is a logical extension; 
-            Python has actual exceptions so if you compare against the 
-            NaN exception value, you can expect an exception being raised. 
-            You could disable trapping by using a Decimal.localcontext()
-            https://stackoverflow.com/a/28371465/11071374
-            """
-            with localcontext() as ctx:
-                ctx.traps[InvalidOperation] = False
-                deviation = (df_reference[reference_column] - df_comparison[comparison_column]).abs() / \
-                            (1 + np.minimum(df_reference[reference_column].fillna(Decimal('NaN')),
-                                            df_comparison[comparison_column].fillna(Decimal('NaN'))))
+    return deviation, is_nan, is_exceeded
 
-        elif deviation_mode == 'absolute':
-            deviation = (df_reference[reference_column] - df_comparison[comparison_column]).abs()
 
+def _to_decimal_matrix(df):
+    """
+    将DataFrame转换为Decimal object 数组，缺失值为Decimal('NaN')
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+
+    Returns
+    -------
+    np.ndarray
+    """
+    matrix = df.to_numpy(dtype=object)
+    is_na = pd.isna(matrix)
+    matrix[is_na] = Decimal('NaN')
+    matrix[~is_na] = [Decimal(value) if not isinstance(value, Decimal) else value
+                      for value in matrix[~is_na].tolist()]
+
+    return matrix
+
+
+def _step_order(column):
+    """
+    步骤列的排序key，依照 last_step, middle_step_1, middle_step_2... 排序
+
+    Parameters
+    ----------
+    column : str
+
+    Returns
+    -------
+    int
+    """
+    return -1 if column.endswith('last_step') else int(column.rsplit('_', 1)[-1])
+
+
+def _step_position(column):
+    """
+    步骤列在矩阵中的位置，last_step 为第0列，middle_step_i 为第i列
+
+    Parameters
+    ----------
+    column : str
+
+    Returns
+    -------
+    int
+    """
+    return 0 if column.endswith('last_step') else int(column.rsplit('_', 1)[-1])
+
+
+def _step_column_names(prefix, step_num):
+    """
+    生成 {prefix}_last_step, {prefix}_middle_step_1, ... 共 step_num 个列名
+
+    Parameters
+    ----------
+    prefix : str
+    step_num : int
+
+    Returns
+    -------
+    list[str]
+    """
+    return [f'{prefix}_{step}' for step in _step_names(step_num)]
+
+
+def _step_names(step_num):
+    """
+    生成 last_step, middle_step_1, ... 共 step_num 个步骤名，顺序与矩阵中的位置一致
+
+    Parameters
+    ----------
+    step_num : int
+
+    Returns
+    -------
+    list[str]
+    """
+    return ['last_step', *(f'middle_step_{i}' for i in range(1, step_num))]
+
+
+def _chunk_matrices(data_chunk):
+    """
+    将同一块(chunk)中各文件的数据依据nuc_ix对齐为float64矩阵，缺失的值为NaN
+    只转换数值，不对齐原始的DataFrame
+
+    Parameters
+    ----------
+    data_chunk : list[pd.DataFrame or None]
+
+    Returns
+    -------
+    tuple[np.ndarray, list[np.ndarray or None], list[np.ndarray or None]]
+        对齐后的nuc_ix(row,)，各文件的矩阵(row, step)，各文件每一行在原DataFrame中的位置(row,)，不存在为-1
+    """
+    present_data = [data for data in data_chunk if data is not None]
+    nuc_ix = np.unique(np.concatenate([data['nuc_ix'].to_numpy(dtype=np.int64) for data in present_data]))
+    step_num = max(len(data.columns) - 2 for data in present_data)
+
+    matrices, row_positions = [], []
+    for data in data_chunk:
+        if data is None:
+            matrices.append(None)
+            row_positions.append(None)
+            continue
+
+        positions = np.searchsorted(nuc_ix, data['nuc_ix'].to_numpy(dtype=np.int64))
+        columns = [_step_position(column) for column in data.columns[2:]]
+
+        matrix = np.full((len(nuc_ix), step_num), np.nan)
+        matrix[np.ix_(positions, columns)] = data.iloc[:, 2:].to_numpy(dtype=np.float64, na_value=np.nan)
+        matrices.append(matrix)
+
+        row_position = np.full(len(nuc_ix), -1)
+        row_position[positions] = np.arange(len(data))
+        row_positions.append(row_position)
+
+    return nuc_ix, matrices, row_positions
+
+
+def _decimal_rows(data, rows, step_num):
+    """
+    取出DataFrame中指定行的数值，转换为依照步骤排列的Decimal矩阵，缺失值为Decimal('NaN')
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+    rows : np.ndarray
+        行的位置
+    step_num : int
+
+    Returns
+    -------
+    np.ndarray
+    """
+    matrix = np.full((len(rows), step_num), Decimal('NaN'), dtype=object)
+    columns = [_step_position(column) for column in data.columns[2:]]
+    matrix[:, columns] = _to_decimal_matrix(data.iloc[rows, 2:])
+
+    return matrix
+
+
+def _step_times(file, step_num):
+    """
+    依据文件的 time_interval 和 repeat_times 计算各步骤在矩阵中位置对应的时间点，单位为天
+    last_step 为第0列，middle_step_i 为第i列
+
+    Parameters
+    ----------
+    file : File
+    step_num : int
+
+    Returns
+    -------
+    np.ndarray
+    """
+    if file.time_interval is None or file.repeat_times is None:
+        raise Exception(f"{file.name} has no time_interval or repeat_times, can't align it by time")
+
+    time_interval = file.time_interval / timedelta(days=1)
+    times = np.arange(step_num) * time_interval
+    times[0] = int(file.repeat_times) * time_interval
+
+    return times
+
+
+def _interpolate_to_time_grid(values, times, grid_times):
+    """
+    将各行的数据依照时间线性插值至时间网格，全部核素一同计算
+    时间点重合时直接取原值，超出 times 范围或者相邻的值为NaN时结果为NaN
+
+    Parameters
+    ----------
+    values : np.ndarray
+        数据，shape (row, step)
+    times : np.ndarray
+        各步骤的时间点，shape (step,)
+    grid_times : np.ndarray
+        目标时间网格，shape (grid,)
+
+    Returns
+    -------
+    np.ndarray
+        shape (row, grid)
+    """
+    order = np.argsort(times, kind='stable')
+    times, values = times[order], values[:, order]
+    num_of_times = len(times)
+
+    upper = np.searchsorted(times, grid_times)
+    lower = upper - 1
+    is_upper_equal = (upper < num_of_times) & np.isclose(times[np.minimum(upper, num_of_times - 1)], grid_times)
+    is_lower_equal = (lower >= 0) & np.isclose(times[np.maximum(lower, 0)], grid_times)
+    is_equal = is_upper_equal | is_lower_equal
+    is_inside = ~is_equal & (lower >= 0) & (upper < num_of_times)
+
+    result = np.full((len(values), len(grid_times)), np.nan)
+    result[:, is_equal] = values[:, np.where(is_upper_equal, upper, lower)[is_equal]]
+
+    lower, upper = lower[is_inside], upper[is_inside]
+    weight = (grid_times[is_inside] - times[lower]) / (times[upper] - times[lower])
+    result[:, is_inside] = values[:, lower] + (values[:, upper] - values[:, lower]) * weight
+
+    return result
+
+
+def _align_chunks_by_time(data_chunks, reference_file, comparison_files, is_all_step=False):
+    """
+    将各块中对比文件的数据依照时间插值至基准文件的时间网格，基准文件的数据不变
+    插值后对比文件的列与基准文件的步骤一一对应，之后即可依照位置对比
+
+    Parameters
+    ----------
+    data_chunks : Iterable[list[pd.DataFrame or None]]
+        参见 stream_extracted_data_by_filenames_and_physical_quantity
+    reference_file : File
+    comparison_files : list[File]
+    is_all_step : bool, default = False
+
+    Returns
+    -------
+    Generator[list[pd.DataFrame or None]]
+    """
+    grid_times = _step_times(reference_file, int(reference_file.repeat_times) if is_all_step else 1)
+
+    for reference_data, *comparison_data in data_chunks:
+        aligned_data = []
+        for data, comparison_file in zip(comparison_data, comparison_files):
+            if data is None:
+                aligned_data.append(None)
+                continue
+
+            step_num = len(data.columns) - 2
+            columns = [_step_position(column) for column in data.columns[2:]]
+            matrix = np.full((len(data), step_num), np.nan)
+            matrix[:, columns] = data.iloc[:, 2:].to_numpy(dtype=np.float64, na_value=np.nan)
+
+            aligned = pd.DataFrame(_interpolate_to_time_grid(matrix,
+                                                             _step_times(comparison_file, step_num),
+                                                             grid_times),
+                                   columns=_step_column_names(comparison_file.name, len(grid_times)))
+            aligned_data.append(pd.concat([data[['nuc_ix', 'name']].reset_index(drop=True), aligned],
+                                          axis=1, copy=False))
+
+        yield [reference_data, *aligned_data]
+
+
+def _stream_comparison_chunks(nuc_data_id,
+                              reference_file,
+                              comparison_files,
+                              physical_quantity,
+                              is_all_step=False,
+                              chunk_size=10000,
+                              alignment='step'):
+    """
+    分块读取基准文件和对比文件的数据，alignment 为 time 时对比文件的数据插值至基准文件的时间网格
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+    reference_file : File
+    comparison_files : list[File]
+    physical_quantity : PhysicalQuantity
+    is_all_step : bool, default = False
+    chunk_size : int, default = 10000
+    alignment : str, default = 'step'
+        step: 依照步骤的位置对齐
+        time: 依照时间对齐
+
+    Returns
+    -------
+    Generator[list[pd.DataFrame or None]]
+    """
+    data_chunks = stream_extracted_data_by_filenames_and_physical_quantity(nuc_data_id,
+                                                                           [reference_file, *comparison_files],
+                                                                           physical_quantity,
+                                                                           is_all_step,
+                                                                           chunk_size)
+    if alignment == 'step':
+        return data_chunks
+    elif alignment == 'time':
+        return _align_chunks_by_time(data_chunks, reference_file, comparison_files, is_all_step)
+    else:
+        raise Exception("wrong alignment mode")
+
+
+def _compare_chunk(data_chunk,
+                   deviation_mode='relative',
+                   threshold=Decimal('1.0E-12'),
+                   is_high_precision=False,
+                   statistics=None):
+    """
+    对比一块(chunk)数据，基准文件只转换一次，全部对比文件叠加为三维矩阵后一次性计算偏差
+    relative deviation formula: abs(X - Y) / (1 + min(X, Y))
+    absolute deviation formula: abs(X - Y)
+    任一步骤的偏差超过阈值则保留该行，NaN不超过阈值
+
+    先以float64矩阵计算每行的最大偏差进行筛选，只有超过阈值的行才从原始数据中取出并生成详细结果
+    使用Decimal时，float64筛选会放宽舍入误差的范围，只对候选行使用Decimal计算
+
+    Parameters
+    ----------
+    data_chunk : list[pd.DataFrame or None]
+        第一个为基准文件，其余为对比文件
+    deviation_mode : str, default = 'relative'
+    threshold : Decimal, default = Decimal('1.0E-12')
+    is_high_precision : bool, default = False
+        是否使用Decimal计算，默认使用float64
+    statistics : list[_DeviationStatistics], optional
+        与对比文件一一对应，不为None时以同一偏差矩阵累加聚合统计
+
+    Returns
+    -------
+    list[pd.DataFrame or None]
+        各对比文件超过阈值的行，没有则为None
+    """
+    nuc_ix, matrices, row_positions = _chunk_matrices(data_chunk)
+    reference_data, *comparison_data = data_chunk
+    reference, *comparisons = matrices
+
+    present = [i for i, data in enumerate(comparison_data) if data is not None]
+    step_num = reference.shape[1]
+
+    comparison = np.stack([comparisons[i] for i in present])
+    deviations = _deviation_matrix(reference[np.newaxis], comparison, deviation_mode)
+
+    with np.errstate(invalid='ignore'):
+        if is_high_precision:
+            # float64 的舍入误差上限，保证不会漏掉Decimal计算下超过阈值的行
+            error = 8 * np.finfo(np.float64).eps * np.fmax(np.abs(reference[np.newaxis]), np.abs(comparison))
+            if deviation_mode == 'relative':
+                error = error / np.abs(1 + np.minimum(reference[np.newaxis], comparison))
+            row_maximum = np.fmax.reduce(deviations + error, axis=2)
         else:
-            raise Exception("wrong deviation mode")
+            row_maximum = np.fmax.reduce(deviations, axis=2)
+        is_candidate = row_maximum > float(threshold)
 
-        if not deviation.isnull().values.all():
-            df_deviation[f'{deviation_mode}_deviation_middle_step_{i}'] = deviation
+    if statistics is not None:
+        names = np.full(len(nuc_ix), None, dtype=object)
+        is_reference_row = row_positions[0] >= 0
+        names[is_reference_row] = reference_data['name'].to_numpy()[row_positions[0][is_reference_row]]
+        for k, i in enumerate(present):
+            statistics[i].update(deviations[k], nuc_ix, names)
 
-        i += 1
+    deviation_columns = _step_column_names(f'{deviation_mode}_deviation', step_num)
 
-    df_deviation.rename(columns={f'{deviation_mode}_deviation_middle_step_0': f'{deviation_mode}_deviation_last_step'},
-                        inplace=True)
+    df_results = [None] * len(comparison_data)
+    for k, i in enumerate(present):
+        rows = np.flatnonzero(is_candidate[k])
+        if not rows.size:
+            continue
 
-    reserved_index = (df_deviation.T > threshold).any()
-    df_deviation = df_deviation.loc[reserved_index].reset_index(drop=True)
+        reference_rows = row_positions[0][rows]
+        comparison_rows = row_positions[i + 1][rows]
 
-    return df_deviation, reserved_index
+        if is_high_precision:
+            deviation, _, exceeded = _deviation_matrix_decimal(_decimal_rows(reference_data, reference_rows, step_num),
+                                                               _decimal_rows(comparison_data[i],
+                                                                             comparison_rows,
+                                                                             step_num),
+                                                               deviation_mode,
+                                                               threshold)
+            is_reserved = exceeded.any(axis=1)
+            if not is_reserved.any():
+                continue
+            deviation = deviation[is_reserved]
+            reference_rows = reference_rows[is_reserved]
+            comparison_rows = comparison_rows[is_reserved]
+        else:
+            deviation = deviations[k][rows]
+
+        df_results[i] = pd.concat([reference_data.iloc[reference_rows].reset_index(drop=True),
+                                   comparison_data[i].iloc[comparison_rows, 2:].reset_index(drop=True),
+                                   pd.DataFrame(deviation, columns=deviation_columns)],
+                                  axis=1, copy=False)
+
+    return df_results
 
 
-def _merge_reference_comparison_and_deviation(df_reference,
-                                              df_comparison,
-                                              df_deviation,
-                                              reserved_index,
-                                              reserved_na=False):
+def _concat_chunks(df_chunks, reference_file_name, comparison_file_name, deviation_mode):
     """
-    依据reserved_index合并reference，comparison和deviation表
-    如果reserved_na为False,则drop columns with all NaN's，否则反之
-    默认reserved_na为False
+    合并各块的对比结果，drop columns with all NaN's，
+    并将 reference，comparison，deviation columns 分别依照 last_step, middle_step_1, middle_step_2... 排序
 
     Parameters
     ----------
-    df_reference : pd.DataFrame
-    df_comparison : pd.DataFrame
-    df_deviation : pd.DataFrame
-    reserved_index : pd.Series
-    reserved_na : bool, default = False
-        如果reserved_na为False,则drop columns with all NaN's，否则反之
+    df_chunks : list[pd.DataFrame]
+    reference_file_name : str
+    comparison_file_name : str
+    deviation_mode : str
 
     Returns
     -------
     pd.DataFrame
     """
-    df_ = pd.merge(df_reference.loc[reserved_index],
-                   df_comparison.loc[reserved_index],
-                   how='outer', on=['nuc_ix', 'name'])
+    df_all = pd.concat(df_chunks, ignore_index=True, copy=False)
+    df_all.dropna(axis=1, how='all', inplace=True)
+
+    columns = ['nuc_ix', 'name']
+    for prefix in (reference_file_name, comparison_file_name, f'{deviation_mode}_deviation'):
+        pattern = re.compile(rf'{re.escape(prefix)}_(last_step|middle_step_\d+)')
+        columns.extend(sorted((column for column in df_all.columns if pattern.fullmatch(column)),
+                              key=_step_order))
+
+    return df_all.loc[:, columns]
+
+
+class _DeviationStatistics:
+    """
+    一对文件某一物理量的聚合偏差统计，在逐块对比时累加，不需要读回详细结果
+    每一步: 全部核素中的最大偏差(及所在核素)和RMS偏差
+    每个核素: 全部步骤中的最大偏差(及所在步骤)和RMS偏差
+    统计基于float64偏差，NaN不参与统计
+    """
+
+    def __init__(self):
+        self.step_maximum = np.empty(0)
+        self.step_argmax_nuc_ix = np.empty(0, dtype=np.int64)
+        self.step_argmax_name = np.empty(0, dtype=object)
+        self.step_square_sum = np.empty(0)
+        self.step_count = np.empty(0, dtype=np.int64)
+        self.nuclide_chunks = []
+
+    def _grow(self, step_num):
+        # 各块的步数可能不同，依照最大步数扩充
+        grow = step_num - len(self.step_maximum)
+        if grow <= 0:
+            return
+        self.step_maximum = np.concatenate([self.step_maximum, np.full(grow, np.nan)])
+        self.step_argmax_nuc_ix = np.concatenate([self.step_argmax_nuc_ix, np.full(grow, -1)])
+        self.step_argmax_name = np.concatenate([self.step_argmax_name, np.full(grow, None, dtype=object)])
+        self.step_square_sum = np.concatenate([self.step_square_sum, np.zeros(grow)])
+        self.step_count = np.concatenate([self.step_count, np.zeros(grow, dtype=np.int64)])
+
+    def update(self, deviation, nuc_ix, names):
+        """
+        累加一块的偏差
+
+        Parameters
+        ----------
+        deviation : np.ndarray
+            偏差矩阵，shape (row, step)
+        nuc_ix : np.ndarray
+            各行的nuc_ix，shape (row,)
+        names : np.ndarray
+            各行的核素名，shape (row,)
+
+        Returns
+        -------
+
+        """
+        is_valid = ~np.isnan(deviation)
+        rows = np.flatnonzero(is_valid.any(axis=1))
+        if not rows.size:
+            return
+
+        deviation, is_valid = deviation[rows], is_valid[rows]
+        nuc_ix, names = nuc_ix[rows], names[rows]
+        filled = np.where(is_valid, deviation, -np.inf)
+        squares = np.where(is_valid, deviation, 0) ** 2
+
+        # 每个核素
+        nuclide_argmax = filled.argmax(axis=1)
+        self.nuclide_chunks.append((nuc_ix,
+                                    names,
+                                    filled[np.arange(len(rows)), nuclide_argmax],
+                                    nuclide_argmax,
+                                    np.sqrt(squares.sum(axis=1) / is_valid.sum(axis=1))))
+
+        # 每一步
+        step_num = deviation.shape[1]
+        self._grow(step_num)
+        step_argmax = filled.argmax(axis=0)
+        step_maximum = filled[step_argmax, np.arange(step_num)]
+        is_greater = step_maximum > np.where(np.isnan(self.step_maximum[:step_num]),
+                                             -np.inf,
+                                             self.step_maximum[:step_num])
+        steps = np.flatnonzero(is_greater)
+        self.step_maximum[steps] = step_maximum[steps]
+        self.step_argmax_nuc_ix[steps] = nuc_ix[step_argmax[steps]]
+        self.step_argmax_name[steps] = names[step_argmax[steps]]
+        self.step_square_sum[:step_num] += squares.sum(axis=0)
+        self.step_count[:step_num] += is_valid.sum(axis=0)
+
+    def to_frames(self):
+        """
+        生成统计结果
+
+        Returns
+        -------
+        tuple[pd.DataFrame, pd.DataFrame]
+            每一步的统计，每个核素的统计
+        """
+        steps = np.flatnonzero(self.step_count)
+        step_names = _step_names(len(self.step_count))
+        df_step = pd.DataFrame({'step': [step_names[i] for i in steps],
+                                'max_deviation': self.step_maximum[steps],
+                                'nuc_ix': self.step_argmax_nuc_ix[steps],
+                                'name': self.step_argmax_name[steps],
+                                'rms_deviation': np.sqrt(self.step_square_sum[steps] / self.step_count[steps])})
+
+        if self.nuclide_chunks:
+            nuc_ix, names, maximum, argmax, rms = (np.concatenate(arrays) for arrays in zip(*self.nuclide_chunks))
+        else:
+            nuc_ix, names, maximum, argmax, rms = (np.empty(0), np.empty(0, dtype=object),
+                                                   np.empty(0), np.empty(0, dtype=np.int64), np.empty(0))
+        step_names = _step_names(int(argmax.max(initial=0)) + 1)
+        df_nuclide = pd.DataFrame({'nuc_ix': nuc_ix,
+                                   'name': names,
+                                   'max_deviation': maximum,
+                                   'step': [step_names[i] for i in argmax.tolist()],
+                                   'rms_deviation': rms})
+
+        return df_step, df_nuclide.sort_values('nuc_ix', ignore_index=True)
+
+
+def calculate_comparative_results(nuc_data_id,
+                                  reference_file,
+                                  comparison_files,
+                                  physical_quantities='isotope',
+                                  deviation_mode='relative',
+                                  threshold=Decimal('1.0E-12'),
+                                  is_all_step=False,
+                                  chunk_size=10000,
+                                  is_high_precision=False,
+                                  is_statistics=False,
+                                  alignment='step'):
+    """
+    选定一个基准文件，与对比文件列表中的文件一一对比，计算并返回对比结果
+    数据依照nuc_ix分块读取，每块中基准文件的数据只读取和转换一次，全部对比文件一同计算，
+    内存中只保留超过阈值的行
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+    reference_file : File or str
+        基准文件
+    comparison_files : list[File or str] or File or str
+        对比文件列表
+    physical_quantities : list[str or PhysicalQuantity] or str or PhysicalQuantity, default = 'isotope'
+        对比用物理量，可以是物理量名的list[str]或str，
+        也可以是PhysicalQuantity list也可以是list[PhysicalQuantity]或PhysicalQuantity
+        默认为核素密度
+    deviation_mode : str, default = 'relative'
+        绝对=absolute
+        相对=relative
+        偏差模式，分为绝对和相对，默认为相对
+    threshold : Decimal, default = Decimal('1.0E-12')
+        偏差阈值，默认1.0E-12
+    is_all_step : bool, default = False
+        是否读取全部中间结果数据列，默认只读取最终结果列
+    chunk_size : int, default = 10000
+        每块的行数
+    is_high_precision : bool, default = False
+        是否使用Decimal计算偏差，默认使用float64
+    is_statistics : bool, default = False
+        是否同时计算聚合统计，结果中增加 {物理量}_step_stat (每一步的最大、RMS偏差及最大偏差所在核素)
+        和 {物理量}_nuc_stat (每个核素的最大、RMS偏差及最大偏差所在步骤)
+    alignment : str, default = 'step'
+        step: 依照步骤的位置对比，步数不同时较短的一方补NaN
+        time: 依照文件的 time_interval 和 repeat_times 生成时间轴，
+        对比文件的数据线性插值至基准文件各步骤的时间点后再对比，超出对比文件时间范围的步骤为NaN
+
+    Returns
+    -------
+    list[dict[str, pd.DataFrame]]
+        与 comparison_files 一一对应
+    """
+
+    if type_checker(reference_file, File) == 'str':
+        reference_file = fetch_files_by_name(reference_file).pop()
 
-    df_all = pd.concat([df_, df_deviation], axis=1, copy=False)
+    if type_checker(comparison_files, File) == 'str':
+        comparison_files = fetch_files_by_name(comparison_files)
 
-    if not reserved_na:
-        df_all.dropna(axis=1, how='all', inplace=True)
+    if not isinstance(comparison_files, list):
+        comparison_files = [comparison_files]
 
-    return df_all
+    if type_checker(physical_quantities, PhysicalQuantity) == 'str':
+        physical_quantities = fetch_physical_quantities_by_name(physical_quantities)
+
+    if not isinstance(physical_quantities, list):
+        physical_quantities = [physical_quantities]
+
+    comparison_file_names = [comparison_file.name for comparison_file in comparison_files]
+    threshold = Decimal(threshold)
+
+    list_dict_df_all = [{} for _ in comparison_files]
+
+    physical_quantity: PhysicalQuantity
+    for physical_quantity in physical_quantities:
+        df_chunks = [[] for _ in comparison_files]
+        has_data = np.zeros(len(comparison_files) + 1, dtype=bool)
+        statistics = [_DeviationStatistics() for _ in comparison_files] if is_statistics else None
+
+        for data_chunk in _stream_comparison_chunks(nuc_data_id,
+                                                    reference_file,
+                                                    comparison_files,
+                                                    physical_quantity,
+                                                    is_all_step,
+                                                    chunk_size,
+                                                    alignment):
+            has_data |= [data is not None for data in data_chunk]
+
+            if data_chunk[0] is None or all(data is None for data in data_chunk[1:]):
+                # 该块中只有一方有数据，偏差全为NaN，不会超过阈值
+                continue
+
+            for i, df_result in enumerate(_compare_chunk(data_chunk,
+                                                         deviation_mode,
+                                                         threshold,
+                                                         is_high_precision,
+                                                         statistics)):
+                if df_result is not None:
+                    df_chunks[i].append(df_result)
+
+        for i, comparison_file_name in enumerate(comparison_file_names):
+            if not (has_data[0] and has_data[i + 1]):
+                # 任意一方没有数据则跳过该物理量
+                continue
+
+            if df_chunks[i]:
+                list_dict_df_all[i][physical_quantity.name] = _concat_chunks(df_chunks[i],
+                                                                             reference_file.name,
+                                                                             comparison_file_name,
+                                                                             deviation_mode)
+            else:
+                # 没有超过阈值的行
+                list_dict_df_all[i][physical_quantity.name] = pd.DataFrame()
+
+            if is_statistics:
+                (list_dict_df_all[i][f'{physical_quantity.name}_step_stat'],
+                 list_dict_df_all[i][f'{physical_quantity.name}_nuc_stat']) = statistics[i].to_frames()
+
+    return list_dict_df_all
 
 
 def calculate_comparative_result(nuc_data_id,
@@ -162,9 +727,14 @@ def calculate_comparative_result(nuc_data_id,
                                  physical_quantities='isotope',
                                  deviation_mode='relative',
                                  threshold=Decimal('1.0E-12'),
-                                 is_all_step=False):
+                                 is_all_step=False,
+                                 chunk_size=10000,
+                                 is_high_precision=False,
+                                 is_statistics=False,
+                                 alignment='step'):
     """
     选定一个基准文件，一个对比文件，与其进行对比，计算并返回对比结果
+    参见 calculate_comparative_results
 
     Parameters
     ----------
@@ -174,64 +744,545 @@ def calculate_comparative_result(nuc_data_id,
     comparison_file : File or str
         对比文件
     physical_quantities : list[str or PhysicalQuantity] or str or PhysicalQuantity, default = 'isotope'
-        对比用物理量，可以是物理量名的list[str]或str，
-        也可以是PhysicalQuantity list也可以是list[PhysicalQuantity]或PhysicalQuantity
-        默认为核素密度
+        对比用物理量
     deviation_mode : str, default = 'relative'
-        绝对=absolute
-        相对=relative
-        偏差模式，分为绝对和相对，默认为相对
+        偏差模式，分为绝对(absolute)和相对(relative)，默认为相对
     threshold : Decimal, default = Decimal('1.0E-12')
         偏差阈值，默认1.0E-12
     is_all_step : bool, default = False
         是否读取全部中间结果数据列，默认只读取最终结果列
+    chunk_size : int, default = 10000
+        每块的行数
+    is_high_precision : bool, default = False
+        是否使用Decimal计算偏差，默认使用float64
+    is_statistics : bool, default = False
+        是否同时计算聚合统计
+    alignment : str, default = 'step'
+        对齐方式，依照步骤(step)或者时间(time)
 
     Returns
     -------
     dict[str, pd.DataFrame]
     """
+    if type_checker(comparison_file, File) == 'str':
+        comparison_file = fetch_files_by_name(comparison_file).pop()
+
+    return calculate_comparative_results(nuc_data_id=nuc_data_id,
+                                         reference_file=reference_file,
+                                         comparison_files=[comparison_file],
+                                         physical_quantities=physical_quantities,
+                                         deviation_mode=deviation_mode,
+                                         threshold=threshold,
+                                         is_all_step=is_all_step,
+                                         chunk_size=chunk_size,
+                                         is_high_precision=is_high_precision,
+                                         is_statistics=is_statistics,
+                                         alignment=alignment).pop()
+
+
+def calculate_comparison_summary(nuc_data_id,
+                                 reference_file,
+                                 comparison_files,
+                                 physical_quantities='isotope',
+                                 deviation_mode='relative',
+                                 threshold=Decimal('1.0E-12'),
+                                 is_all_step=False,
+                                 chunk_size=10000,
+                                 alignment='step'):
+    """
+    计算基准文件与对比文件列表对比结果的摘要，不生成详细结果
+    每个文件对和物理量统计超过阈值的核素数，以及最大偏差和对应的核素和步骤
+    任意一方没有数据的物理量不统计
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+    reference_file : File or str
+        基准文件
+    comparison_files : list[File or str] or File or str
+        对比文件列表
+    physical_quantities : list[str or PhysicalQuantity] or str or PhysicalQuantity, default = 'isotope'
+        物理量
+    deviation_mode : str, default = 'relative'
+        偏差模式，分为绝对(absolute)和相对(relative)，默认为相对
+    threshold : Decimal, default = Decimal('1.0E-12')
+        偏差阈值，默认1.0E-12
+    is_all_step : bool, default = False
+        是否读取全部中间结果数据列，默认只读取最终结果列
+    chunk_size : int, default = 10000
+        每块的行数
+    alignment : str, default = 'step'
+        对齐方式，依照步骤(step)或者时间(time)，参见 calculate_comparative_results
 
-    if type_checker([reference_file, comparison_file], File) == 'str':
+    Returns
+    -------
+    pd.DataFrame
+        columns 为 reference, comparison, physical_quantity, count, max_deviation, nuc_ix, name, step
+    """
+    if type_checker(reference_file, File) == 'str':
         reference_file = fetch_files_by_name(reference_file).pop()
-        comparison_file = fetch_files_by_name(comparison_file).pop()
+
+    if type_checker(comparison_files, File) == 'str':
+        comparison_files = fetch_files_by_name(comparison_files)
+
+    if not isinstance(comparison_files, list):
+        comparison_files = [comparison_files]
 
     if type_checker(physical_quantities, PhysicalQuantity) == 'str':
         physical_quantities = fetch_physical_quantities_by_name(physical_quantities)
 
-    dict_df_all = {}
+    if not isinstance(physical_quantities, list):
+        physical_quantities = [physical_quantities]
+
+    threshold = float(threshold)
+    records = []
 
     physical_quantity: PhysicalQuantity
     for physical_quantity in physical_quantities:
-        reference_data = fetch_extracted_data_by_filename_and_physical_quantity(nuc_data_id,
-                                                                                reference_file,
-                                                                                physical_quantity,
-                                                                                is_all_step)
-
-        comparison_data = fetch_extracted_data_by_filename_and_physical_quantity(nuc_data_id,
-                                                                                 comparison_file,
-                                                                                 physical_quantity,
-                                                                                 is_all_step
-                                                                                 )
-
-        if reference_data.empty or comparison_data.empty:
+        count = np.zeros(len(comparison_files), dtype=np.int64)
+        maximum = np.full(len(comparison_files), -np.inf)
+        locations = [(None, None, None)] * len(comparison_files)
+        has_data = np.zeros(len(comparison_files) + 1, dtype=bool)
+
+        for data_chunk in _stream_comparison_chunks(nuc_data_id,
+                                                    reference_file,
+                                                    comparison_files,
+                                                    physical_quantity,
+                                                    is_all_step,
+                                                    chunk_size,
+                                                    alignment):
+            has_data |= [data is not None for data in data_chunk]
+
+            if data_chunk[0] is None or all(data is None for data in data_chunk[1:]):
+                continue
+
+            _, (reference, *comparisons), row_positions = _chunk_matrices(data_chunk)
+            present = [i for i, comparison in enumerate(comparisons) if comparison is not None]
+            deviations = _deviation_matrix(reference[np.newaxis],
+                                           np.stack([comparisons[i] for i in present]),
+                                           deviation_mode)
+
+            with np.errstate(invalid='ignore'):
+                count[present] += (np.fmax.reduce(deviations, axis=2) > threshold).sum(axis=1)
+
+            for k, i in enumerate(present):
+                deviation = np.where(np.isnan(deviations[k]), -np.inf, deviations[k])
+                row, step = np.unravel_index(np.argmax(deviation), deviation.shape)
+                if deviation[row, step] > maximum[i]:
+                    maximum[i] = deviation[row, step]
+                    reference_row = data_chunk[0].iloc[row_positions[0][row]]
+                    locations[i] = (int(reference_row['nuc_ix']),
+                                    reference_row['name'],
+                                    'last_step' if step == 0 else f'middle_step_{step}')
+
+        for i, comparison_file in enumerate(comparison_files):
+            if not (has_data[0] and has_data[i + 1]):
+                # 任意一方没有数据则跳过该物理量
+                continue
+
+            nuc_ix, name, step = locations[i]
+            records.append({'reference': reference_file.name,
+                            'comparison': comparison_file.name,
+                            'physical_quantity': physical_quantity.name,
+                            'count': int(count[i]),
+                            'max_deviation': maximum[i] if np.isfinite(maximum[i]) else np.nan,
+                            'nuc_ix': nuc_ix,
+                            'name': name,
+                            'step': step})
+
+    return pd.DataFrame(records, columns=['reference', 'comparison', 'physical_quantity', 'count',
+                                          'max_deviation', 'nuc_ix', 'name', 'step'])
+
+
+def calculate_deviation_statistics(nuc_data_id,
+                                   filenames,
+                                   physical_quantities='isotope',
+                                   deviation_mode='relative',
+                                   is_all_step=False,
+                                   chunk_size=10000):
+    """
+    计算文件列表两两之间偏差的最大值，平均值和均方根(RMS)，得到 N x N 矩阵
+    全部文件的数据依照nuc_ix分块一同读取，每个文件只读取一次，NaN 不参与统计
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+    filenames : list[File or str] or str
+        文件列表
+    physical_quantities : list[str or PhysicalQuantity] or str or PhysicalQuantity, default = 'isotope'
+        物理量
+    deviation_mode : str, default = 'relative'
+        偏差模式，分为绝对(absolute)和相对(relative)，默认为相对
+    is_all_step : bool, default = False
+        是否读取全部中间结果数据列，默认只读取最终结果列
+    chunk_size : int, default = 10000
+        每块的行数
+
+    Returns
+    -------
+    dict[str, dict[str, pd.DataFrame]]
+        {physical quantity name: {'max': df, 'mean': df, 'rms': df}}，df 的 index 和 columns 均为文件名
+    """
+    if type_checker(filenames, File) == 'str':
+        filenames = fetch_files_by_name(filenames)
+
+    if type_checker(physical_quantities, PhysicalQuantity) == 'str':
+        physical_quantities = fetch_physical_quantities_by_name(physical_quantities)
+
+    if not isinstance(physical_quantities, list):
+        physical_quantities = [physical_quantities]
+
+    file_names = [filename.name for filename in filenames]
+    file_num = len(filenames)
+
+    dict_statistics = {}
+
+    physical_quantity: PhysicalQuantity
+    for physical_quantity in physical_quantities:
+        maximum = np.full((file_num, file_num), -np.inf)
+        total = np.zeros((file_num, file_num))
+        square_total = np.zeros((file_num, file_num))
+        count = np.zeros((file_num, file_num), dtype=np.int64)
+        has_data = np.zeros(file_num, dtype=bool)
+
+        for data_chunk in stream_extracted_data_by_filenames_and_physical_quantity(nuc_data_id,
+                                                                                   filenames,
+                                                                                   physical_quantity,
+                                                                                   is_all_step,
+                                                                                   chunk_size):
+            present = np.flatnonzero([data is not None for data in data_chunk])
+            has_data[present] = True
+            if len(present) < 2:
+                continue
+
+            _, chunk_matrices, _ = _chunk_matrices(data_chunk)
+            matrices = np.stack([chunk_matrices[i] for i in present]).reshape(len(present), -1)
+
+            # 偏差对称，只计算上三角，对每个文件一次性计算其与后续全部文件的偏差
+            for k, i in enumerate(present[:-1]):
+                others = present[k + 1:]
+                deviation = _deviation_matrix(matrices[k][np.newaxis], matrices[k + 1:], deviation_mode)
+                is_valid = ~np.isnan(deviation)
+                deviation = np.where(is_valid, deviation, 0)
+
+                maximum[i, others] = np.maximum(maximum[i, others],
+                                                np.where(is_valid, deviation, -np.inf).max(axis=1))
+                total[i, others] += deviation.sum(axis=1)
+                square_total[i, others] += np.square(deviation).sum(axis=1)
+                count[i, others] += is_valid.sum(axis=1)
+
+        if not has_data.any():
             continue
 
-        reference_data, comparison_data = _complement_columns(reference_data,
-                                                              comparison_data,
-                                                              reference_file.name,
-                                                              comparison_file.name)
+        upper = np.triu_indices(file_num, k=1)
+        lower = (upper[1], upper[0])
+        for matrix in (maximum, total, square_total, count):
+            matrix[lower] = matrix[upper]
 
-        df_deviation, reserved_index = _calculate_deviation(reference_data,
-                                                            comparison_data,
-                                                            deviation_mode,
-                                                            Decimal(threshold))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            statistics = {'max': np.where(count > 0, maximum, np.nan),
+                          'mean': np.where(count > 0, total / count, np.nan),
+                          'rms': np.where(count > 0, np.sqrt(square_total / count), np.nan)}
 
-        dict_df_all[physical_quantity.name] = _merge_reference_comparison_and_deviation(reference_data,
-                                                                                        comparison_data,
-                                                                                        df_deviation,
-                                                                                        reserved_index)
+        for matrix in statistics.values():
+            # 文件与自身的偏差为0
+            matrix[np.diag_indices(file_num)] = np.where(has_data, 0, np.nan)
 
-    return dict_df_all
+        dict_statistics[physical_quantity.name] = {
+            key: pd.DataFrame(matrix,
+                              index=pd.Index(file_names, name='file'),
+                              columns=file_names)
+            for key, matrix in statistics.items()}
+
+    return dict_statistics
+
+
+def save_deviation_statistics_to_excel(nuc_data_id,
+                                       filenames,
+                                       result_path,
+                                       physical_quantities='isotope',
+                                       deviation_mode='relative',
+                                       is_all_step=False,
+                                       chunk_size=10000,
+                                       output_format='xlsx'):
+    """
+    计算文件列表两两之间偏差的最大值，平均值和均方根，输出至工作簿(xlsx文件)
+    每个物理量输出 {physical quantity}_max，{physical quantity}_mean，{physical quantity}_rms 三个sheet
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+    filenames : list[File or str] or str
+        文件列表
+    result_path : Path or str
+    physical_quantities : list[str or PhysicalQuantity] or str or PhysicalQuantity, default = 'isotope'
+        物理量
+    deviation_mode : str, default = 'relative'
+        偏差模式，分为绝对(absolute)和相对(relative)，默认为相对
+    is_all_step : bool, default = False
+        是否读取全部中间结果数据列，默认只读取最终结果列
+    chunk_size : int, default = 10000
+        每块的行数
+    output_format : str, default = 'xlsx'
+        输出格式，xlsx，csv，parquet，feather 或 hdf5，参见 open_writer
+
+    Returns
+    -------
+
+    """
+    dict_statistics = calculate_deviation_statistics(nuc_data_id=nuc_data_id,
+                                                     filenames=filenames,
+                                                     physical_quantities=physical_quantities,
+                                                     deviation_mode=deviation_mode,
+                                                     is_all_step=is_all_step,
+                                                     chunk_size=chunk_size)
+
+    dict_df_all = {f'{physical_quantity}_{key}': df.reset_index()
+                   for physical_quantity, statistics in dict_statistics.items()
+                   for key, df in statistics.items()}
+
+    file_name = f'{deviation_mode}_all_pairs.xlsx'
+
+    if is_all_step:
+        file_name = f'all_step_{file_name}'
+
+    remove_output(Path(result_path).joinpath('comparative_result').joinpath(file_name), output_format)
+    save_to_excel(dict_df_all,
+                  file_name,
+                  Path(result_path).joinpath('comparative_result'),
+                  output_format)
+
+
+def _load_or_calculate_comparative_results(nuc_data_id,
+                                           reference_file,
+                                           comparison_files,
+                                           physical_quantities,
+                                           deviation_mode='relative',
+                                           threshold=Decimal('1.0E-12'),
+                                           is_all_step=False,
+                                           chunk_size=10000,
+                                           is_high_precision=False,
+                                           nuclide_list=None,
+                                           is_recompute=False,
+                                           is_statistics=False):
+    """
+    优先读取数据库中保存的对比结果(两个文件的数据版本号均未改变)，只计算缺少的文件对和物理量，
+    并将新的计算结果保存至数据库
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+    reference_file : File
+    comparison_files : list[File]
+    physical_quantities : list[PhysicalQuantity]
+    deviation_mode : str, default = 'relative'
+    threshold : Decimal, default = Decimal('1.0E-12')
+    is_all_step : bool, default = False
+    chunk_size : int, default = 10000
+    is_high_precision : bool, default = False
+    nuclide_list : list[str] or str or None
+        生成 nuc_data_id 所用的核素列表，作为保存结果的key的一部分
+    is_recompute : bool, default = False
+        是否忽略已保存的结果，重新计算
+    is_statistics : bool, default = False
+        是否同时计算聚合统计，已保存的结果中没有聚合统计时重新计算
+
+    Returns
+    -------
+    tuple[list[dict[str, pd.DataFrame]], list[bool]]
+        与 comparison_files 一一对应的对比结果，以及是否全部来自已保存的结果
+    """
+    key = {'deviation_mode': deviation_mode,
+           'threshold': str(Decimal(threshold).normalize()),
+           'is_all_step': bool(is_all_step),
+           'is_high_precision': bool(is_high_precision),
+           'nuclide_key': nuclide_list_key(nuclide_list)}
+
+    list_dict_df_all = [{} for _ in comparison_files]
+    is_reused = [True] * len(comparison_files)
+    comparison_results = []
+
+    for physical_quantity in physical_quantities:
+        stored_results = {} if is_recompute else fetch_comparison_results(reference_file,
+                                                                          comparison_files,
+                                                                          physical_quantity,
+                                                                          **key)
+        statistics_names = [f'{physical_quantity.name}_step_stat', f'{physical_quantity.name}_nuc_stat']
+
+        if is_statistics:
+            stored_results = {comparison_file_id: result for comparison_file_id, result in stored_results.items()
+                              if result is None or statistics_names[0] in result}
+
+        missing = [i for i, comparison_file in enumerate(comparison_files)
+                   if comparison_file.id not in stored_results]
+        calculated_results = []
+        if missing:
+            calculated_results = calculate_comparative_results(nuc_data_id=nuc_data_id,
+                                                               reference_file=reference_file,
+                                                               comparison_files=[comparison_files[i]
+                                                                                 for i in missing],
+                                                               physical_quantities=[physical_quantity],
+                                                               deviation_mode=deviation_mode,
+                                                               threshold=threshold,
+                                                               is_all_step=is_all_step,
+                                                               chunk_size=chunk_size,
+                                                               is_high_precision=is_high_precision,
+                                                               is_statistics=is_statistics)
+
+        for i, dict_df in zip(missing, calculated_results):
+            is_reused[i] = False
+            comparison_results.append({'reference_file_id': reference_file.id,
+                                       'comparison_file_id': comparison_files[i].id,
+                                       'physical_quantity_id': physical_quantity.id,
+                                       'reference_generation': reference_file.generation,
+                                       'comparison_generation': comparison_files[i].generation,
+                                       'result': dict_df or None,
+                                       **key})
+            stored_results[comparison_files[i].id] = dict_df or None
+
+        for i, comparison_file in enumerate(comparison_files):
+            result = stored_results[comparison_file.id]
+            if result is None:
+                continue
+            list_dict_df_all[i].update((sheet_name, df) for sheet_name, df in result.items()
+                                       if is_statistics or sheet_name not in statistics_names)
+
+    if comparison_results:
+        save_comparison_results(comparison_results)
+
+    return list_dict_df_all, is_reused
+
+
+def _save_comparative_results(nuc_data_id,
+                              reference_file,
+                              comparison_files,
+                              result_path,
+                              physical_quantities='isotope',
+                              deviation_mode='relative',
+                              threshold=Decimal('1.0E-12'),
+                              is_all_step=False,
+                              chunk_size=10000,
+                              is_high_precision=False,
+                              nuclide_list=None,
+                              is_persisted=False,
+                              is_recompute=False,
+                              is_statistics=False,
+                              alignment='step',
+                              output_format='xlsx'):
+    """
+    计算基准文件与对比文件列表的对比结果，并逐一输出至工作簿(xlsx文件)
+    参数参见 save_comparison_result_to_excel
+
+    Returns
+    -------
+
+    """
+    if type_checker(reference_file, File) == 'str':
+        reference_file = fetch_files_by_name(reference_file).pop()
+
+    if type_checker(comparison_files, File) == 'str':
+        comparison_files = fetch_files_by_name(comparison_files)
+
+    if not isinstance(comparison_files, list):
+        comparison_files = [comparison_files]
+
+    # 依照时间对齐的结果不保存至数据库
+    if is_persisted and alignment == 'step':
+        if type_checker(physical_quantities, PhysicalQuantity) == 'str':
+            physical_quantities = fetch_physical_quantities_by_name(physical_quantities)
+
+        if not isinstance(physical_quantities, list):
+            physical_quantities = [physical_quantities]
+
+        list_dict_df_all, is_reused = _load_or_calculate_comparative_results(nuc_data_id=nuc_data_id,
+                                                                             reference_file=reference_file,
+                                                                             comparison_files=comparison_files,
+                                                                             physical_quantities=physical_quantities,
+                                                                             deviation_mode=deviation_mode,
+                                                                             threshold=threshold,
+                                                                             is_all_step=is_all_step,
+                                                                             chunk_size=chunk_size,
+                                                                             is_high_precision=is_high_precision,
+                                                                             nuclide_list=nuclide_list,
+                                                                             is_recompute=is_recompute,
+                                                                             is_statistics=is_statistics)
+    else:
+        # 基准文件的数据只读取一次，全部对比文件一同计算
+        list_dict_df_all = calculate_comparative_results(nuc_data_id=nuc_data_id,
+                                                         reference_file=reference_file,
+                                                         comparison_files=comparison_files,
+                                                         physical_quantities=physical_quantities,
+                                                         deviation_mode=deviation_mode,
+                                                         threshold=threshold,
+                                                         is_all_step=is_all_step,
+                                                         chunk_size=chunk_size,
+                                                         is_high_precision=is_high_precision,
+                                                         is_statistics=is_statistics,
+                                                         alignment=alignment)
+        is_reused = [False] * len(comparison_files)
+
+    for comparison_file, dict_df_all, is_pair_reused in zip(comparison_files, list_dict_df_all, is_reused):
+        print((reference_file.name, comparison_file.name))
+
+        file_name = f'{deviation_mode}_{threshold}_{reference_file.name}_vs_{comparison_file.name}.xlsx'
+
+        if alignment == 'time':
+            file_name = f'time_aligned_{file_name}'
+
+        if is_all_step:
+            file_name = f'all_step_{file_name}'
+
+        file_path = Path(result_path).joinpath('comparative_result').joinpath(file_name)
+        if is_pair_reused and output_exists(file_path, output_format):
+            # 结果没有变化，工作簿无需重新输出
+            continue
+
+        remove_output(file_path, output_format)
+        save_to_excel(dict_df_all,
+                      file_name,
+                      Path(result_path).joinpath('comparative_result'),
+                      output_format)
+
+
+# worker 进程共享的 nuc_data_id，由 _init_worker 设置，避免每个任务重复传输
+_worker_nuc_data_id = None
+
+
+def _init_worker(nuc_data_id):
+    """
+    初始化 worker 进程
+
+    Parameters
+    ----------
+    nuc_data_id : list[int]
+
+    Returns
+    -------
+
+    """
+    global _worker_nuc_data_id
+    _worker_nuc_data_id = nuc_data_id
+    # fork 得到的连接池属于父进程，不能在子进程中使用
+    engine.dispose(close=False)
+
+
+def _save_comparative_results_in_worker(reference_file_name, comparison_file_names, physical_quantity_names,
+                                        **kwargs):
+    """
+    在 worker 进程中运行 _save_comparative_results，文件和物理量以名称传递
+
+    Returns
+    -------
+
+    """
+    reference_file = fetch_files_by_name(reference_file_name).pop()
+    comparison_files = fetch_files_by_name(comparison_file_names)
+
+    _save_comparative_results(_worker_nuc_data_id,
+                              reference_file,
+                              comparison_files,
+                              physical_quantities=fetch_physical_quantities_by_name(physical_quantity_names),
+                              **kwargs)
 
 
 def save_comparison_result_to_excel(nuc_data_id,
@@ -241,7 +1292,16 @@ def save_comparison_result_to_excel(nuc_data_id,
                                     physical_quantities='isotope',
                                     deviation_mode='relative',
                                     threshold=Decimal('1.0E-12'),
-                                    is_all_step=False):
+                                    is_all_step=False,
+                                    chunk_size=10000,
+                                    is_high_precision=False,
+                                    jobs=1,
+                                    nuclide_list=None,
+                                    is_persisted=False,
+                                    is_recompute=False,
+                                    is_statistics=False,
+                                    alignment='step',
+                                    output_format='xlsx'):
     """
     选定一个基准文件，使其与对比文件列表中的文件一一对比，计算并输出对比结果至工作簿(xlsx文件)
 
@@ -265,34 +1325,80 @@ def save_comparison_result_to_excel(nuc_data_id,
         偏差阈值，默认1.0E-12
     is_all_step : bool, default = False
         是否读取全部中间结果数据列，默认只读取最终结果列
+    chunk_size : int, default = 10000
+        每块的行数
+    is_high_precision : bool, default = False
+        是否使用Decimal计算偏差，默认使用float64
+    jobs : int, default = 1
+        并行的进程数，大于1时对比文件分组在多个进程中计算和输出
+    nuclide_list : list[str] or str or None
+        生成 nuc_data_id 所用的核素列表，is_persisted 为 True 时作为保存结果的key的一部分
+    is_persisted : bool, default = False
+        是否将对比结果保存至数据库，并复用数据版本号未改变的文件对的结果
+    is_recompute : bool, default = False
+        是否忽略已保存的结果，重新计算
+    is_statistics : bool, default = False
+        是否在同一次计算中输出聚合统计，每个物理量增加 {物理量}_step_stat 和 {物理量}_nuc_stat 两个工作表
+    alignment : str, default = 'step'
+        对齐方式，依照步骤(step)或者时间(time)，参见 calculate_comparative_results，
+        依照时间对齐的结果不保存至数据库，输出的文件名以 time_aligned_ 开头
+    output_format : str, default = 'xlsx'
+        输出格式，xlsx，csv，parquet，feather 或 hdf5，参见 open_writer
 
     Returns
     -------
     """
 
+    kwargs = {'result_path': result_path,
+              'deviation_mode': deviation_mode,
+              'threshold': threshold,
+              'is_all_step': is_all_step,
+              'chunk_size': chunk_size,
+              'is_high_precision': is_high_precision,
+              'nuclide_list': nuclide_list,
+              'is_persisted': is_persisted,
+              'is_recompute': is_recompute,
+              'is_statistics': is_statistics,
+              'alignment': alignment,
+              'output_format': output_format}
+
     if type_checker(reference_file, File) == 'str':
-        reference_file = fetch_files_by_name(reference_file)
+        reference_file = fetch_files_by_name(reference_file).pop()
 
     if type_checker(comparison_files, File) == 'str':
         comparison_files = fetch_files_by_name(comparison_files)
 
-    for comparison_file in comparison_files:
-        print((reference_file.name, comparison_file.name))
+    if not isinstance(comparison_files, list):
+        comparison_files = [comparison_files]
 
-        dict_df_all = calculate_comparative_result(nuc_data_id=nuc_data_id,
-                                                   reference_file=reference_file,
-                                                   comparison_file=comparison_file,
-                                                   physical_quantities=physical_quantities,
-                                                   deviation_mode=deviation_mode,
-                                                   threshold=threshold,
-                                                   is_all_step=is_all_step)
+    jobs = min(jobs, len(comparison_files))
+    if jobs <= 1:
+        _save_comparative_results(nuc_data_id,
+                                  reference_file,
+                                  comparison_files,
+                                  physical_quantities=physical_quantities,
+                                  **kwargs)
+        return
 
-        file_name = f'{deviation_mode}_{threshold}_{reference_file.name}_vs_{comparison_file.name}.xlsx'
+    if type_checker(physical_quantities, PhysicalQuantity) == 'str':
+        physical_quantities = fetch_physical_quantities_by_name(physical_quantities)
 
-        if is_all_step:
-            file_name = f'all_step_{file_name}'
+    if not isinstance(physical_quantities, list):
+        physical_quantities = [physical_quantities]
 
-        Path(result_path).joinpath('comparative_result').joinpath(file_name).unlink(missing_ok=True)
-        save_to_excel(dict_df_all,
-                      file_name,
-                      Path(result_path).joinpath('comparative_result'))
+    physical_quantity_names = [physical_quantity.name for physical_quantity in physical_quantities]
+
+    # 对比文件分为 jobs 组，每组在一个 worker 进程中与基准文件一同读取、计算并输出
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_init_worker,
+                             initargs=(nuc_data_id,)) as executor:
+        futures = [executor.submit(_save_comparative_results_in_worker,
+                                   reference_file.name,
+                                   [comparison_file.name for comparison_file in comparison_files[i::jobs]],
+                                   physical_quantity_names,
+                                   **kwargs)
+                   for i in range(jobs)]
+
+        for future in futures:
+            # 抛出 worker 中的异常
+            future.result()
@@ -1,7 +1,16 @@
+import abc
+import datetime
+import importlib.util
+import itertools
+import math
+import numbers
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from openpyxl import load_workbook
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
 
 
 def get_column_index(filename):
@@ -95,9 +104,594 @@ def append_df_to_excel(filename, df, sheet_name='Sheet1', startrow=None,
     writer.save()
 
 
-def save_to_excel(dict_df, file_name, dir_path):
+class WorkbookWriter:
     """
-    保存结果至xlsx文件
+    工作簿写入会话，一个文件的全部工作表写入同一个打开的工作簿，关闭时只保存一次
+
+    新文件使用 openpyxl 的 write_only 模式，逐行流式写入临时文件，内存占用与工作表的大小无关
+    文件已存在时读取该工作簿后追加工作表，同名工作表则追加在已有内容之后(与 append_df_to_excel 相同)
+    表头的格式与 pd.DataFrame.to_excel 相同，NaN 输出为空单元格
+
+    超过 Excel 的行数(max_rows)或者列数(max_columns)上限的表拆分为多个续表，
+    依照创建的顺序命名为 {sheet name}_2, {sheet name}_3...，先依照列拆分，再依照行拆分，
+    每个续表都保留表头，并且重复 nuc_ix 和 name 列
+    write_chunks 可以逐块写入一个工作表，写满一个续表后再创建下一个，不需要预先知道总行数
+
+    Examples
+    --------
+    >>> with WorkbookWriter('final.xlsx') as writer:
+    ...     writer.write('isotope', df_isotope)
+    ...     writer.write('decay_heat', df_decay_heat)
+    ...     writer.write_chunks('fission', iter_df_fission)
+    """
+
+    _header_font = Font(bold=True)
+    _header_border = Border(left=Side(style='thin'),
+                            right=Side(style='thin'),
+                            top=Side(style='thin'),
+                            bottom=Side(style='thin'))
+    _header_alignment = Alignment(horizontal='center', vertical='top')
+
+    # Excel 工作表的行数和列数上限
+    max_rows = 1048576
+    max_columns = 16384
+    key_columns = ('nuc_ix', 'name')
+
+    def __init__(self, file_path):
+        self.file_path = Path(file_path)
+        self.is_write_only = not self.file_path.is_file()
+        if self.is_write_only:
+            self.book = Workbook(write_only=True)
+        else:
+            self.book = load_workbook(self.file_path)
+        self.num_of_sheets = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+    def _header_cell(self, sheet, value):
+        cell = WriteOnlyCell(sheet, value=value)
+        self._set_header_style(cell)
+        return cell
+
+    def _set_header_style(self, cell):
+        cell.font = self._header_font
+        cell.border = self._header_border
+        cell.alignment = self._header_alignment
+
+    def write(self, sheet_name, df):
+        """
+        写入一个工作表，不输出index，超过行数或者列数上限时写入多个续表
+
+        Parameters
+        ----------
+        sheet_name : str
+        df : pd.DataFrame
+
+        Returns
+        -------
+
+        """
+        self.write_chunks(sheet_name, [df])
+
+    def write_chunks(self, sheet_name, df_chunks):
+        """
+        逐块写入一个工作表，各块的 columns 与第一块相同，每一块写入后即可释放
+        没有任何块时不创建工作表
+
+        Parameters
+        ----------
+        sheet_name : str
+        df_chunks : Iterable[pd.DataFrame]
+
+        Returns
+        -------
+
+        """
+        column_blocks = None
+        # 每个列块当前的续表和已使用的行数，首次写入该列块时才创建，以便依照先列后行的顺序命名
+        parts = []
+        part_names = (sheet_name if part == 1 else f'{sheet_name}_{part}' for part in itertools.count(1))
+
+        for df in df_chunks:
+            if column_blocks is None:
+                column_blocks = self._column_blocks(df.columns.tolist())
+                parts = [None] * len(column_blocks)
+
+            for i, columns in enumerate(column_blocks):
+                if parts[i] is None:
+                    parts[i] = self._open_sheet(next(part_names), columns)
+
+                rows = _sheet_rows(df.loc[:, columns]) if columns else []
+                while rows:
+                    sheet, num_of_rows = parts[i]
+                    if num_of_rows >= self.max_rows:
+                        parts[i] = self._open_sheet(next(part_names), columns)
+                        continue
+
+                    rows_in_sheet, rows = rows[:self.max_rows - num_of_rows], rows[self.max_rows - num_of_rows:]
+                    for row in rows_in_sheet:
+                        sheet.append(row)
+                    parts[i] = [sheet, num_of_rows + len(rows_in_sheet)]
+
+    def _column_blocks(self, columns):
+        """
+        依照列数上限拆分 columns，超过上限时每一块都以 nuc_ix 和 name 开头
+
+        Parameters
+        ----------
+        columns : list[str]
+
+        Returns
+        -------
+        list[list[str]]
+        """
+        if len(columns) <= self.max_columns:
+            return [columns]
+
+        key_columns = [column for column in columns[:len(self.key_columns)]
+                       if column in self.key_columns]
+        data_columns = columns[len(key_columns):]
+        num_of_columns = self.max_columns - len(key_columns)
+
+        return [key_columns + data_columns[start:start + num_of_columns]
+                for start in range(0, len(data_columns), num_of_columns)]
+
+    def _open_sheet(self, sheet_name, columns):
+        """
+        创建工作表并写入表头，已存在的同名工作表则在已有内容之后写入表头
+
+        Returns
+        -------
+        list
+            [工作表, 已使用的行数]
+        """
+        is_existing = not self.is_write_only and sheet_name in self.book.sheetnames
+        sheet = self.book[sheet_name] if is_existing else self.book.create_sheet(sheet_name)
+        self.num_of_sheets += 1
+
+        if not columns:
+            return [sheet, 0]
+
+        if self.is_write_only:
+            sheet.append([self._header_cell(sheet, column) for column in columns])
+            return [sheet, 1]
+
+        start_row = sheet.max_row + 1 if is_existing else 1
+        for j, column in enumerate(columns, start=1):
+            self._set_header_style(sheet.cell(row=start_row, column=j, value=column))
+
+        return [sheet, start_row]
+
+    def close(self):
+        """
+        保存工作簿，新文件没有写入任何工作表时不生成文件
+
+        Returns
+        -------
+
+        """
+        if self.is_write_only and not self.num_of_sheets:
+            return
+
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self.book.save(self.file_path)
+
+
+class _DirectoryWriter(abc.ABC):
+    """
+    每个工作表输出为目录中的一个文件，{dir}/{sheet name}.{suffix}
+    """
+
+    suffix = None
+
+    def __init__(self, dir_path):
+        self.dir_path = Path(dir_path)
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+    def write(self, sheet_name, df):
+        """
+        写入一个工作表，同名的文件会被替换
+
+        Parameters
+        ----------
+        sheet_name : str
+        df : pd.DataFrame
+
+        Returns
+        -------
+
+        """
+        self.write_chunks(sheet_name, [df])
+
+    def write_chunks(self, sheet_name, df_chunks):
+        """
+        逐块写入一个工作表，各块的 columns 与第一块相同，同名的文件会被替换
+        没有任何块时不生成文件
+
+        Parameters
+        ----------
+        sheet_name : str
+        df_chunks : Iterable[pd.DataFrame]
+
+        Returns
+        -------
+
+        """
+        self._write_chunks(df_chunks, self.dir_path.joinpath(f'{sheet_name}.{self.suffix}'))
+
+    @abc.abstractmethod
+    def _write_chunks(self, df_chunks, file_path):
+        """
+        将全部块写入 file_path
+
+        Parameters
+        ----------
+        df_chunks : Iterable[pd.DataFrame]
+        file_path : Path
+
+        Returns
+        -------
+
+        """
+
+    def close(self):
+        pass
+
+
+class CsvWriter(_DirectoryWriter):
+    """
+    csv 格式，Decimal 原样输出，不损失精度
+    """
+
+    suffix = 'csv'
+
+    def _write_chunks(self, df_chunks, file_path):
+        columns = None
+        for df in df_chunks:
+            if columns is None:
+                columns = df.columns
+                df.to_csv(file_path, index=False)
+            else:
+                df.reindex(columns=columns).to_csv(file_path, mode='a', header=False, index=False)
+
+
+class _ArrowWriter(_DirectoryWriter):
+    """
+    依照第一块的 schema 逐块写入 arrow table(需要pyarrow)，数值列为float64
+    """
+
+    def __init__(self, dir_path):
+        _check_module('pyarrow', self.suffix)
+        super().__init__(dir_path)
+
+    def _write_chunks(self, df_chunks, file_path):
+        import pyarrow as pa
+
+        writer = None
+        schema = None
+        try:
+            for df in df_chunks:
+                df = _to_columnar(df)
+                if writer is None:
+                    table = pa.Table.from_pandas(df, preserve_index=False)
+                    schema = table.schema
+                    writer = self._open_file(file_path, schema)
+                else:
+                    table = pa.Table.from_pandas(df.reindex(columns=schema.names),
+                                                 schema=schema,
+                                                 preserve_index=False)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    @abc.abstractmethod
+    def _open_file(self, file_path, schema):
+        """
+        打开 file_path，返回有 write_table 和 close 方法的 writer
+
+        Parameters
+        ----------
+        file_path : Path
+        schema : pyarrow.Schema
+
+        Returns
+        -------
+        pyarrow.parquet.ParquetWriter or pyarrow.ipc.RecordBatchFileWriter
+        """
+
+
+class ParquetWriter(_ArrowWriter):
+    """
+    parquet 格式(需要pyarrow)，数值列为float64，每一块为一个 row group
+    """
+
+    suffix = 'parquet'
+
+    def _open_file(self, file_path, schema):
+        import pyarrow.parquet as pq
+
+        return pq.ParquetWriter(file_path, schema)
+
+
+class FeatherWriter(_ArrowWriter):
+    """
+    feather 格式(需要pyarrow)，数值列为float64，每一块为一个 record batch
+    """
+
+    suffix = 'feather'
+
+    def _open_file(self, file_path, schema):
+        import pyarrow as pa
+
+        # 与 pd.DataFrame.to_feather 相同，默认使用lz4压缩
+        compression = 'lz4' if pa.Codec.is_available('lz4') else None
+        return pa.ipc.new_file(str(file_path), schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+
+
+class Hdf5Writer:
+    """
+    HDF5 格式(需要tables)，每个工作表为文件中的一个 group，key 为 sheet name，数值列为float64
+    """
+
+    def __init__(self, file_path):
+        _check_module('tables', 'HDF5')
+        self.file_path = Path(file_path)
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self.store = pd.HDFStore(self.file_path, mode='a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, sheet_name, df):
+        """
+        写入一个工作表，同名的 group 会被替换
+
+        Parameters
+        ----------
+        sheet_name : str
+        df : pd.DataFrame
+
+        Returns
+        -------
+
+        """
+        self.write_chunks(sheet_name, [df])
+
+    def write_chunks(self, sheet_name, df_chunks):
+        """
+        逐块写入一个工作表，同名的 group 会被替换
+        只有一块时使用 fixed 格式，多于一块时使用可以追加的 table 格式
+
+        Parameters
+        ----------
+        sheet_name : str
+        df_chunks : Iterable[pd.DataFrame]
+
+        Returns
+        -------
+
+        """
+        df_chunks = iter(df_chunks)
+        df_first = next(df_chunks, None)
+        if df_first is None:
+            return
+
+        df_second = next(df_chunks, None)
+        if df_second is None:
+            self.store.put(sheet_name, _to_columnar(df_first), format='fixed')
+            return
+
+        if sheet_name in self.store:
+            self.store.remove(sheet_name)
+
+        df_first = _to_columnar(df_first)
+        # table 格式的字符串列宽度在第一次写入时确定
+        min_itemsize = {column: max([64, *df_first[column].astype(str).str.len().tolist()])
+                        for column in df_first.columns[df_first.dtypes == object].tolist()}
+        columns = df_first.columns
+
+        self.store.append(sheet_name, df_first, format='table', min_itemsize=min_itemsize)
+        for df in itertools.chain([df_second], df_chunks):
+            self.store.append(sheet_name, _to_columnar(df.reindex(columns=columns)), format='table')
+
+    def close(self):
+        self.store.close()
+
+
+_writers = {'xlsx': WorkbookWriter,
+            'csv': CsvWriter,
+            'parquet': ParquetWriter,
+            'feather': FeatherWriter,
+            'hdf5': Hdf5Writer}
+
+output_formats = list(_writers)
+
+
+def output_path(file_path, output_format='xlsx'):
+    """
+    依据输出格式生成实际的输出路径，file_path 为 xlsx 格式的文件路径
+    xlsx: {name}.xlsx，hdf5: {name}.h5，csv/parquet/feather: {name} 目录
+
+    Parameters
+    ----------
+    file_path : Path or str
+    output_format : str, default = 'xlsx'
+
+    Returns
+    -------
+    Path
+    """
+    file_path = Path(file_path)
+
+    if output_format == 'xlsx':
+        return file_path.with_suffix('.xlsx')
+    elif output_format == 'hdf5':
+        return file_path.with_suffix('.h5')
+    elif output_format in _writers:
+        return file_path.with_suffix('')
+    else:
+        raise Exception(f"can't support {output_format} format")
+
+
+def open_writer(file_path, output_format='xlsx'):
+    """
+    打开对应格式的写入会话，write(sheet_name, df) 写入一个工作表，close() 结束写入
+
+    Parameters
+    ----------
+    file_path : Path or str
+        xlsx 格式的文件路径，参见 output_path
+    output_format : str, default = 'xlsx'
+        xlsx，csv，parquet，feather 或 hdf5
+
+    Returns
+    -------
+    WorkbookWriter or CsvWriter or ParquetWriter or FeatherWriter or Hdf5Writer
+    """
+    return _writers[output_format](output_path(file_path, output_format))
+
+
+def output_exists(file_path, output_format='xlsx'):
+    """
+    输出文件，或者目录中该格式的文件是否存在
+
+    Parameters
+    ----------
+    file_path : Path or str
+        xlsx 格式的文件路径，参见 output_path
+    output_format : str, default = 'xlsx'
+
+    Returns
+    -------
+    bool
+    """
+    path = output_path(file_path, output_format)
+    if path.is_dir():
+        return any(path.glob(f'*.{_writers[output_format].suffix}'))
+
+    return path.is_file()
+
+
+def remove_output(file_path, output_format='xlsx'):
+    """
+    删除已存在的输出文件，或者目录中该格式的文件
+
+    Parameters
+    ----------
+    file_path : Path or str
+        xlsx 格式的文件路径，参见 output_path
+    output_format : str, default = 'xlsx'
+
+    Returns
+    -------
+
+    """
+    path = output_path(file_path, output_format)
+    if not path.is_dir():
+        path.unlink(missing_ok=True)
+        return
+
+    # 同一目录中可能有其他格式的输出，只删除该格式的文件
+    for sheet_path in path.glob(f'*.{_writers[output_format].suffix}'):
+        sheet_path.unlink()
+    if not any(path.iterdir()):
+        path.rmdir()
+
+
+def _check_module(module_name, format_name):
+    if importlib.util.find_spec(module_name) is None:
+        raise Exception(f'{module_name} is required to write {format_name} files, '
+                        f'please install it with pip install {module_name} or pip install nuc-data-tool[formats]')
+
+
+def _to_columnar(df):
+    """
+    将全部为数值(Decimal等)的 object 列转换为float64，全部为整数的 object 列转换为int64，以便写入列式存储格式
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    dtypes = {}
+    for column, dtype in df.dtypes.items():
+        if dtype.kind != 'O':
+            continue
+
+        values = df[column].tolist()
+        if all(isinstance(value, numbers.Integral) and not isinstance(value, bool) for value in values):
+            dtypes[column] = np.int64
+        elif all(isinstance(value, numbers.Number) and not isinstance(value, bool)
+                 for value in df[column].dropna().tolist()):
+            dtypes[column] = np.float64
+
+    if not dtypes:
+        return df
+
+    return df.astype(dtypes)
+
+
+def _sheet_rows(df):
+    """
+    将DataFrame转换为逐行写入的list，单元格的值与 pd.DataFrame.to_excel 相同:
+    NaN/None 为空单元格，inf 为字符串，Decimal 等非基本类型输出为 str
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+
+    Returns
+    -------
+    list[list]
+    """
+    values = df.to_numpy(dtype=object)
+    values[pd.isna(values)] = None
+
+    for j, dtype in enumerate(df.dtypes.tolist()):
+        if dtype.kind == 'f':
+            column = df.iloc[:, j].to_numpy()
+            values[np.isposinf(column), j] = 'inf'
+            values[np.isneginf(column), j] = '-inf'
+        elif dtype.kind == 'O':
+            values[:, j] = [_excel_value(value) for value in values[:, j].tolist()]
+
+    return values.tolist()
+
+
+def _excel_value(value):
+    if value is None or isinstance(value, (str, datetime.date, datetime.timedelta)):
+        return value
+
+    if isinstance(value, numbers.Real):
+        if math.isinf(value):
+            return 'inf' if value > 0 else '-inf'
+        return value
+
+    return str(value)
+
+
+def save_to_excel(dict_df, file_name, dir_path, output_format='xlsx'):
+    """
+    保存结果至xlsx文件(或者 output_format 指定的格式)，全部工作表在同一个写入会话中写入，文件只保存一次
     keys of dict 为 sheet name
     values of dict 为 worksheet table
 
@@ -106,6 +700,8 @@ def save_to_excel(dict_df, file_name, dir_path):
     dict_df : dict[str, pd.DataFrame]
     file_name : str
     dir_path : Path or str
+    output_format : str, default = 'xlsx'
+        xlsx，csv，parquet，feather 或 hdf5，参见 open_writer
 
     Returns
     -------
@@ -113,11 +709,7 @@ def save_to_excel(dict_df, file_name, dir_path):
 
     dir_path = Path(dir_path)
     dir_path.mkdir(parents=True, exist_ok=True)
-    file_path = dir_path.joinpath(file_name)
-
-    for key in dict_df:
-        append_df_to_excel(file_path,
-                           dict_df[key],
-                           sheet_name=key,
-                           index=False,
-                           encoding='utf-8')
+
+    with open_writer(dir_path.joinpath(file_name), output_format) as writer:
+        for key in dict_df:
+            writer.write(key, dict_df[key])
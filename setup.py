@@ -31,9 +31,13 @@ setup(
 
     include_package_data=True,
 
-    install_requires=["SQLAlchemy >= 1.4.0", "pandas", "toml",
+    install_requires=["SQLAlchemy >= 1.4.33", "pandas", "toml",
                       "protobuf", "openpyxl", "click",
                       "psycopg2", "mysql-connector-python", "pycaret >= 2.3.0"],
+    extras_require={
+        # --format parquet/feather 需要 pyarrow，hdf5 需要 tables(pandas.HDFStore)
+        "formats": ["pyarrow", "tables"],
+    },
     python_requires=">=3.8",
 
     entry_points={